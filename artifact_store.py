@@ -0,0 +1,538 @@
+"""
+Хранилище артефактов для обучения: загрузка архива частями с докачкой и раздача по HTTP
+- ArtifactServer — локальный HTTP-сервер: принимает загрузку частями, сверяет sha256 каждой части
+  и файла целиком и раздаёт готовые файлы по ссылке /artifacts/<sha256>/<имя> (с поддержкой Range).
+- upload_file — загрузчик частями через HTTPArtifactBackend. Состояние
+  загрузки хранит сервер (id загрузки выводится из хеша и имени), поэтому прерванная загрузка —
+  в том числе после перезапуска процесса — продолжается с последней принятой части.
+Без ARTIFACT_TOKEN сервер слушает только localhost: иначе загружать мог бы кто угодно.
+
+    ARTIFACT_TOKEN=... python artifact_store.py serve --host 0.0.0.0 --port 8765 --public-url https://artifacts.example.com
+    python artifact_store.py upload training_data.zip --server http://localhost:8765
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import logging
+import ipaddress
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# КОНФИГУРАЦИЯ
+# =============================================================================
+
+ARTIFACT_SERVER_URL = os.getenv("ARTIFACT_SERVER_URL")      # Куда загружать (если не задан — ручная загрузка)
+ARTIFACT_PUBLIC_URL = os.getenv("ARTIFACT_PUBLIC_URL")      # Адрес, по которому Replicate скачает файл
+ARTIFACT_TOKEN = os.getenv("ARTIFACT_TOKEN")                # Токен на загрузку (скачивание — по ссылке)
+ARTIFACT_ROOT = os.getenv("ARTIFACT_ROOT", "data/artifacts")
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_RETRIES = 5           # Подряд неудачных попыток на одну часть
+UPLOAD_RETRY_DELAY = 1.0     # Начальная пауза, удваивается
+UPLOAD_TIMEOUT = 60
+MAX_ARTIFACT_BYTES = 10 * 1024 ** 3
+PARTIAL_UPLOAD_MAX_AGE = 24 * 3600  # Незаконченная загрузка без новых частей дольше — удаляется
+READ_CHUNK_SIZE = 1024 * 1024
+
+SAFE_NAME = re.compile(r'[^A-Za-z0-9._-]+')
+
+
+class ChecksumMismatchError(ValueError):
+    """Хеш части или файла целиком не совпал с заявленным"""
+
+
+class OffsetMismatch(Exception):
+    """Клиент и сервер разошлись в позиции загрузки; offset — сколько сервер уже принял"""
+
+    def __init__(self, offset: int):
+        super().__init__(f"Upload offset mismatch, server has {offset} bytes")
+        self.offset = offset
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def safe_name(name: str) -> str:
+    return SAFE_NAME.sub('_', os.path.basename(name)).strip('._') or "artifact"
+
+
+def upload_id_for(sha256: str, name: str) -> str:
+    """Детерминированный id: повторная загрузка того же файла находит свою незаконченную часть"""
+    return hashlib.sha256(f"{sha256}:{safe_name(name)}".encode()).hexdigest()[:24]
+
+# =============================================================================
+# СЕРВЕР
+# =============================================================================
+
+class ArtifactStore:
+    """Файловое хранилище: незаконченные загрузки в partial/, готовые файлы в artifacts/<sha256>/"""
+
+    def __init__(self, root: str = ARTIFACT_ROOT, max_bytes: int = MAX_ARTIFACT_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.partial_dir = os.path.join(root, "partial")
+        self.artifacts_dir = os.path.join(root, "artifacts")
+        os.makedirs(self.partial_dir, exist_ok=True)
+        os.makedirs(self.artifacts_dir, exist_ok=True)
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def _lock(self, upload_id: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(upload_id, threading.Lock())
+
+    def _meta_path(self, upload_id: str) -> str:
+        return os.path.join(self.partial_dir, f"{upload_id}.json")
+
+    def _part_path(self, upload_id: str) -> str:
+        return os.path.join(self.partial_dir, f"{upload_id}.part")
+
+    def artifact_path(self, sha256: str, name: str) -> str:
+        return os.path.join(self.artifacts_dir, sha256, safe_name(name))
+
+    def prune_partial(self, max_age: float = PARTIAL_UPLOAD_MAX_AGE) -> int:
+        """Удаляет брошенные загрузки (без новых частей дольше max_age); возвращает их число"""
+        deadline = time.time() - max_age
+        pruned = 0
+        for name in os.listdir(self.partial_dir):
+            upload_id, extension = os.path.splitext(name)
+            if extension != ".json":
+                continue
+            with self._lock(upload_id):
+                paths = [self._meta_path(upload_id), self._part_path(upload_id)]
+                try:
+                    if max(os.path.getmtime(path) for path in paths if os.path.exists(path)) >= deadline:
+                        continue
+                except ValueError:
+                    continue
+                for path in paths:
+                    if os.path.exists(path):
+                        os.remove(path)
+                pruned += 1
+        if pruned:
+            logger.info(f"Removed {pruned} abandoned upload(s) from {self.partial_dir}")
+        return pruned
+
+    def _load_meta(self, upload_id: str) -> dict:
+        with open(self._meta_path(upload_id)) as f:
+            return json.load(f)
+
+    def start(self, name: str, size: int, sha256: str) -> dict:
+        """Новая загрузка или продолжение прерванной; готовый файл с тем же хешем не загружается снова"""
+        if not re.fullmatch(r'[0-9a-f]{64}', sha256 or ''):
+            raise ValueError("sha256 must be 64 hex characters")
+        if not 0 <= size <= self.max_bytes:
+            raise ValueError(f"Artifact size must be within {self.max_bytes} bytes")
+        name = safe_name(name)
+        if os.path.exists(self.artifact_path(sha256, name)):
+            return {"upload_id": None, "offset": size, "complete": True, "path": f"{sha256}/{name}"}
+        upload_id = upload_id_for(sha256, name)
+        if not os.path.exists(self._meta_path(upload_id)):
+            self.prune_partial()
+        with self._lock(upload_id):
+            if not os.path.exists(self._meta_path(upload_id)):
+                with open(self._meta_path(upload_id), 'w') as f:
+                    json.dump({"name": name, "size": size, "sha256": sha256, "created_at": time.time()}, f)
+                open(self._part_path(upload_id), 'wb').close()
+            offset = os.path.getsize(self._part_path(upload_id))
+        return {"upload_id": upload_id, "offset": offset, "complete": False}
+
+    def append(self, upload_id: str, offset: int, data: bytes, chunk_sha256: str = None) -> int:
+        """
+        Дописывает часть с позиции offset; возвращает новую позицию
+        Позиция не совпала (часть уже принята или пропущена) — OffsetMismatch с фактической позицией.
+        """
+        with self._lock(upload_id):
+            meta = self._load_meta(upload_id)
+            current = os.path.getsize(self._part_path(upload_id))
+            if offset != current:
+                raise OffsetMismatch(current)
+            if current + len(data) > meta["size"]:
+                raise ValueError("Chunk goes past the declared size")
+            if chunk_sha256 and hashlib.sha256(data).hexdigest() != chunk_sha256:
+                raise ChecksumMismatchError("Chunk checksum mismatch")
+            with open(self._part_path(upload_id), 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            return current + len(data)
+
+    def complete(self, upload_id: str) -> str:
+        """Сверяет хеш всего файла и переносит его в artifacts/; возвращает путь <sha256>/<имя>"""
+        with self._lock(upload_id):
+            meta = self._load_meta(upload_id)
+            part_path = self._part_path(upload_id)
+            size = os.path.getsize(part_path)
+            if size != meta["size"]:
+                raise OffsetMismatch(size)
+            if file_sha256(part_path) != meta["sha256"]:
+                # Испорченную загрузку начинаем заново, иначе докачка будет повторять ошибку
+                os.remove(part_path)
+                os.remove(self._meta_path(upload_id))
+                raise ChecksumMismatchError("Artifact checksum mismatch, upload discarded")
+            target = self.artifact_path(meta["sha256"], meta["name"])
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(part_path, target)
+            os.remove(self._meta_path(upload_id))
+        logger.info(f"Artifact {meta['name']} stored ({meta['size'] / 1024 / 1024:.1f} MB, {meta['sha256'][:12]})")
+        return f"{meta['sha256']}/{meta['name']}"
+
+
+class _ArtifactHandler(BaseHTTPRequestHandler):
+    server_version = "ArtifactStore/1.0"
+    service = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self) -> bool:
+        token = self.service.token
+        if token and self.headers.get('Authorization') != f"Bearer {token}":
+            self._send_json(401, {"error": "unauthorized"})
+            return False
+        return True
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _handle(self, action):
+        try:
+            return action()
+        except OffsetMismatch as e:
+            return self._send_json(409, {"error": str(e), "offset": e.offset})
+        except ChecksumMismatchError as e:
+            return self._send_json(422, {"error": str(e)})
+        except FileNotFoundError:
+            return self._send_json(404, {"error": "upload not found"})
+        except ValueError as e:
+            return self._send_json(400, {"error": str(e)})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        path = urlsplit(self.path).path
+        if path == '/uploads':
+            def start():
+                body = json.loads(self._read_body() or b'{}')
+                session = self.service.store.start(body.get("name", ""), int(body.get("size", -1)), body.get("sha256"))
+                if session["complete"]:
+                    session["url"] = self.service.artifact_url(session.pop("path"))
+                self._send_json(200, session)
+            return self._handle(start)
+        match = re.fullmatch(r'/uploads/([0-9a-f]{24})/complete', path)
+        if match:
+            def complete():
+                self._send_json(200, {"url": self.service.artifact_url(self.service.store.complete(match.group(1)))})
+            return self._handle(complete)
+        self._send_json(404, {"error": "not found"})
+
+    def do_PUT(self):
+        if not self._authorized():
+            return
+        parts = urlsplit(self.path)
+        match = re.fullmatch(r'/uploads/([0-9a-f]{24})', parts.path)
+        if not match:
+            return self._send_json(404, {"error": "not found"})
+
+        def append():
+            offset = int(parse_qs(parts.query).get("offset", ["-1"])[0])
+            data = self._read_body()
+            new_offset = self.service.store.append(match.group(1), offset, data, self.headers.get('X-Chunk-SHA256'))
+            self._send_json(200, {"offset": new_offset})
+        self._handle(append)
+
+    def do_HEAD(self):
+        self._serve_artifact(head=True)
+
+    def do_GET(self):
+        self._serve_artifact(head=False)
+
+    def _serve_artifact(self, head: bool):
+        match = re.fullmatch(r'/artifacts/([0-9a-f]{64})/([A-Za-z0-9._-]+)', urlsplit(self.path).path)
+        path = match and self.service.store.artifact_path(match.group(1), match.group(2))
+        if not path or not os.path.isfile(path):
+            return self._send_json(404, {"error": "not found"})
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        range_match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if range_match and (range_match.group(1) or range_match.group(2)):
+            if range_match.group(1):
+                start = int(range_match.group(1))
+                end = min(int(range_match.group(2)), size - 1) if range_match.group(2) else size - 1
+            else:
+                start = max(0, size - int(range_match.group(2)))
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{size}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/zip' if path.endswith('.zip') else 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', f'"{match.group(1)}"')
+        self.end_headers()
+        if head:
+            return
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(READ_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+class _ArtifactHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class ArtifactServer:
+    """HTTP-сервер хранилища в фоновом потоке (или в основном через serve_forever)"""
+
+    def __init__(self, root: str = ARTIFACT_ROOT, host: str = "127.0.0.1", port: int = 0,
+                 public_url: str = None, token: str = None):
+        if not token and not is_loopback(host):
+            raise ValueError(f"Refusing to listen on {host} without a token: set ARTIFACT_TOKEN or bind to 127.0.0.1")
+        self.store = ArtifactStore(root)
+        self.store.prune_partial()
+        self.token = token
+        self._public_url = public_url
+        handler = type('BoundArtifactHandler', (_ArtifactHandler,), {'service': self})
+        self.httpd = _ArtifactHTTPServer((host, port), handler)
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def artifact_url(self, path: str) -> str:
+        return f"{(self._public_url or self.url).rstrip('/')}/artifacts/{path}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+# =============================================================================
+# КЛИЕНТ
+# =============================================================================
+
+class HTTPArtifactBackend:
+    """
+    Клиент загрузки частями для ArtifactServer
+    start -> {"upload_id", "offset", "complete", "url"?}; put_chunk -> новая позиция; finish -> ссылка.
+    При расхождении позиции put_chunk бросает OffsetMismatch с позицией, принятой сервером.
+    """
+
+    def __init__(self, base_url: str, token: str = None, timeout: float = UPLOAD_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def _check(self, response) -> dict:
+        payload = response.json() if response.content else {}
+        if response.status_code == 409:
+            raise OffsetMismatch(payload["offset"])
+        if response.status_code == 422:
+            raise ChecksumMismatchError(payload.get("error", "checksum mismatch"))
+        response.raise_for_status()
+        return payload
+
+    def start(self, name: str, size: int, sha256: str) -> dict:
+        return self._check(self.session.post(f"{self.base_url}/uploads", timeout=self.timeout,
+                                             json={"name": name, "size": size, "sha256": sha256}))
+
+    def put_chunk(self, upload_id: str, offset: int, data: bytes, chunk_sha256: str) -> int:
+        return self._check(self.session.put(
+            f"{self.base_url}/uploads/{upload_id}", params={"offset": offset}, data=data, timeout=self.timeout,
+            headers={"X-Chunk-SHA256": chunk_sha256, "Content-Type": "application/octet-stream"}
+        ))["offset"]
+
+    def finish(self, upload_id: str) -> str:
+        return self._check(self.session.post(f"{self.base_url}/uploads/{upload_id}/complete",
+                                             timeout=self.timeout))["url"]
+
+
+def _retryable(error: Exception) -> bool:
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(error, "response", None)
+    return response is not None and (response.status_code >= 500 or response.status_code == 429)
+
+
+def upload_file(path: str, backend: HTTPArtifactBackend, chunk_size: int = UPLOAD_CHUNK_SIZE,
+                retries: int = UPLOAD_RETRIES, progress=None) -> str:
+    """
+    Загружает файл частями и возвращает ссылку на него
+    Сетевые ошибки и 5xx повторяются с паузой; после ошибки позиция уточняется у бэкенда, так что
+    часть, которую сервер успел принять, не отправляется повторно. progress(sent, total) — по желанию.
+    """
+    size = os.path.getsize(path)
+    sha256 = file_sha256(path)
+    name = os.path.basename(path)
+    failures = 0
+    while True:
+        try:
+            session = backend.start(name, size, sha256)
+            if session.get("complete"):
+                logger.info(f"Artifact {name} already uploaded ({sha256[:12]})")
+                return session["url"]
+            upload_id, offset = session["upload_id"], session["offset"]
+            if offset:
+                logger.info(f"Resuming upload of {name} from {offset / 1024 / 1024:.1f} MB")
+            with open(path, 'rb') as f:
+                while offset < size:
+                    f.seek(offset)
+                    data = f.read(chunk_size)
+                    try:
+                        offset = backend.put_chunk(upload_id, offset, data, hashlib.sha256(data).hexdigest())
+                    except OffsetMismatch as e:
+                        offset = e.offset
+                        continue
+                    failures = 0
+                    if progress:
+                        progress(offset, size)
+            return backend.finish(upload_id)
+        except ChecksumMismatchError:
+            # Сервер отбросил загрузку: файл менялся во время отправки или данные испортились в пути
+            failures += 1
+            if failures > retries:
+                raise
+            sha256 = file_sha256(path)
+            size = os.path.getsize(path)
+        except Exception as e:
+            if not _retryable(e):
+                raise
+            failures += 1
+            if failures > retries:
+                raise
+            delay = UPLOAD_RETRY_DELAY * 2 ** (failures - 1)
+            logger.warning(f"Upload of {name} failed ({e}), retry {failures}/{retries} in {delay:.0f}s")
+            time.sleep(delay)
+
+
+def verify_download(url: str, sha256: str, timeout: float = UPLOAD_TIMEOUT) -> bool:
+    """Скачивает файл по ссылке потоком и сверяет хеш (проверка того, что увидит тренер)"""
+    digest = hashlib.sha256()
+    with requests.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(READ_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest() == sha256
+
+
+def upload_artifact(path: str, server_url: str = None, token: str = None, verify: bool = True,
+                    chunk_size: int = UPLOAD_CHUNK_SIZE) -> str:
+    """Загрузка на ArtifactServer из конфигурации; возвращает ссылку для Replicate"""
+    server_url = server_url or ARTIFACT_SERVER_URL
+    if not server_url:
+        raise ValueError("ARTIFACT_SERVER_URL is not set")
+    started = time.perf_counter()
+
+    def progress(sent, total):
+        print(f"\r   ⬆️  {sent / 1024 / 1024:.1f} / {total / 1024 / 1024:.1f} MB", end="", flush=True)
+
+    url = upload_file(path, HTTPArtifactBackend(server_url, token or ARTIFACT_TOKEN), chunk_size, progress=progress)
+    print()
+    if verify and not verify_download(url, file_sha256(path)):
+        raise ChecksumMismatchError(f"Downloaded artifact does not match {path}")
+    logger.info(f"Uploaded {path} in {time.perf_counter() - started:.1f}s: {url}")
+    return url
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Хранилище артефактов: сервер и загрузка частями")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="Запустить HTTP-сервер хранилища")
+    serve.add_argument("--root", default=ARTIFACT_ROOT, help="Папка хранилища")
+    serve.add_argument("--host", default="127.0.0.1", help="Адрес (не localhost — только с ARTIFACT_TOKEN)")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--public-url", default=ARTIFACT_PUBLIC_URL, help="Внешний адрес для ссылок")
+    upload = commands.add_parser("upload", help="Загрузить файл")
+    upload.add_argument("path")
+    upload.add_argument("--server", default=ARTIFACT_SERVER_URL, help="Адрес сервера хранилища")
+    upload.add_argument("--chunk-mb", type=int, default=UPLOAD_CHUNK_SIZE // 1024 // 1024)
+    upload.add_argument("--no-verify", action="store_true", help="Не скачивать файл для проверки хеша")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if args.command == "serve":
+        try:
+            server = ArtifactServer(args.root, args.host, args.port, args.public_url, ARTIFACT_TOKEN)
+        except ValueError as e:
+            print(f"❌ {e}")
+            return 1
+        print(f"📦 Хранилище {args.root} на {server.url} (ссылки: {server.artifact_url('...')})")
+        try:
+            server.httpd.serve_forever()
+        except KeyboardInterrupt:
+            server.httpd.server_close()
+        return 0
+
+    if not args.server:
+        print("❌ Укажите --server или ARTIFACT_SERVER_URL")
+        return 1
+    if not os.path.isfile(args.path):
+        print(f"❌ Файл {args.path} не найден")
+        return 1
+    url = upload_artifact(args.path, args.server, verify=not args.no_verify, chunk_size=args.chunk_mb * 1024 * 1024)
+    print(f"✅ {url}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
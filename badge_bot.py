@@ -4,26 +4,45 @@ Telegram Bot для автоматической генерации бейдже
 """
 
 import os
+import asyncio
+import hashlib
+import json
 import logging
-import requests
-import tempfile
 import math
-from io import BytesIO
-from PIL import Image, ImageDraw, ImageFont
-import replicate
-from replicate.exceptions import ReplicateError
-from deep_translator import GoogleTranslator
-from telegram import Update
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO, StringIO
+from telegram import Update, Chat, Message
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
     ConversationHandler
 )
 from dotenv import load_dotenv
-import numpy as np
+import replay
+from reference_cache import load_reference_bytes, warm_reference_cache
+from reference_routing import compile_routing_rules
+from request_dedup import SingleFlight, RecentUpdateIds, PerChatUpdateProcessor
+from load_shedding import LoadShedder, compile_degradation_levels
+from metrics import start_metrics_server, add_route
+from pipeline import Pipeline, Stage
+from generation_history import GenerationHistory
+from job_journal import JobJournal
+from model_warmup import ModelLatencyTracker, ModelWarmer, parse_hours
+from prefetch import PrefetchStore, Prefetcher
+from memory_profile import MemoryProfiler, deep_size, format_report as format_memory_report
+from health import Readiness
+from provider_pool import ProviderPool, ProviderUnavailableError
+from usage_stats import UsageStore, build_report as build_usage_report, estimate_cost, format_report, write_csv
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
@@ -42,13 +61,83 @@ logger = logging.getLogger(__name__)
 # API Токены
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "YOUR_TELEGRAM_BOT_TOKEN")
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN", "YOUR_REPLICATE_TOKEN")
+# Пул токенов через запятую (разные аккаунты — разные лимиты); без него — один REPLICATE_API_TOKEN
+REPLICATE_API_TOKENS = [
+    token.strip() for token in os.getenv("REPLICATE_API_TOKENS", "").split(",") if token.strip()
+] or [REPLICATE_API_TOKEN]
 
 # Модели Replicate
 GENERATION_MODEL = "google/nano-banana"
-GENERATION_SEED = None  # None = случайный, число = фиксированный seed
+GENERATION_SEED = None  # None = случайный (выбирается ботом и пишется в историю), число = фиксированный seed
 BACKGROUND_REMOVAL_MODEL = "851-labs/background-remover:a029dff38972b5fda4ec5d75d7d1cd25aeff621d2cf4946a41055d7db66b80bc"
 BACKGROUND_REMOVAL_ENABLED = False  # Активировано
 
+# Параллельная обработка апдейтов (генерация идёт в отдельных потоках; внутри чата — по порядку)
+CONCURRENT_UPDATES = 32
+DUPLICATE_RESULT_TTL = 15  # секунд: повторная отправка того же запроса получает готовый бейдж
+PROVIDER_TOKEN_CONCURRENCY = int(os.getenv("PROVIDER_TOKEN_CONCURRENCY", CONCURRENT_UPDATES))  # вызовов на токен
+
+# Деградация под нагрузкой: срабатывает самый высокий уровень, у которого выполнен порог
+# queue_depth — генераций в полёте, latency_p90 — задержка недавних генераций (сек)
+LOAD_SHEDDING_ENABLED = True
+FAST_GENERATION_MODEL = os.getenv("FAST_GENERATION_MODEL")  # None = уровень fast_model не меняет модель
+LOAD_SHEDDING_LEVELS = [
+    {"name": "no_bg_removal", "queue_depth": 8, "latency_p90": 40, "skip_background_removal": True},
+    {"name": "small_refs", "queue_depth": 16, "latency_p90": 60, "skip_background_removal": True,
+     "reference_max_side": 512},
+    {"name": "fast_model", "queue_depth": 24, "latency_p90": 90, "skip_background_removal": True,
+     "reference_max_side": 512, "model": FAST_GENERATION_MODEL},
+    {"name": "refuse", "queue_depth": 32, "latency_p90": 150, "skip_background_removal": True,
+     "reference_max_side": 512, "model": FAST_GENERATION_MODEL, "refuse": True},
+]
+LOAD_SHEDDING_RECOVERY_SECONDS = 30  # Сколько секунд без давления до шага вниз
+
+# Прогрев моделей: keep-alive предсказания, если модель простаивает дольше интервала
+MODEL_WARMING_ENABLED = False
+MODEL_WARMING_INTERVAL = 240  # секунд простоя до keep-alive (меньше, чем провайдер держит модель)
+MODEL_WARMING_HOURS = "9-21"  # часы мероприятий по локальному времени, "" = круглосуточно
+MODEL_COLD_IDLE_SECONDS = 300  # вызов после такого простоя считается холодным стартом
+
+# Предгенерация в простое: частые недавние запросы и примеры из /examples отдаются из хранилища сразу
+PREFETCH_ENABLED = False
+PREFETCH_DB_PATH = os.getenv("PREFETCH_DB_PATH", "data/prefetch.sqlite3")
+PREFETCH_DAILY_LIMIT = 50  # генераций в день
+PREFETCH_DAILY_BUDGET_USD = 2.0  # оценка по MODEL_PRICING; None = только лимит по числу
+PREFETCH_IDLE_SECONDS = 60  # секунд без генераций пользователей до начала предгенерации
+PREFETCH_HOURS = MODEL_WARMING_HOURS  # "" = круглосуточно
+PREFETCH_POPULAR_DAYS = 3  # окно истории для частых запросов
+PREFETCH_POPULAR_TOP = 10  # сколько частых запросов держать готовыми
+PREFETCH_MIN_USES = 2  # запрос считается частым с такого числа повторов
+PREFETCH_PER_KEY = 1  # готовых бейджей на запрос (каждый отдаётся одному пользователю)
+PREFETCH_MAX_AGE = 7 * 24 * 3600  # секунд: старые бейджи удаляются
+PREFETCH_USER_ID = 0  # user_id в логах и учёте предсказаний (feature="prefetch")
+
+# История генераций (/history, /again, /regen)
+HISTORY_ENABLED = True
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "data/history.sqlite3")
+HISTORY_LIMIT = 10  # Сколько последних генераций показывает /history
+
+# Журнал заданий: после перезапуска бот дожидается уже созданных предсказаний и доставляет бейджи
+JOB_JOURNAL_ENABLED = True
+JOB_JOURNAL_PATH = os.getenv("JOB_JOURNAL_PATH", "data/jobs.sqlite3")
+JOB_RESUME_MAX_AGE = 3600  # секунд: выходы предсказаний API Replicate хранятся около часа
+JOB_RESUME_ATTEMPTS = 2  # задание, на котором бот падал чаще, не возобновляется
+JOB_JOURNAL_RETENTION = 7 * 24 * 3600  # завершённые задания старше удаляются при старте
+
+# Учёт предсказаний (время GPU, очередь, затраты) и команда /stats для администраторов
+USAGE_TRACKING_ENABLED = True
+USAGE_DB_PATH = os.getenv("USAGE_DB_PATH", "data/usage.sqlite3")
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+TELEGRAM_MESSAGE_LIMIT = 4096  # символов в сообщении; длинные отчёты /stats и /memory делятся на части
+# Оценка цен Replicate: поштучно или за секунду GPU (predict_time); проверяйте по странице модели
+MODEL_PRICING = {
+    "google/nano-banana": {"per_prediction": 0.039},
+    "851-labs/background-remover": {"per_second": 0.000225},
+}
+
+# HTTP /metrics в формате Prometheus, /healthz и /readyz для оркестратора (None = выключено)
+METRICS_PORT = os.getenv("METRICS_PORT")
+
 # Режим генерации текста
 GENERATE_TEXT_IN_PROMPT = True  # True = текст генерируется в промпте, False = добавляется программно
 
@@ -56,12 +145,46 @@ GENERATE_TEXT_IN_PROMPT = True  # True = текст генерируется в
 REFERENCE_IMAGES_DIR = "reference_images"
 USE_PREDEFINED_REFERENCE_IMAGES = True
 FEMALE_REFERENCE_IMAGE = "Girl.jpg"  # Референс для женских персонажей
+REFERENCE_PREPROCESS_ENABLED = True  # Уменьшать референсы до размера входа модели (кеш в .cache/)
+REFERENCE_MAX_SIDE = 1024  # Длинная сторона подготовленного референса (px)
+REFERENCE_TOP_K = 4  # Если референсов больше, выбираются k самых подходящих к промпту (индекс в .cache/)
 
 # Ключевые слова для определения женского персонажа
+# Совпадение только по целым словам; "*" в конце = любое окончание (девушка, девушкой)
+# "mom" перечислен формами: "mom*" совпал бы с "moment"
 FEMALE_KEYWORDS = [
-    'girl', 'woman', 'female', 'lady', 'she', 'her', 'wife', 'mother', 'mom', 'daughter',
-    'девушка', 'женщина', 'девочка', 'дама', 'жена', 'мать', 'мама', 'дочь', 'дочка',
-    'сестра', 'sister', 'бабушка', 'grandmother', 'тётя', 'aunt'
+    'girl*', 'woman', 'women', 'female', 'lady', 'ladies', 'she', 'her', 'herself',
+    'wife', 'mother*', 'mom', 'moms', 'mommy', 'momma', 'daughter*', 'sister*', 'grandmother*', 'aunt*',
+    'девушк*', 'женщин*', 'девочк*', 'дама', 'дамы', 'даму', 'дамой', 'жена', 'жены', 'жену', 'женой',
+    'мать', 'матер*', 'мама', 'мамы', 'маму', 'мамой', 'доч*', 'сестр*', 'бабушк*',
+    'тётя', 'тёти', 'тётю', 'тётей'
+]
+
+# Ключевые слова для определения активной/динамичной сцены
+# "руби*" совпал бы с "рубином"; воин — персонаж, а не действие, поэтому warrior/воин не входят
+ACTION_KEYWORDS = [
+    'fight*', 'battle*', 'attack*', 'sword*', 'katana*', 'strike*', 'slash*', 'jump*', 'run', 'running',
+    'бой', 'боя', 'бою', 'битв*', 'атак*', 'меч', 'меча', 'мечом', 'мечи', 'катан*', 'удар*',
+    'прыж*', 'бежать', 'бежит', 'сражени*', 'сража*', 'рубит', 'рубить', 'рубят', 'рубя',
+    'combat', 'action', 'dynamic', 'stance', 'боев*', 'стойк*'
+]
+
+# Правила выбора референсов и дополнений промпта (порядок = приоритет)
+# references: список файлов вместо набора по умолчанию (None = не меняет референсы)
+# prompt_fragment: добавляется к промпту генерации
+REFERENCE_ROUTING_RULES = [
+    {
+        "name": "female",
+        "keywords": FEMALE_KEYWORDS,
+        "references": [FEMALE_REFERENCE_IMAGE],
+        "prompt_fragment": None,
+    },
+    {
+        "name": "action",
+        "keywords": ACTION_KEYWORDS,
+        "references": None,
+        "prompt_fragment": "dynamic action pose with motion lines",
+    },
 ]
 
 # Настройки текста на бейдже
@@ -116,7 +239,11 @@ MESSAGES = {
 
 ⏱ Генерация занимает 10-30 секунд
 
-💡 Если результат не понравился, просто начните заново!""",
+💡 Если результат не понравился, просто начните заново!
+
+🗂 /history — последние бейджи
+🔁 /again [N] — прислать бейдж ещё раз (N из /history, по умолчанию последний)
+🎲 /regen [N] — сгенерировать новый вариант с тем же сюжетом и текстом""",
 
     "examples": """💡 **Примеры хороших запросов:**
 
@@ -199,6 +326,30 @@ MESSAGES = {
     "generating": "⏳ Создаю твой бейдж...\nЭто займёт 10-30 секунд ⚡",
     "generating_quick": "⏳ Создаю бейдж...",
 
+    "history_empty": "🗂 Пока нет сохранённых бейджей. Напиши сюжет, и начнём!",
+    "history_header": "🗂 Последние бейджи:\n",
+    "history_item": "{position}. {scene} | {text} — {date}",
+    "history_footer": "\n🔁 /again N — прислать ещё раз, 🎲 /regen N — новый вариант",
+    "again_not_found": "🤷 Нет бейджа с таким номером. Посмотри /history",
+    "again_no_file": "⚠️ Этот бейдж уже нельзя переслать, попробуй /regen {position}",
+
+    "admin_only": "⛔ Эта команда только для администраторов",
+    "stats_empty": "📊 За {days} дн. предсказаний не было",
+    "stats_usage": "Использование: /stats [дней] [csv|json]",
+    "memory_usage": "Использование: /memory [on [глубина стека]|off|json]",
+    "memory_on": "🧠 tracemalloc включён (глубина стека {frames}). Повторяй /memory, чтобы видеть рост между отчётами",
+    "memory_off": "🧠 tracemalloc выключен",
+    "prefetch_disabled": "📦 Предгенерация выключена (PREFETCH_ENABLED)",
+    "prefetch_header": "📦 Сегодня: {generations} генераций, ${cost_usd:.2f}, выдано {hits}\nГотово:",
+    "prefetch_item": "{ready} × {scene_en} | {badge_text}",
+    "prefetch_empty": "   пока ничего",
+
+    "resumed": "♻️ Бот перезапускался — заканчиваю твой бейдж...",
+    "resume_expired": "😔 Бот перезапускался, и бейдж не удалось восстановить. Попробуй ещё раз!",
+
+    "overloaded": """🚦 Сейчас слишком много заказов бейджей.
+Попробуй снова примерно через {eta} мин.""",
+
     "badge_ready": """🎊 Твой бейдж готов!
 
 🎨 Сюжет: {scene}
@@ -234,6 +385,39 @@ MESSAGES = {
     }
 }
 
+# Правила маршрутизации компилируются один раз при загрузке модуля
+REFERENCE_ROUTER = compile_routing_rules(REFERENCE_ROUTING_RULES)
+
+# Дедупликация: одинаковые генерации в полёте и повторно доставленные апдейты
+BADGE_SINGLE_FLIGHT = SingleFlight(linger=DUPLICATE_RESULT_TTL)
+RECENT_UPDATE_IDS = RecentUpdateIds()
+
+# Стартовые проверки и heartbeat для /healthz и /readyz
+READINESS = Readiness()
+
+# Задержки моделей с разделением на холодные и тёплые старты
+MODEL_LATENCY = ModelLatencyTracker(cold_idle_seconds=MODEL_COLD_IDLE_SECONDS)
+
+# Потоки генерации: пул по умолчанию (cpu + 4) на маленьком контейнере ограничил бы параллельность
+GENERATION_EXECUTOR = ThreadPoolExecutor(max_workers=CONCURRENT_UPDATES, thread_name_prefix="badge")
+
+# Контроллер деградации; без LOAD_SHEDDING_ENABLED остаётся на полном качестве
+LOAD_SHEDDER = LoadShedder(
+    compile_degradation_levels(LOAD_SHEDDING_LEVELS if LOAD_SHEDDING_ENABLED else []),
+    recovery_seconds=LOAD_SHEDDING_RECOVERY_SECONDS,
+    parallelism=CONCURRENT_UPDATES,
+)
+
+# Вызовы моделей распределяются по токенам; токены с ошибками авторизации/квоты уходят в карантин
+PROVIDER_POOL = ProviderPool.from_tokens(REPLICATE_API_TOKENS, max_concurrency=PROVIDER_TOKEN_CONCURRENCY)
+
+# Профилирование памяти по команде /memory (tracemalloc выключен, пока его не включат)
+MEMORY_PROFILER = MemoryProfiler()
+MEMORY_PROFILER.add_source("single_flight", lambda: {
+    "in_flight": len(BADGE_SINGLE_FLIGHT),
+    "recent_results_bytes": deep_size(BADGE_SINGLE_FLIGHT.recent_results()),
+})
+
 # Состояния диалога
 WAITING_FOR_SCENE, WAITING_FOR_BADGE_TEXT, WAITING_FOR_REFERENCE_PHOTOS = range(3)
 
@@ -241,8 +425,10 @@ WAITING_FOR_SCENE, WAITING_FOR_BADGE_TEXT, WAITING_FOR_REFERENCE_PHOTOS = range(
 # ФУНКЦИИ ГЕНЕРАЦИИ
 # =============================================================================
 
-def find_yellow_banner_center(img: Image.Image, user_id: int) -> tuple:
+def find_yellow_banner_center(img: "Image.Image", user_id: int) -> tuple:
     """Находит центр жёлтого баннера на изображении по цвету"""
+    import numpy as np
+    
     try:
         img_array = np.array(img)
         height = img_array.shape[0]
@@ -272,22 +458,39 @@ def find_yellow_banner_center(img: Image.Image, user_id: int) -> tuple:
 
 def is_female_prompt(text: str) -> bool:
     """Проверяет, содержит ли текст упоминание женского персонажа"""
-    text_lower = text.lower()
-    return any(keyword in text_lower for keyword in FEMALE_KEYWORDS)
-
-
-# Ключевые слова для определения активной/динамичной сцены
-ACTION_KEYWORDS = [
-    'fight', 'fighting', 'battle', 'attack', 'sword', 'katana', 'strike', 'slash', 'jump', 'run',
-    'бой', 'битва', 'атака', 'меч', 'катана', 'удар', 'прыжок', 'бежать', 'сражение', 'рубит',
-    'combat', 'warrior', 'action', 'dynamic', 'stance', 'боевой', 'стойка', 'воин'
-]
+    return REFERENCE_ROUTER.classify(text).matched("female")
 
 
 def is_action_scene(text: str) -> bool:
     """Проверяет, является ли сцена активной/динамичной"""
-    text_lower = text.lower()
-    return any(keyword in text_lower for keyword in ACTION_KEYWORDS)
+    return REFERENCE_ROUTER.classify(text).matched("action")
+
+
+def read_reference_file(filepath: str) -> BytesIO:
+    """Читает референс: подготовленную копию из кеша или исходный файл
+    Под нагрузкой уровень деградации может требовать уменьшенные референсы"""
+    degraded_side = LOAD_SHEDDER.current.reference_max_side
+    if REFERENCE_PREPROCESS_ENABLED or degraded_side:
+        max_side = min(REFERENCE_MAX_SIDE, degraded_side or REFERENCE_MAX_SIDE)
+        img_bytes = load_reference_bytes(filepath, max_side=max_side)
+    else:
+        with open(filepath, 'rb') as f:
+            img_bytes = BytesIO(f.read())
+        img_bytes.seek(0)
+    # Исходный файл: по нему ключ предгенерации не зависит от размера копии
+    img_bytes.reference_path = filepath
+    return img_bytes
+
+
+def reference_identity(ref_image):
+    """Имя и время изменения исходного файла референса; загруженное пользователем фото — как есть"""
+    path = getattr(ref_image, "reference_path", None)
+    if path is None:
+        return ref_image
+    try:
+        return f"{os.path.basename(path)}:{os.stat(path).st_mtime_ns}"
+    except OSError:
+        return ref_image
 
 
 def load_single_reference_image(filename: str) -> list:
@@ -298,27 +501,31 @@ def load_single_reference_image(filename: str) -> list:
         return []
     
     try:
-        with open(filepath, 'rb') as f:
-            img_bytes = BytesIO(f.read())
-            img_bytes.seek(0)
-            logger.info(f"Loaded single reference image: {filename}")
-            return [img_bytes]
+        img_bytes = read_reference_file(filepath)
+        logger.info(f"Loaded single reference image: {filename}")
+        return [img_bytes]
     except Exception as e:
         logger.warning(f"Failed to load {filename}: {e}")
         return []
 
 
-def load_reference_images_for_prompt(prompt: str) -> list:
-    """Загружает референсы в зависимости от содержимого промпта"""
-    if is_female_prompt(prompt):
-        logger.info(f"Detected female character in prompt, using {FEMALE_REFERENCE_IMAGE}")
-        return load_single_reference_image(FEMALE_REFERENCE_IMAGE)
+def load_reference_images_for_prompt(prompt: str, prompt_en: str = None) -> list:
+    """Загружает референсы в зависимости от содержимого промпта
+    Правила маршрутизации двуязычные и смотрят исходный текст, теги индекса — английские (prompt_en)"""
+    route = REFERENCE_ROUTER.classify(prompt)
+    if route.references:
+        logger.info(f"Routing rules {route.rules} matched {route.keywords}, using {route.references}")
+        reference_images = []
+        for filename in route.references:
+            reference_images.extend(load_single_reference_image(filename))
+        return reference_images
     else:
-        return load_reference_images_from_dir(REFERENCE_IMAGES_DIR)
+        return load_reference_images_from_dir(REFERENCE_IMAGES_DIR, prompt=prompt_en or prompt)
 
 
-def load_reference_images_from_dir(directory: str) -> list:
-    """Загружает референсные фото из указанной папки, исключая специальные референсы"""
+def load_reference_images_from_dir(directory: str, prompt: str = None) -> list:
+    """Загружает референсные фото из указанной папки, исключая специальные референсы
+    Если передан промпт и файлов больше REFERENCE_TOP_K, берутся самые подходящие по индексу"""
     reference_images = []
     
     if not os.path.exists(directory):
@@ -326,7 +533,8 @@ def load_reference_images_from_dir(directory: str) -> list:
         return reference_images
     
     supported_formats = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
-    excluded_files = [FEMALE_REFERENCE_IMAGE.lower()]
+    # Референсы, закреплённые за правилами маршрутизации, в набор по умолчанию не входят
+    excluded_files = [name.lower() for name in REFERENCE_ROUTER.special_references]
     
     try:
         files = [f for f in os.listdir(directory) 
@@ -335,14 +543,16 @@ def load_reference_images_from_dir(directory: str) -> list:
                 and f.lower() not in excluded_files]
         files.sort()
         
+        if prompt is not None and len(files) > REFERENCE_TOP_K:
+            from reference_index import get_reference_index
+            files = get_reference_index(directory).select(prompt, REFERENCE_TOP_K, candidates=set(files))
+            logger.info(f"Selected top-{REFERENCE_TOP_K} references for prompt: {files}")
+        
         for filename in files:
             filepath = os.path.join(directory, filename)
             try:
-                with open(filepath, 'rb') as f:
-                    img_bytes = BytesIO(f.read())
-                    img_bytes.seek(0)
-                    reference_images.append(img_bytes)
-                    logger.info(f"Loaded reference image: {filename}")
+                reference_images.append(read_reference_file(filepath))
+                logger.info(f"Loaded reference image: {filename}")
             except Exception as e:
                 logger.warning(f"Failed to load {filename}: {e}")
         
@@ -359,8 +569,7 @@ def translate_to_english(text: str, user_id: int) -> str:
         has_cyrillic = any('\u0400' <= char <= '\u04FF' for char in text)
         if has_cyrillic:
             logger.info(f"User {user_id}: Translating '{text}' from Russian to English")
-            translator = GoogleTranslator(source='ru', target='en')
-            translated = translator.translate(text)
+            translated = replay.translate(text, source='ru', target='en')
             logger.info(f"User {user_id}: Translated to '{translated}'")
             return translated
         return text
@@ -369,60 +578,127 @@ def translate_to_english(text: str, user_id: int) -> str:
         return text
 
 
-def generate_image_with_lora(scene_description: str, user_id: int, reference_images: list = None, badge_text: str = None) -> str:
-    """Генерирует изображение через модель google/nano-banana"""
-    if not os.getenv("REPLICATE_API_TOKEN"):
-        os.environ["REPLICATE_API_TOKEN"] = REPLICATE_API_TOKEN
+def rewind_inputs(model_input: dict):
+    """Файлы во входе модели — в начало (перед повтором вызова на другом токене)"""
+    for value in model_input.values():
+        for item in value if isinstance(value, list) else [value]:
+            if hasattr(item, 'seek'):
+                item.seek(0)
+
+
+def call_model(model: str, model_input: dict, prediction: dict = None, on_created=None):
+    """Вызов модели через пул токенов (и слой записи/воспроизведения); имя токена — в prediction["provider"]
+    prediction["user_id"] и prediction["feature"] (если заданы) попадают в учёт предсказаний"""
+    prediction = {} if prediction is None else prediction
+    
+    def call(provider):
+        rewind_inputs(model_input)
+        prediction["provider"] = provider.name
+        return replay.run_model(model, model_input, prediction, on_created, client=provider.client)
     
+    started = time.monotonic()
     try:
-        logger.info(f"User {user_id}: Generating image with scene '{scene_description}'")
-        
-        # Формируем упрощённый промпт: пользовательский промпт + красный шар с царапинами
-        prompt_parts = [
-            scene_description,
-            "large red circle behind the character with white diagonal scratch marks across it"
-        ]
+        # Ошибка после создания предсказания (при опросе) — не повод платить за второе на другом токене:
+        # исключение уходит наверх, а предсказание дожидается журнал заданий
+        output = PROVIDER_POOL.call(call, can_retry=lambda: not prediction.get("id"))
+    except Exception:
+        # Предсказание, которое успели создать, стоит денег даже при ошибке
+        if prediction.get("id"):
+            record_usage(model, prediction, "failed", time.monotonic() - started)
+        raise
+    record_usage(model, prediction, "succeeded", time.monotonic() - started)
+    return output
+
+
+def run_model(model: str, model_input: dict, prediction: dict = None, on_created=None):
+    """Вызов модели с замером холодного/тёплого старта
+    prediction заполняется id и метриками предсказания, on_created(id) вызывается сразу после создания"""
+    with MODEL_LATENCY.track(model):
+        return call_model(model, model_input, prediction, on_created)
+
+
+def download_image(image_url: str) -> BytesIO:
+    """Скачивает изображение (выход модели) в BytesIO"""
+    image_bytes = BytesIO(replay.fetch_bytes(image_url))
+    image_bytes.seek(0)
+    return image_bytes
+
+
+def output_image_url(output) -> str:
+    """URL картинки из выхода модели генерации"""
+    if hasattr(output, 'url'):
+        return output.url()
+    return output[0] if isinstance(output, list) else output
+
+
+def generation_seed():
+    """Seed генерации: GENERATION_SEED или случайный, чтобы в историю попал seed, с которым получен бейдж
+    При записи и воспроизведении случайный seed не передаётся: ключ фикстуры зависит от входа модели"""
+    if GENERATION_SEED is not None:
+        return int(GENERATION_SEED)
+    if replay.current_mode() != "off":
+        return None
+    return random.randrange(2 ** 31)
+
+
+def build_generation_input(scene_description: str, reference_images: list = None, badge_text: str = None) -> dict:
+    """Вход модели генерации: промпт с фрагментами маршрутизации, референсы и seed
+    Общий для бота и bench_models, чтобы бенчмарк мерил ровно тот вход, который отправляет бот"""
+    # Формируем упрощённый промпт: пользовательский промпт + красный шар с царапинами
+    prompt_parts = [
+        scene_description,
+        "large red circle behind the character with white diagonal scratch marks across it"
+    ]
+    prompt_parts.extend(REFERENCE_ROUTER.classify(scene_description).prompt_fragments)
+    
+    # Если включена генерация текста в промпте и текст передан
+    if GENERATE_TEXT_IN_PROMPT and badge_text:
+        prompt_parts.append(f"bold black text '{badge_text.upper()}' at the bottom, no background behind text")
+    else:
+        prompt_parts.append("space for text at the bottom")
+    
+    # Упрощённый негативный промпт
+    nano_banana_input = {
+        "prompt": ", ".join(prompt_parts),
+        "negative_prompt": "multiple people, crowd, text errors, misspelled words, wrong text",
+        "output_format": "jpg",
+    }
+    
+    image_inputs = []
+    for ref_image in reference_images or []:
+        if isinstance(ref_image, BytesIO):
+            ref_image.seek(0)
+        image_inputs.append(ref_image)
+    if image_inputs:
+        nano_banana_input["image_input"] = image_inputs
+        nano_banana_input["aspect_ratio"] = "match_input_image"
+    
+    seed = generation_seed()
+    if seed is not None:
+        nano_banana_input["seed"] = seed
+    return nano_banana_input
+
+
+def generate_image_with_lora(scene_description: str, user_id: int, reference_images: list = None, badge_text: str = None,
+                             model: str = None, prediction: dict = None, on_created=None) -> str:
+    """Генерирует изображение через модель google/nano-banana (или model, если передана)"""
+    from replicate.exceptions import ReplicateError
+    
+    model = model or GENERATION_MODEL
+    
+    try:
+        logger.info(f"User {user_id}: Generating image with scene '{scene_description}' ({model})")
         
-        # Если включена генерация текста в промпте и текст передан
+        nano_banana_input = build_generation_input(scene_description, reference_images, badge_text)
         if GENERATE_TEXT_IN_PROMPT and badge_text:
-            badge_text_upper = badge_text.upper()
-            prompt_parts.append(f"bold black text '{badge_text_upper}' at the bottom, no background behind text")
-            logger.info(f"User {user_id}: Including badge text '{badge_text_upper}' in prompt")
-        else:
-            prompt_parts.append("space for text at the bottom")
-        
-        prompt = ", ".join(prompt_parts)
-        
-        # Упрощённый негативный промпт
-        nano_banana_input = {
-            "prompt": prompt,
-            "negative_prompt": "multiple people, crowd, text errors, misspelled words, wrong text",
-            "output_format": "jpg",
-        }
-        
-        if reference_images:
-            image_inputs = []
-            for ref_image in reference_images:
-                if isinstance(ref_image, BytesIO):
-                    ref_image.seek(0)
-                    image_inputs.append(ref_image)
-                else:
-                    image_inputs.append(ref_image)
-            
-            if image_inputs:
-                nano_banana_input["image_input"] = image_inputs
-                nano_banana_input["aspect_ratio"] = "match_input_image"
-                logger.info(f"User {user_id}: Added {len(image_inputs)} reference image(s)")
-        
-        if GENERATION_SEED is not None:
-            nano_banana_input["seed"] = int(GENERATION_SEED)
+            logger.info(f"User {user_id}: Including badge text '{badge_text.upper()}' in prompt")
+        if "image_input" in nano_banana_input:
+            logger.info(f"User {user_id}: Added {len(nano_banana_input['image_input'])} reference image(s)")
+        if prediction is not None:
+            prediction["seed"] = nano_banana_input.get("seed")
         
-        output = replicate.run(GENERATION_MODEL, input=nano_banana_input)
-        
-        if hasattr(output, 'url'):
-            image_url = output.url()
-        else:
-            image_url = output[0] if isinstance(output, list) else output
+        output = run_model(model, nano_banana_input, prediction, on_created)
+        image_url = output_image_url(output)
         
         logger.info(f"User {user_id}: Image generated successfully")
         return image_url
@@ -434,8 +710,8 @@ def generate_image_with_lora(scene_description: str, user_id: int, reference_ima
         if "404" in error_detail or "not found" in error_detail.lower():
             error_msg = (
                 f"❌ Модель не найдена (404)\n\n"
-                f"Модель '{GENERATION_MODEL}' не существует в Replicate.\n\n"
-                f"Проверьте модель на: https://replicate.com/{GENERATION_MODEL.split(':')[0]}"
+                f"Модель '{model}' не существует в Replicate.\n\n"
+                f"Проверьте модель на: https://replicate.com/{model.split(':')[0]}"
             )
         else:
             error_msg = f"❌ Ошибка Replicate API: {error_detail}"
@@ -446,6 +722,26 @@ def generate_image_with_lora(scene_description: str, user_id: int, reference_ima
         raise
 
 
+def prepare_image_for_background_removal(image_bytes: BytesIO) -> str:
+    """Приводит изображение к RGB на белом фоне и сохраняет во временный PNG"""
+    import tempfile
+    from PIL import Image
+    
+    image_bytes.seek(0)
+    img = Image.open(image_bytes)
+    
+    if img.mode == 'RGBA':
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[3])
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    
+    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as temp_file:
+        img.save(temp_file, format='PNG', quality=95)
+        return temp_file.name
+
+
 def remove_background(image_bytes: BytesIO, user_id: int) -> BytesIO:
     """Удаляет фон с изображения через Replicate API"""
     if not BACKGROUND_REMOVAL_ENABLED:
@@ -455,63 +751,37 @@ def remove_background(image_bytes: BytesIO, user_id: int) -> BytesIO:
     try:
         logger.info(f"User {user_id}: Removing background")
         
-        if not os.getenv("REPLICATE_API_TOKEN"):
-            os.environ["REPLICATE_API_TOKEN"] = REPLICATE_API_TOKEN
-        
-        image_bytes.seek(0)
-        img = Image.open(image_bytes)
-        
-        if img.mode == 'RGBA':
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            background.paste(img, mask=img.split()[3])
-            img = background
-        elif img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as temp_file:
-            img.save(temp_file, format='PNG', quality=95)
-            temp_file_path = temp_file.name
+        temp_file_path = prepare_image_for_background_removal(image_bytes)
         
         try:
+            prediction = {"user_id": user_id, "feature": "background"}
             with open(temp_file_path, 'rb') as img_file:
-                output = replicate.run(
+                output = run_model(
                     BACKGROUND_REMOVAL_MODEL,
-                    input={
+                    {
                         "image": img_file,
                         "format": "png",
                         "reverse": False,
                         "threshold": 0,
                         "background_type": "rgba"
-                    }
+                    },
+                    prediction
                 )
             
             if hasattr(output, 'read'):
                 result_bytes = BytesIO(output.read())
                 result_bytes.seek(0)
-                return result_bytes
             elif hasattr(output, 'url'):
-                image_url = output.url()
-                response = requests.get(image_url)
-                response.raise_for_status()
-                result_bytes = BytesIO(response.content)
-                result_bytes.seek(0)
-                return result_bytes
+                result_bytes = download_image(output.url())
             elif isinstance(output, (list, tuple)) and len(output) > 0:
-                image_url = output[0]
-                response = requests.get(image_url)
-                response.raise_for_status()
-                result_bytes = BytesIO(response.content)
-                result_bytes.seek(0)
-                return result_bytes
+                result_bytes = download_image(output[0])
             else:
                 image_url = str(output)
-                if image_url.startswith('http'):
-                    response = requests.get(image_url)
-                    response.raise_for_status()
-                    result_bytes = BytesIO(response.content)
-                    result_bytes.seek(0)
-                    return result_bytes
-                raise ValueError(f"Unexpected output format: {type(output)}")
+                if not image_url.startswith('http'):
+                    raise ValueError(f"Unexpected output format: {type(output)}")
+                result_bytes = download_image(image_url)
+            usage_safely("set_output_size", prediction.get("id"), result_bytes.getbuffer().nbytes)
+            return result_bytes
         finally:
             try:
                 os.unlink(temp_file_path)
@@ -523,14 +793,14 @@ def remove_background(image_bytes: BytesIO, user_id: int) -> BytesIO:
         return image_bytes
 
 
-def add_text_to_badge(image_url: str, badge_text: str, user_id: int) -> BytesIO:
-    """Добавляет текст на баннер бейджа"""
+def add_text_to_badge(image_url, badge_text: str, user_id: int) -> BytesIO:
+    """Добавляет текст на баннер бейджа (image_url — URL выхода модели или уже скачанный BytesIO)"""
+    from PIL import Image, ImageDraw, ImageFont
+    
     try:
         logger.info(f"User {user_id}: Adding text '{badge_text}' to badge")
         
-        response = requests.get(image_url)
-        response.raise_for_status()
-        img = Image.open(BytesIO(response.content))
+        img = Image.open(download_image(image_url) if isinstance(image_url, str) else image_url)
         
         if img.mode != 'RGB':
             img = img.convert('RGB')
@@ -599,10 +869,588 @@ def add_text_to_badge(image_url: str, badge_text: str, user_id: int) -> BytesIO:
         raise
 
 
+def warmup_generation_input() -> dict:
+    """Минимальный запрос к модели генерации: без референсов, короткий промпт"""
+    return {"prompt": "small red circle", "output_format": "jpg"}
+
+
+def warmup_background_removal_input() -> dict:
+    """Минимальный запрос к модели удаления фона: белая картинка 64x64"""
+    from PIL import Image
+    
+    image_bytes = BytesIO()
+    Image.new('RGB', (64, 64), (255, 255, 255)).save(image_bytes, format='PNG')
+    image_bytes.seek(0)
+    image_bytes.name = "warmup.png"
+    return {"image": image_bytes, "format": "png", "reverse": False, "threshold": 0, "background_type": "rgba"}
+
+
+def badge_request_key(scene_description: str, badge_text: str, reference_images: list, level=None) -> str:
+    """Нормализованный ключ запроса: одинаковые сюжет, текст, референсы и настройки"""
+    digest = hashlib.sha256()
+    normalized_scene = ' '.join(scene_description.lower().split())
+    normalized_text = ' '.join(badge_text.upper().split())
+    level = level or LOAD_SHEDDER.current
+    background_removal = BACKGROUND_REMOVAL_ENABLED and not level.skip_background_removal
+    for part in (normalized_scene, normalized_text, level.model or GENERATION_MODEL, str(GENERATION_SEED),
+                 str(GENERATE_TEXT_IN_PROMPT), str(background_removal)):
+        digest.update(part.encode())
+        digest.update(b'\0')
+    for ref_image in reference_images or []:
+        if isinstance(ref_image, BytesIO):
+            digest.update(hashlib.sha256(ref_image.getbuffer()).digest())
+        else:
+            digest.update(str(ref_image).encode())
+    return digest.hexdigest()
+
+
+async def run_coalesced(key: str, func, *args):
+    """func(*args) в пуле генерации; одинаковые ключи в полёте делят один вызов"""
+    loop = asyncio.get_running_loop()
+    return await BADGE_SINGLE_FLIGHT.do(key, lambda: loop.run_in_executor(GENERATION_EXECUTOR, func, *args))
+
+
+# =============================================================================
+# КОНВЕЙЕР БЕЙДЖА
+# =============================================================================
+# Стадии получают общий контекст: scene, badge_text, user_id, message, status_text, caption
+# и результаты предыдущих стадий под их именами
+
+def stage_translate(ctx: dict) -> str:
+    return translate_to_english(ctx["scene"], ctx["user_id"])
+
+
+def stage_references(ctx: dict) -> list:
+    if not USE_PREDEFINED_REFERENCE_IMAGES:
+        return []
+    return load_reference_images_for_prompt(ctx["scene"], ctx["translate"])
+
+
+async def stage_status(ctx: dict):
+    status = await ctx["message"].reply_text(ctx["status_text"])
+    if ctx.get("job_id"):
+        await journal_call("update", ctx["job_id"], status_message_id=status.message_id)
+    return status
+
+
+def generate_tracked(scene_description: str, user_id: int, reference_images: list, badge_text: str, level,
+                     on_created=None) -> tuple:
+    """Генерация с учётом в контроллере нагрузки; возвращает (url, данные предсказания)
+    on_created(id, токен) вызывается сразу после создания предсказания"""
+    prediction = {"model": level.model or GENERATION_MODEL, "seed": GENERATION_SEED,
+                  "user_id": user_id, "feature": "generate"}
+    if on_created is not None:
+        created = on_created
+        on_created = lambda prediction_id: created(prediction_id, prediction.get("provider"))
+    with LOAD_SHEDDER.track():
+        image_url = generate_image_with_lora(
+            scene_description,
+            user_id,
+            reference_images,
+            badge_text=badge_text if GENERATE_TEXT_IN_PROMPT else None,
+            model=level.model,
+            prediction=prediction,
+            on_created=on_created
+        )
+    return image_url, prediction
+
+
+def resume_generation(prediction_id: str, model: str, user_id: int, provider: str = None) -> tuple:
+    """Дожидается предсказания, созданного до перезапуска; возвращает (url, данные предсказания)"""
+    logger.info(f"User {user_id}: Resuming prediction {prediction_id}")
+    # Предсказание видно только аккаунту, который его создал
+    try:
+        client = PROVIDER_POOL.get(provider).client
+    except KeyError:
+        logger.warning(f"User {user_id}: Provider token {provider} is not configured, using the first token")
+        client = PROVIDER_POOL.providers[0].client
+    prediction = {"model": model, "seed": GENERATION_SEED, "provider": provider}
+    started = time.monotonic()
+    image_url = output_image_url(replay.resume_prediction(prediction_id, prediction, client=client))
+    # Процесс, создавший предсказание, упал до его завершения и записать учёт не успел
+    record_usage(model or GENERATION_MODEL, dict(prediction, user_id=user_id, feature="generate"), "succeeded",
+                 time.monotonic() - started)
+    logger.info(f"User {user_id}: Resumed prediction {prediction_id} finished")
+    return image_url, prediction
+
+
+async def stage_generate(ctx: dict) -> str:
+    level = ctx["level"] = LOAD_SHEDDER.level()
+    if ctx.get("prediction_id"):
+        # Задание из журнала: предсказание уже оплачено до перезапуска
+        image_url, ctx["prediction"] = await run_coalesced(
+            f"resume:{ctx['prediction_id']}", resume_generation,
+            ctx["prediction_id"], ctx.get("model"), ctx["user_id"], ctx.get("provider")
+        )
+        return image_url
+    
+    scene_description, reference_images = ctx["translate"], ctx["references"]
+    if not ctx.get("fresh"):
+        prefetched = await asyncio.to_thread(
+            prefetch_safely, "take", prefetch_key(scene_description, ctx["badge_text"], reference_images)
+        )
+        if prefetched:
+            logger.info(f"User {ctx['user_id']}: Serving prefetched badge #{prefetched['id']}")
+            ctx["prefetched"] = prefetched["image"]
+            ctx["prediction"] = {"model": prefetched["model"], "seed": prefetched["seed"],
+                                 "id": prefetched["prediction_id"]}
+            return f"prefetch:{prefetched['id']}"
+    
+    key = badge_request_key(scene_description, ctx["badge_text"], reference_images, level)
+    if ctx.get("fresh"):
+        # /regen просит именно новую картинку: недавний результат с тем же ключом не подходит
+        key = f"{key}:fresh:{id(ctx)}"
+    
+    on_created = None
+    if ctx.get("job_id"):
+        model = level.model or GENERATION_MODEL
+        await journal_call("mark_generating", ctx["job_id"], key, scene_description, model)
+        on_created = lambda prediction_id, provider: journal_safely("attach_prediction", key, prediction_id, provider)
+    
+    def generate():
+        try:
+            return generate_tracked(scene_description, ctx["user_id"], reference_images, ctx["badge_text"],
+                                    level, on_created)
+        finally:
+            # Следующий запрос с тем же ключом — новое предсказание: id этого (возможно, упавшего) ему не подходит
+            journal_safely("forget_prediction", key)
+    
+    image_url, ctx["prediction"] = await run_coalesced(f"generate:{key}", generate)
+    return image_url
+
+
+def render_badge(image_url: str, badge_text: str, user_id: int) -> tuple:
+    """Загрузка готового бейджа или наложение текста на баннер; возвращает (байты, размер выхода модели)"""
+    output = download_image(image_url)
+    output_size = output.getbuffer().nbytes
+    # Если текст генерируется в промпте, пропускаем этап добавления текста
+    if GENERATE_TEXT_IN_PROMPT:
+        return output.getvalue(), output_size
+    return add_text_to_badge(output, badge_text, user_id).getvalue(), output_size
+
+
+async def stage_render(ctx: dict) -> bytes:
+    if ctx.get("prefetched"):
+        return ctx["prefetched"]
+    image, output_size = await run_coalesced(
+        f"render:{ctx['generate']}:{ctx['badge_text']}", render_badge, ctx["generate"], ctx["badge_text"], ctx["user_id"]
+    )
+    await asyncio.to_thread(usage_safely, "set_output_size", (ctx.get("prediction") or {}).get("id"), output_size)
+    return image
+
+
+async def stage_background(ctx: dict) -> bytes:
+    image = ctx["render"]
+    level = ctx.get("level") or LOAD_SHEDDER.current
+    if not BACKGROUND_REMOVAL_ENABLED or ctx.get("prefetched"):
+        # Готовый бейдж из хранилища фон уже прошёл при предгенерации
+        return image
+    if level.skip_background_removal:
+        logger.info(f"User {ctx['user_id']}: Skipping background removal (load shedding: {level.name})")
+        return image
+    return await run_coalesced(
+        f"background:{hashlib.sha256(image).hexdigest()}",
+        lambda: remove_background(BytesIO(image), ctx["user_id"]).getvalue()
+    )
+
+
+async def stage_reply(ctx: dict):
+    await ctx["status"].delete()
+    return await ctx["message"].reply_photo(photo=BytesIO(ctx["background"]), caption=ctx["caption"])
+
+
+def stage_history(ctx: dict):
+    """Запоминает генерацию вместе с file_id отправленного фото"""
+    history = get_history()
+    if history is None:
+        return None
+    try:
+        sent = ctx["reply"]
+        prediction = ctx.get("prediction") or {}
+        return history.add(
+            user_id=ctx["user_id"],
+            chat_id=ctx["message"].chat_id,
+            scene=ctx["scene"],
+            scene_en=ctx["translate"],
+            badge_text=ctx["badge_text"],
+            seed=prediction.get("seed"),
+            model=prediction.get("model"),
+            prediction_id=prediction.get("id"),
+            file_id=sent.photo[-1].file_id if sent and sent.photo else None,
+        )
+    except Exception as e:
+        # Бейдж уже отправлен — сбой истории не должен выглядеть для пользователя как ошибка
+        logger.warning(f"User {ctx['user_id']}: Failed to save history: {e}")
+        return None
+
+
+_history = None
+
+
+def get_history():
+    """База истории (открывается при первом обращении); None, если история выключена"""
+    global _history
+    if HISTORY_ENABLED and _history is None:
+        _history = GenerationHistory(HISTORY_DB_PATH)
+    return _history
+
+
+_journal = None
+
+
+def get_journal():
+    """Журнал заданий (открывается при первом обращении); None, если журнал выключен"""
+    global _journal
+    if JOB_JOURNAL_ENABLED and _journal is None:
+        _journal = JobJournal(JOB_JOURNAL_PATH)
+    return _journal
+
+
+def journal_safely(method: str, *args, **kwargs):
+    """Вызов метода журнала; сбой журнала не должен ломать генерацию"""
+    journal = get_journal()
+    if journal is None:
+        return None
+    try:
+        return getattr(journal, method)(*args, **kwargs)
+    except Exception as e:
+        logger.warning(f"Job journal {method} failed: {e}")
+        return None
+
+
+async def journal_call(method: str, *args, **kwargs):
+    return await asyncio.to_thread(journal_safely, method, *args, **kwargs)
+
+
+_usage = None
+
+
+def get_usage():
+    """Учёт предсказаний (открывается при первом обращении); None, если учёт выключен"""
+    global _usage
+    if USAGE_TRACKING_ENABLED and _usage is None:
+        _usage = UsageStore(USAGE_DB_PATH, pricing=MODEL_PRICING)
+    return _usage
+
+
+def usage_safely(method: str, *args, **kwargs):
+    """Вызов метода учёта; сбой учёта не должен ломать генерацию"""
+    usage = get_usage()
+    if usage is None:
+        return None
+    try:
+        return getattr(usage, method)(*args, **kwargs)
+    except Exception as e:
+        logger.warning(f"Usage tracking {method} failed: {e}")
+        return None
+
+
+def record_usage(model: str, prediction: dict, status: str, wall_time: float):
+    usage_safely(
+        "record", model, prediction,
+        feature=prediction.get("feature", "other"),
+        user_id=prediction.get("user_id"),
+        status=status,
+        wall_time=wall_time,
+    )
+
+
+def prepare_request(scene: str, user_id: int) -> tuple:
+    """Перевод и референсы вне конвейера (предгенерация, пакетная генерация); возвращает (scene_en, референсы)"""
+    scene_en = translate_to_english(scene, user_id)
+    reference_images = load_reference_images_for_prompt(scene, scene_en) if USE_PREDEFINED_REFERENCE_IMAGES else []
+    return scene_en, reference_images
+
+
+def make_badge(scene_en: str, reference_images: list, badge_text: str, user_id: int, feature: str) -> tuple:
+    """Бейдж вне конвейера: генерация, текст и удаление фона как в боте; возвращает (байты, данные предсказания)"""
+    prediction = {"model": GENERATION_MODEL, "seed": GENERATION_SEED, "user_id": user_id, "feature": feature}
+    image_url = generate_image_with_lora(
+        scene_en,
+        user_id,
+        reference_images,
+        badge_text=badge_text if GENERATE_TEXT_IN_PROMPT else None,
+        prediction=prediction
+    )
+    image, output_size = render_badge(image_url, badge_text, user_id)
+    usage_safely("set_output_size", prediction.get("id"), output_size)
+    if BACKGROUND_REMOVAL_ENABLED:
+        image = remove_background(BytesIO(image), user_id).getvalue()
+    return image, prediction
+
+
+_prefetch = None
+
+
+def get_prefetch_store():
+    """Хранилище предгенерированных бейджей (открывается при первом обращении); None, если выключено"""
+    global _prefetch
+    if PREFETCH_ENABLED and _prefetch is None:
+        _prefetch = PrefetchStore(PREFETCH_DB_PATH, max_age=PREFETCH_MAX_AGE)
+    return _prefetch
+
+
+def prefetch_safely(method: str, *args, **kwargs):
+    """Вызов метода хранилища; без него бейдж просто генерируется обычным путём"""
+    store = get_prefetch_store()
+    if store is None:
+        return None
+    try:
+        return getattr(store, method)(*args, **kwargs)
+    except Exception as e:
+        logger.warning(f"Prefetch store {method} failed: {e}")
+        return None
+
+
+def prefetch_key(scene_description: str, badge_text: str, reference_images: list) -> str:
+    """Ключ без учёта текущей деградации: под нагрузкой готовый бейдж полного качества нужнее всего
+    Референсы — по исходным файлам, а не байтам: под нагрузкой они читаются уменьшенными"""
+    references = [reference_identity(ref_image) for ref_image in reference_images or []]
+    return badge_request_key(scene_description, badge_text, references, LOAD_SHEDDER.levels[0])
+
+
+def example_requests() -> list:
+    """Пары (сюжет, текст) из MESSAGES["examples"]: сюжеты по порядку, тексты по кругу"""
+    scenes_part, _, texts_part = MESSAGES["examples"].partition("**Для текста баннера:**")
+    scenes = re.findall(r'✅ "([^"]+)"', scenes_part)
+    texts = re.findall(r'✅ "([^"]+)"', texts_part)
+    if not texts:
+        return []
+    return [(scene, texts[index % len(texts)]) for index, scene in enumerate(scenes)]
+
+
+def prefetch_candidates() -> list:
+    """Частые недавние запросы всех пользователей, затем примеры из /examples, без повторов"""
+    candidates = []
+    history = get_history()
+    if history is not None:
+        since = time.time() - PREFETCH_POPULAR_DAYS * 24 * 3600
+        popular = history.popular(since, PREFETCH_POPULAR_TOP, PREFETCH_MIN_USES)
+        candidates.extend((row["scene"], row["badge_text"]) for row in popular)
+    candidates.extend(example_requests())
+    seen, unique = set(), []
+    for scene, badge_text in candidates:
+        marker = (' '.join(scene.lower().split()), ' '.join(badge_text.upper().split()))
+        if marker not in seen:
+            seen.add(marker)
+            unique.append((scene, badge_text))
+    return unique
+
+
+def prefetch_request(scene: str, badge_text: str) -> tuple:
+    """Перевод, референсы и ключ запроса — так же, как их получит конвейер бота"""
+    scene_en, reference_images = prepare_request(scene, PREFETCH_USER_ID)
+    return scene_en, reference_images, prefetch_key(scene_en, badge_text, reference_images)
+
+
+def prefetch_badge(scene: str, badge_text: str) -> dict:
+    """Готовый бейдж для хранилища"""
+    scene_en, reference_images, key = prefetch_request(scene, badge_text)
+    image, prediction = make_badge(scene_en, reference_images, badge_text, PREFETCH_USER_ID, "prefetch")
+    predict_time = (prediction.get("metrics") or {}).get("predict_time")
+    return {
+        "key": key,
+        "image": image,
+        "scene_en": scene_en,
+        "model": prediction["model"],
+        "seed": prediction.get("seed"),
+        "prediction_id": prediction.get("id"),
+        "cost_usd": estimate_cost(MODEL_PRICING, prediction["model"], predict_time),
+    }
+
+
+# Перевод и статусное сообщение идут параллельно; референсы ждут перевод (теги индекса английские),
+# генерация — перевод и референсы, ответ — готовую картинку и статус
+BADGE_PIPELINE = Pipeline("badge", [
+    Stage("translate", stage_translate, run_in_thread=True),
+    Stage("references", stage_references, after=("translate",), run_in_thread=True),
+    Stage("status", stage_status),
+    Stage("generate", stage_generate, after=("translate", "references")),
+    Stage("render", stage_render, after=("generate",)),
+    Stage("background", stage_background, after=("render",)),
+    Stage("reply", stage_reply, after=("background", "status")),
+    Stage("history", stage_history, after=("reply",), run_in_thread=True),
+], executor=GENERATION_EXECUTOR)
+
+
+def badge_error_message(error: Exception, quick: bool) -> str:
+    """Текст ошибки для пользователя"""
+    if isinstance(error, ValueError):
+        return str(error)
+    if isinstance(error, ProviderUnavailableError):
+        return MESSAGES["errors"]["rate_limit"]
+    
+    error_detail = str(error)
+    if "404" in error_detail or "not found" in error_detail.lower():
+        return MESSAGES["errors"]["model_not_found"]
+    elif "401" in error_detail or "unauthorized" in error_detail.lower():
+        return MESSAGES["errors"]["auth_error"]
+    elif "429" in error_detail or "rate limit" in error_detail.lower():
+        return MESSAGES["errors"]["rate_limit"]
+    elif quick:
+        return MESSAGES["errors"]["generic_quick"].format(detail=error_detail)
+    return MESSAGES["errors"]["generic"]
+
+
+async def prepare_scene(update: Update, scene_description: str) -> dict:
+    """Перевод сюжета и подбор референсов — шаг сюжета в диалоге"""
+    return await BADGE_PIPELINE.run(
+        {"scene": scene_description, "user_id": update.effective_user.id},
+        targets=["translate", "references"]
+    )
+
+
+async def run_badge_pipeline(update: Update, ctx: dict, quick: bool = False):
+    """Полный конвейер бейджа от входных данных до ответа; задание пишется в журнал"""
+    ctx.update(
+        user_id=update.effective_user.id,
+        message=update.message,
+        status_text=MESSAGES["generating_quick" if quick else "generating"],
+    )
+    ctx["job_id"] = await journal_call(
+        "start",
+        user_id=ctx["user_id"],
+        chat_id=update.effective_chat.id,
+        chat_type=update.effective_chat.type,
+        message_id=update.message.message_id,
+        scene=ctx["scene"],
+        badge_text=ctx["badge_text"],
+        caption=ctx["caption"],
+        quick=quick,
+    )
+    await execute_badge_job(ctx, quick)
+
+
+async def execute_badge_job(ctx: dict, quick: bool):
+    """Выполняет конвейер и отмечает итог в журнале; ошибки сообщаются пользователю"""
+    user_id = ctx["user_id"]
+    try:
+        await BADGE_PIPELINE.run(ctx)
+        logger.info(f"User {user_id}: Badge created successfully")
+        if ctx.get("job_id"):
+            await journal_call("finish", ctx["job_id"], "delivered")
+    except Exception as e:
+        stage = getattr(e, "failed_stage", "?")
+        if isinstance(e, ValueError):
+            logger.error(f"User {user_id}: Configuration error at stage {stage}: {e}")
+        else:
+            logger.error(f"User {user_id}: Failed to create badge at stage {stage}: {e}")
+        
+        if ctx.get("job_id"):
+            await journal_call("finish", ctx["job_id"], "failed", error=f"{stage}: {e}")
+        
+        user_message = badge_error_message(e, quick)
+        try:
+            if ctx.get("status") is not None and "reply" not in ctx["timings"]:
+                await ctx["status"].edit_text(user_message)
+            else:
+                await ctx["message"].reply_text(user_message)
+        except Exception as reply_error:
+            logger.error(f"User {user_id}: Failed to report error: {reply_error}")
+
+
+def job_message(bot, chat_id: int, chat_type: str, message_id: int) -> Message:
+    """Сообщение из журнала как объект Message, привязанный к боту (для reply_*/edit/delete)"""
+    message = Message(
+        message_id=message_id,
+        date=datetime.now(),
+        chat=Chat(id=chat_id, type=chat_type or Chat.PRIVATE),
+    )
+    message.set_bot(bot)
+    return message
+
+
+async def resume_job(bot, job: dict):
+    """Доводит задание из журнала до доставки: ждёт созданное предсказание или запускает генерацию заново"""
+    journal = get_journal()
+    message = job_message(bot, job["chat_id"], job["chat_type"], job["message_id"])
+    status = None
+    if job["status_message_id"]:
+        status = job_message(bot, job["chat_id"], job["chat_type"], job["status_message_id"])
+    
+    age = datetime.now().timestamp() - job["created_at"]
+    if age > JOB_RESUME_MAX_AGE or job["attempts"] >= JOB_RESUME_ATTEMPTS:
+        logger.warning(f"User {job['user_id']}: Abandoning job {job['id']} "
+                       f"(age {age:.0f}s, attempts {job['attempts']}, stage {job['stage']})")
+        await asyncio.to_thread(journal.finish, job["id"], "abandoned")
+        try:
+            if status is not None:
+                await status.edit_text(MESSAGES["resume_expired"])
+            else:
+                await bot.send_message(job["chat_id"], MESSAGES["resume_expired"])
+        except Exception as e:
+            logger.warning(f"User {job['user_id']}: Failed to notify about abandoned job: {e}")
+        return
+    
+    await asyncio.to_thread(journal.update, job["id"], attempts=job["attempts"] + 1)
+    logger.info(f"User {job['user_id']}: Resuming job {job['id']} at stage {job['stage']}"
+                f"{' (prediction ' + job['prediction_id'] + ')' if job['prediction_id'] else ''}")
+    
+    ctx = {
+        "job_id": job["id"],
+        "user_id": job["user_id"],
+        "message": message,
+        "scene": job["scene"],
+        "badge_text": job["badge_text"],
+        "caption": job["caption"],
+        "status_text": MESSAGES["resumed"],
+    }
+    if job["scene_en"]:
+        ctx["translate"] = job["scene_en"]
+    if job["prediction_id"]:
+        # Референсы уже ушли в предсказание — подбирать их заново не нужно
+        ctx.update(prediction_id=job["prediction_id"], model=job["model"], provider=job["provider"], references=[])
+    if status is not None:
+        ctx["status"] = status
+        try:
+            await status.edit_text(MESSAGES["resumed"])
+        except Exception as e:
+            logger.warning(f"User {job['user_id']}: Failed to update status message: {e}")
+    await execute_badge_job(ctx, quick=bool(job["quick"]))
+
+
+async def load_unfinished_jobs() -> list:
+    """Незавершённые задания прошлого запуска; читать до старта polling, чтобы не захватить новые"""
+    journal = get_journal()
+    if journal is None:
+        return []
+    pruned = await asyncio.to_thread(journal.prune, JOB_JOURNAL_RETENTION)
+    jobs = await asyncio.to_thread(journal.unfinished)
+    if pruned or jobs:
+        logger.info(f"Job journal: {len(jobs)} unfinished job(s) to resume, {pruned} old job(s) pruned")
+    return jobs
+
+
+async def resume_unfinished_jobs(application: Application, jobs: list):
+    """Фоновая задача при старте: незавершённые задания доводятся до конца параллельно"""
+    results = await asyncio.gather(*(resume_job(application.bot, job) for job in jobs), return_exceptions=True)
+    for job, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            logger.error(f"User {job['user_id']}: Failed to resume job {job['id']}: {result}")
+
+
+async def refuse_if_overloaded(update: Update) -> bool:
+    """Под максимальной нагрузкой отвечает оценкой ожидания; True = запрос отклонён"""
+    if not LOAD_SHEDDER.level().refuse:
+        return False
+    LOAD_SHEDDER.refused()
+    eta_minutes = max(1, math.ceil(LOAD_SHEDDER.eta_seconds() / 60))
+    logger.info(f"User {update.effective_user.id}: Request refused by load shedding (ETA {eta_minutes} min)")
+    await update.message.reply_text(MESSAGES["overloaded"].format(eta=eta_minutes))
+    return True
+
+
 # =============================================================================
 # ОБРАБОТЧИКИ КОМАНД
 # =============================================================================
 
+async def drop_duplicate_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Повторно доставленные апдейты (тот же update_id) не обрабатываются"""
+    if RECENT_UPDATE_IDS.seen(update.update_id):
+        logger.info(f"Dropping duplicate update {update.update_id}")
+        raise ApplicationHandlerStop
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user = update.effective_user
@@ -620,6 +1468,185 @@ async def examples_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(MESSAGES["examples"])
 
 
+def history_position(context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Номер из аргумента команды (/again 3); по умолчанию 1 — последний бейдж"""
+    try:
+        return int(context.args[0]) if context.args else 1
+    except ValueError:
+        return 0
+
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /history"""
+    history = get_history()
+    items = await asyncio.to_thread(history.recent, update.effective_user.id, HISTORY_LIMIT) if history else []
+    if not items:
+        await update.message.reply_text(MESSAGES["history_empty"])
+        return
+    
+    lines = [MESSAGES["history_header"]]
+    for position, item in enumerate(items, start=1):
+        lines.append(MESSAGES["history_item"].format(
+            position=position,
+            scene=item["scene"],
+            text=item["badge_text"],
+            date=datetime.fromtimestamp(item["created_at"]).strftime("%d.%m %H:%M")
+        ))
+    lines.append(MESSAGES["history_footer"])
+    await update.message.reply_text("\n".join(lines))
+
+
+async def again_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /again [N]: повторная отправка по file_id, без загрузки картинки"""
+    history = get_history()
+    position = history_position(context)
+    item = await asyncio.to_thread(history.nth, update.effective_user.id, position) if history else None
+    if item is None:
+        await update.message.reply_text(MESSAGES["again_not_found"])
+        return
+    if not item["file_id"]:
+        await update.message.reply_text(MESSAGES["again_no_file"].format(position=position))
+        return
+    
+    try:
+        await update.message.reply_photo(
+            photo=item["file_id"],
+            caption=MESSAGES["badge_ready_quick"].format(scene=item["scene"], text=item["badge_text"])
+        )
+    except BadRequest as e:
+        logger.warning(f"User {update.effective_user.id}: Stored file_id rejected: {e}")
+        await asyncio.to_thread(history.forget_file_id, item["id"])
+        await update.message.reply_text(MESSAGES["again_no_file"].format(position=position))
+
+
+async def regen_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /regen [N]: новая генерация из сохранённых данных, без повторного перевода"""
+    history = get_history()
+    item = await asyncio.to_thread(history.nth, update.effective_user.id, history_position(context)) if history else None
+    if item is None:
+        await update.message.reply_text(MESSAGES["again_not_found"])
+        return
+    
+    if await refuse_if_overloaded(update):
+        return
+    
+    await run_badge_pipeline(update, {
+        "scene": item["scene"],
+        "translate": item["scene_en"],
+        "badge_text": item["badge_text"],
+        "fresh": True,
+        "caption": MESSAGES["badge_ready_quick"].format(scene=item["scene"], text=item["badge_text"]),
+    }, quick=True)
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    """Делит длинный отчёт на сообщения не длиннее limit, по строкам"""
+    parts, current = [], ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            # Одна строка длиннее лимита режется по символам
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        parts.append(current)
+    return parts
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /stats [дней] [csv|json]: затраты и задержки предсказаний (только для админов)"""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text(MESSAGES["admin_only"])
+        return
+    
+    days, export = 7, None
+    for arg in context.args or []:
+        if arg.isdigit() and int(arg) > 0:
+            days = int(arg)
+        elif arg.lower() in ("csv", "json"):
+            export = arg.lower()
+        else:
+            await update.message.reply_text(MESSAGES["stats_usage"])
+            return
+    
+    usage = get_usage()
+    rows = await asyncio.to_thread(usage.rows, days) if usage else []
+    if not rows:
+        await update.message.reply_text(MESSAGES["stats_empty"].format(days=days))
+        return
+    
+    report = build_usage_report(rows, days)
+    for part in split_message(format_report(report)):
+        await update.message.reply_text(part)
+    
+    if export == "csv":
+        document = StringIO()
+        write_csv(rows, document)
+        data = document.getvalue().encode()
+    elif export == "json":
+        data = json.dumps(report, ensure_ascii=False, indent=2).encode()
+    else:
+        return
+    await update.message.reply_document(
+        document=BytesIO(data), filename=f"usage_{datetime.now():%Y%m%d}_{days}d.{export}"
+    )
+
+
+async def memory_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /memory [on [глубина]|off|json]: отчёт о памяти процесса (только для админов)"""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text(MESSAGES["admin_only"])
+        return
+    
+    args = [arg.lower() for arg in context.args or []]
+    action = args[0] if args else "report"
+    if action == "on":
+        frames = int(args[1]) if len(args) > 1 and args[1].isdigit() else MEMORY_PROFILER.frames
+        await asyncio.to_thread(MEMORY_PROFILER.start, frames)
+        await update.message.reply_text(MESSAGES["memory_on"].format(frames=frames))
+        return
+    if action == "off":
+        await asyncio.to_thread(MEMORY_PROFILER.stop)
+        await update.message.reply_text(MESSAGES["memory_off"])
+        return
+    if action not in ("report", "json"):
+        await update.message.reply_text(MESSAGES["memory_usage"])
+        return
+    
+    report = await asyncio.to_thread(MEMORY_PROFILER.report)
+    for part in split_message(format_memory_report(report)):
+        await update.message.reply_text(part)
+    if action == "json":
+        await update.message.reply_document(
+            document=BytesIO(json.dumps(report, ensure_ascii=False, indent=2, default=str).encode()),
+            filename=f"memory_{datetime.now():%Y%m%d_%H%M%S}.json"
+        )
+
+
+async def prefetch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /prefetch: готовые бейджи и дневные затраты предгенерации (только для админов)"""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text(MESSAGES["admin_only"])
+        return
+    
+    summary = await asyncio.to_thread(prefetch_safely, "summary")
+    if summary is None:
+        await update.message.reply_text(MESSAGES["prefetch_disabled"])
+        return
+    lines = [MESSAGES["prefetch_header"].format(**summary["today"])]
+    lines.extend(MESSAGES["prefetch_item"].format(**row) for row in summary["ready"][:PREFETCH_POPULAR_TOP * 2])
+    if not summary["ready"]:
+        lines.append(MESSAGES["prefetch_empty"])
+    await update.message.reply_text("\n".join(lines))
+
+
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /cancel"""
     await update.message.reply_text(MESSAGES["cancel"])
@@ -635,19 +1662,17 @@ async def create_badge(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_scene_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка описания сюжета"""
-    user_id = update.effective_user.id
     scene_description = update.message.text.strip()
-    scene_description_en = translate_to_english(scene_description, user_id)
+    scene = await prepare_scene(update, scene_description)
+    scene_description_en, reference_images = scene["translate"], scene["references"]
     
     context.user_data['scene'] = scene_description_en
     context.user_data['scene_original'] = scene_description
+    context.user_data['reference_images'] = reference_images
     
     display_text = scene_description if scene_description == scene_description_en else f"{scene_description} ({scene_description_en})"
     
     if USE_PREDEFINED_REFERENCE_IMAGES:
-        reference_images = load_reference_images_for_prompt(scene_description_en)
-        context.user_data['reference_images'] = reference_images
-        
         if reference_images:
             await update.message.reply_text(
                 MESSAGES["scene_received"].format(
@@ -717,7 +1742,6 @@ async def skip_reference_photos(update: Update, context: ContextTypes.DEFAULT_TY
 
 async def handle_badge_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка текста для баннера и генерация финального бейджа"""
-    user_id = update.effective_user.id
     badge_text = update.message.text.strip()
     
     if len(badge_text) > TEXT_MAX_LENGTH:
@@ -726,59 +1750,21 @@ async def handle_badge_text_input(update: Update, context: ContextTypes.DEFAULT_
         )
         return WAITING_FOR_BADGE_TEXT
     
-    scene_description = context.user_data.get('scene', 'unknown scene')
-    reference_images = context.user_data.get('reference_images', [])
+    if await refuse_if_overloaded(update):
+        # Диалог остаётся на шаге текста: пользователь может отправить его ещё раз позже
+        return WAITING_FOR_BADGE_TEXT
     
-    status_message = await update.message.reply_text(MESSAGES["generating"])
+    scene_description = context.user_data.get('scene', 'unknown scene')
+    original_scene = context.user_data.get('scene_original', scene_description)
     
-    try:
-        # Передаём текст в генерацию, если включен режим генерации текста в промпте
-        image_url = generate_image_with_lora(
-            scene_description, 
-            user_id, 
-            reference_images,
-            badge_text=badge_text if GENERATE_TEXT_IN_PROMPT else None
-        )
-        
-        # Если текст генерируется в промпте, пропускаем этап добавления текста
-        if GENERATE_TEXT_IN_PROMPT:
-            # Загружаем изображение напрямую
-            response = requests.get(image_url)
-            response.raise_for_status()
-            image_with_text = BytesIO(response.content)
-            image_with_text.seek(0)
-        else:
-            image_with_text = add_text_to_badge(image_url, badge_text, user_id)
-        
-        if BACKGROUND_REMOVAL_ENABLED:
-            image_with_text = remove_background(image_with_text, user_id)
-        
-        await status_message.delete()
-        
-        original_scene = context.user_data.get('scene_original', scene_description)
-        caption = MESSAGES["badge_ready"].format(scene=original_scene, text=badge_text)
-        
-        await update.message.reply_photo(photo=image_with_text, caption=caption)
-        logger.info(f"User {user_id}: Badge created successfully")
-        
-    except ValueError as e:
-        error_msg = str(e)
-        logger.error(f"User {user_id}: Configuration error: {error_msg}")
-        await status_message.edit_text(error_msg)
-    except Exception as e:
-        logger.error(f"User {user_id}: Failed to create badge: {e}")
-        error_detail = str(e)
-        
-        if "404" in error_detail or "not found" in error_detail.lower():
-            user_message = MESSAGES["errors"]["model_not_found"]
-        elif "401" in error_detail or "unauthorized" in error_detail.lower():
-            user_message = MESSAGES["errors"]["auth_error"]
-        elif "429" in error_detail or "rate limit" in error_detail.lower():
-            user_message = MESSAGES["errors"]["rate_limit"]
-        else:
-            user_message = MESSAGES["errors"]["generic"]
-        
-        await status_message.edit_text(user_message)
+    # Сюжет уже переведён, референсы выбраны на шаге сюжета — эти стадии конвейер пропустит
+    await run_badge_pipeline(update, {
+        "scene": original_scene,
+        "translate": scene_description,
+        "references": context.user_data.get('reference_images', []),
+        "badge_text": badge_text,
+        "caption": MESSAGES["badge_ready"].format(scene=original_scene, text=badge_text),
+    })
     
     context.user_data.clear()
     return ConversationHandler.END
@@ -786,25 +1772,22 @@ async def handle_badge_text_input(update: Update, context: ContextTypes.DEFAULT_
 
 async def handle_quick_generate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Быстрая генерация в одно сообщение"""
-    user_id = update.effective_user.id
     message_text = update.message.text.strip()
     
     if '|' in message_text:
         parts = message_text.split('|')
         scene_description = parts[0].strip()
         badge_text = parts[1].strip() if len(parts) > 1 else "SAMURAI"
-        scene_description_en = translate_to_english(scene_description, user_id)
     else:
-        scene_description_en = translate_to_english(message_text, user_id)
+        scene = await prepare_scene(update, message_text)
+        scene_description_en, reference_images = scene["translate"], scene["references"]
         context.user_data['scene'] = scene_description_en
         context.user_data['scene_original'] = message_text
+        context.user_data['reference_images'] = reference_images
         
         display_text = message_text if message_text == scene_description_en else f"{message_text} ({scene_description_en})"
         
         if USE_PREDEFINED_REFERENCE_IMAGES:
-            reference_images = load_reference_images_for_prompt(scene_description_en)
-            context.user_data['reference_images'] = reference_images
-            
             if reference_images:
                 await update.message.reply_text(
                     f"✅ Сюжет: *{display_text}*\n\n"
@@ -828,58 +1811,14 @@ async def handle_quick_generate(update: Update, context: ContextTypes.DEFAULT_TY
         
         return WAITING_FOR_BADGE_TEXT
     
-    status_message = await update.message.reply_text(MESSAGES["generating_quick"])
+    if await refuse_if_overloaded(update):
+        return ConversationHandler.END
     
-    reference_images = []
-    if USE_PREDEFINED_REFERENCE_IMAGES:
-        reference_images = load_reference_images_for_prompt(scene_description_en)
-    
-    try:
-        # Передаём текст в генерацию, если включен режим генерации текста в промпте
-        image_url = generate_image_with_lora(
-            scene_description_en, 
-            user_id, 
-            reference_images,
-            badge_text=badge_text if GENERATE_TEXT_IN_PROMPT else None
-        )
-        
-        # Если текст генерируется в промпте, пропускаем этап добавления текста
-        if GENERATE_TEXT_IN_PROMPT:
-            # Загружаем изображение напрямую
-            response = requests.get(image_url)
-            response.raise_for_status()
-            image_with_text = BytesIO(response.content)
-            image_with_text.seek(0)
-        else:
-            image_with_text = add_text_to_badge(image_url, badge_text, user_id)
-        
-        if BACKGROUND_REMOVAL_ENABLED:
-            image_with_text = remove_background(image_with_text, user_id)
-        
-        await status_message.delete()
-        original_scene = context.user_data.get('scene_original', scene_description_en)
-        await update.message.reply_photo(
-            photo=image_with_text,
-            caption=MESSAGES["badge_ready_quick"].format(scene=original_scene, text=badge_text)
-        )
-    except ValueError as e:
-        error_msg = str(e)
-        logger.error(f"User {user_id}: Configuration error: {error_msg}")
-        await status_message.edit_text(error_msg)
-    except Exception as e:
-        logger.error(f"User {user_id}: Failed to create badge: {e}")
-        error_detail = str(e)
-        
-        if "404" in error_detail or "not found" in error_detail.lower():
-            user_message = MESSAGES["errors"]["model_not_found"]
-        elif "401" in error_detail or "unauthorized" in error_detail.lower():
-            user_message = MESSAGES["errors"]["auth_error"]
-        elif "429" in error_detail or "rate limit" in error_detail.lower():
-            user_message = MESSAGES["errors"]["rate_limit"]
-        else:
-            user_message = MESSAGES["errors"]["generic_quick"].format(detail=error_detail)
-        
-        await status_message.edit_text(user_message)
+    await run_badge_pipeline(update, {
+        "scene": scene_description,
+        "badge_text": badge_text,
+        "caption": MESSAGES["badge_ready_quick"].format(scene=scene_description, text=badge_text),
+    }, quick=True)
     
     return ConversationHandler.END
 
@@ -894,20 +1833,115 @@ def main():
         logger.error("❌ TELEGRAM_TOKEN not configured!")
         return
     
-    if REPLICATE_API_TOKEN == "YOUR_REPLICATE_TOKEN":
-        logger.error("❌ REPLICATE_API_TOKEN not configured!")
+    if "YOUR_REPLICATE_TOKEN" in REPLICATE_API_TOKENS:
+        logger.error("❌ REPLICATE_API_TOKEN (or REPLICATE_API_TOKENS) not configured!")
         return
     
-    os.environ["REPLICATE_API_TOKEN"] = REPLICATE_API_TOKEN
+    os.environ["REPLICATE_API_TOKEN"] = REPLICATE_API_TOKENS[0]
+    
+    # HTTP-сервер поднимается первым: liveness доступен, пока идёт старт
+    if METRICS_PORT:
+        READINESS.register_routes()
+        add_route("/model-latency", lambda: (200, "application/json", json.dumps(MODEL_LATENCY.summary(), indent=2)))
+        add_route("/providers", lambda: (200, "application/json", json.dumps(PROVIDER_POOL.summary(), indent=2)))
+        start_metrics_server(int(METRICS_PORT))
     
     logger.info("🚀 Bot started successfully!")
     logger.info(f"📊 Using model: {GENERATION_MODEL}")
+    logger.info(f"🔑 Provider tokens: {len(PROVIDER_POOL.providers)} × {PROVIDER_TOKEN_CONCURRENCY} concurrent calls")
     
+    # Кеши прогреваются в фоне (start_background_tasks), polling стартует сразу
+    application = build_application(TELEGRAM_TOKEN)
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+
+def preload_heavy_modules() -> str:
+    """Импортирует тяжёлые модули в фоне, чтобы первый запрос не платил за импорт"""
+    import numpy  # noqa: F401
+    import replicate  # noqa: F401
+    import deep_translator  # noqa: F401
+    from PIL import Image  # noqa: F401
+    return "replicate, deep_translator, numpy, PIL"
+
+
+def check_reference_cache() -> str:
+    """Подготавливает уменьшенные копии всех референсов"""
+    prepared = warm_reference_cache(REFERENCE_IMAGES_DIR, max_side=REFERENCE_MAX_SIDE)
+    return f"{prepared} image(s)"
+
+
+def check_reference_index() -> str:
+    """Загружает и доиндексирует индекс референсов для выбора top-k"""
+    from reference_index import get_reference_index
+    return f"{len(get_reference_index(REFERENCE_IMAGES_DIR).names)} image(s)"
+
+
+def check_font() -> str:
+    """Шрифт для наложения текста (без него используется запасной)"""
+    from PIL import ImageFont
+    ImageFont.truetype(FONT_PATH, FONT_SIZE_BASE)
+    return FONT_PATH
+
+
+def startup_checks() -> list:
+    """Стартовые проверки: (имя, функция, обязательна для готовности)"""
+    checks = [("modules", preload_heavy_modules, True)]
     if USE_PREDEFINED_REFERENCE_IMAGES:
-        ref_images = load_reference_images_from_dir(REFERENCE_IMAGES_DIR)
-        logger.info(f"📸 Predefined reference images: {len(ref_images)} image(s)")
+        if REFERENCE_PREPROCESS_ENABLED:
+            checks.append(("reference_cache", check_reference_cache, True))
+        checks.append(("reference_index", check_reference_index, True))
+    if not GENERATE_TEXT_IN_PROMPT:
+        checks.append(("font", check_font, False))
+    return checks
+
+
+async def start_background_tasks(application: Application):
+    """Фоновые задачи после инициализации бота: стартовые проверки, heartbeat, возобновление заданий, прогрев,
+    предгенерация"""
+    MEMORY_PROFILER.attach(application)
+    tasks = application.bot_data.setdefault("background_tasks", [])
+    tasks.append(asyncio.create_task(READINESS.heartbeat()))
+    tasks.append(asyncio.create_task(READINESS.run_checks(startup_checks())))
+    jobs = await load_unfinished_jobs()
+    if jobs:
+        tasks.append(asyncio.create_task(resume_unfinished_jobs(application, jobs)))
     
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    if MODEL_WARMING_ENABLED:
+        warm_inputs = {GENERATION_MODEL: warmup_generation_input}
+        if BACKGROUND_REMOVAL_ENABLED:
+            warm_inputs[BACKGROUND_REMOVAL_MODEL] = warmup_background_removal_input
+        warmer = ModelWarmer(
+            MODEL_LATENCY, warm_inputs,
+            lambda model, model_input: call_model(model, model_input, {"feature": "warmup"}),
+            interval=MODEL_WARMING_INTERVAL, hours=parse_hours(MODEL_WARMING_HOURS)
+        )
+        tasks.append(asyncio.create_task(warmer.run()))
+    
+    if PREFETCH_ENABLED:
+        prefetcher = Prefetcher(
+            get_prefetch_store(), prefetch_candidates,
+            lambda scene, badge_text: prefetch_request(scene, badge_text)[2],
+            prefetch_badge, LOAD_SHEDDER.idle_seconds,
+            daily_limit=PREFETCH_DAILY_LIMIT, daily_budget_usd=PREFETCH_DAILY_BUDGET_USD, per_key=PREFETCH_PER_KEY,
+            idle_after=PREFETCH_IDLE_SECONDS, hours=parse_hours(PREFETCH_HOURS)
+        )
+        tasks.append(asyncio.create_task(prefetcher.run()))
+
+
+async def stop_background_tasks(application: Application):
+    """Останавливает фоновые задачи и пишет итог по холодным/тёплым стартам"""
+    for task in application.bot_data.pop("background_tasks", []):
+        task.cancel()
+    logger.info(f"Model latency summary: {MODEL_LATENCY.summary()}")
+
+
+def build_application(token: str, base_url: str = None) -> Application:
+    """Собирает Application со всеми обработчиками (base_url — для локального Bot API)"""
+    builder = Application.builder().token(token).concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+    if base_url:
+        builder = builder.base_url(base_url)
+    builder = builder.post_init(start_background_tasks).post_stop(stop_background_tasks)
+    application = builder.build()
     
     conv_handler = ConversationHandler(
         entry_points=[
@@ -930,11 +1964,18 @@ def main():
         fallbacks=[CommandHandler("cancel", cancel_command)],
     )
     
+    application.add_handler(TypeHandler(Update, drop_duplicate_updates), group=-1)
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("examples", examples_command))
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("again", again_command))
+    application.add_handler(CommandHandler("regen", regen_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("memory", memory_command))
+    application.add_handler(CommandHandler("prefetch", prefetch_command))
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    return application
 
 
 if __name__ == '__main__':
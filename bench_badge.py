@@ -0,0 +1,227 @@
+"""
+Микробенчмарки функций обработки изображений badge_bot
+Синтетические бейджи 512/1024/2048 px и тексты разной длины, время и пиковая память.
+Результаты сравниваются с JSON baseline; при регрессии выше порога или без baseline код возврата = 1.
+
+Пример:
+    python bench_badge.py --save-baseline     # записать baseline
+    python bench_badge.py                     # сравнить с baseline
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+from unittest import mock
+from PIL import Image
+
+import badge_bot
+import reference_cache
+import replay
+from fake_services import make_synthetic_badge
+
+# =============================================================================
+# КОНФИГУРАЦИЯ
+# =============================================================================
+
+BENCH_SIZES = [512, 1024, 2048]
+BENCH_TEXTS = {
+    "short": "UX",
+    "medium": "CODE SAMURAI",
+    "long": "THE BEST DEV SENSEI",
+}
+BENCH_BASELINE_FILE = "bench_baseline.json"
+BENCH_REPEAT = 5
+TIME_THRESHOLD = 0.25    # Допустимый рост медианного времени (+25%)
+MEMORY_THRESHOLD = 0.15  # Допустимый рост пиковой памяти (+15%)
+MIN_TIME_DELTA = 0.002   # Разница меньше 2 мс считается шумом
+
+# =============================================================================
+# ЗАГЛУШКА СЕТИ
+# =============================================================================
+
+class _StubResponse:
+    """Ответ requests.get с заранее подготовленным телом"""
+
+    def __init__(self, content: bytes):
+        self.content = content
+        self.status_code = 200
+
+    def raise_for_status(self):
+        pass
+
+
+def stub_image_fetch(images: dict):
+    """Подменяет сетевой GET картинок: URL stub://<key> -> байты из images"""
+    def fake_get(url, *args, **kwargs):
+        return _StubResponse(images[url[len("stub://"):]])
+    return mock.patch.object(replay.requests, "get", side_effect=fake_get)
+
+
+# =============================================================================
+# ИЗМЕРЕНИЯ
+# =============================================================================
+
+def measure(func, repeat: int = BENCH_REPEAT) -> dict:
+    """Медиана времени по repeat запускам и пиковая память отдельного запуска под tracemalloc"""
+    func()  # прогрев: импорты, шрифты, кеши
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+
+    # tracemalloc замедляет код, поэтому память меряется отдельным запуском
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "median_s": round(statistics.median(timings), 6),
+        "min_s": round(min(timings), 6),
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+def build_cases(workdir: str) -> tuple:
+    """Набор бенчмарков (имя -> функция без аргументов) и байты изображений для заглушки сети"""
+    cases = {}
+    images = {}
+
+    for size in BENCH_SIZES:
+        badge_jpg = make_synthetic_badge(size, 'JPEG')
+        images[f"badge_{size}"] = badge_jpg
+        badge_img = Image.open(BytesIO(badge_jpg)).convert('RGBA')
+        badge_img.load()
+
+        cases[f"find_yellow_banner_center/{size}"] = (
+            lambda img=badge_img: badge_bot.find_yellow_banner_center(img, 0)
+        )
+
+        for text_name, text in BENCH_TEXTS.items():
+            cases[f"add_text_to_badge/{size}/{text_name}"] = (
+                lambda s=size, t=text: badge_bot.add_text_to_badge(f"stub://badge_{s}", t, 0)
+            )
+
+        rgba_png = BytesIO()
+        badge_img.save(rgba_png, format='PNG')
+
+        def prepare(data=rgba_png.getvalue()):
+            path = badge_bot.prepare_image_for_background_removal(BytesIO(data))
+            os.unlink(path)
+        cases[f"bg_removal_preprocess/{size}"] = prepare
+
+        # Референсы: исходник в отдельной папке, чтобы бенчмарк не трогал reference_images/
+        ref_dir = os.path.join(workdir, f"refs_{size}")
+        os.makedirs(ref_dir, exist_ok=True)
+        ref_path = os.path.join(ref_dir, "ref.jpg")
+        with open(ref_path, 'wb') as f:
+            f.write(badge_jpg)
+
+        cases[f"preprocess_reference_image/{size}"] = (
+            lambda p=ref_path: reference_cache.preprocess_reference_image(p)
+        )
+        cases[f"load_reference_images_from_dir/{size}"] = (
+            lambda d=ref_dir: badge_bot.load_reference_images_from_dir(d)
+        )
+
+    return cases, images
+
+
+def run_benchmarks(selected: str = None, repeat: int = BENCH_REPEAT) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        cases, images = build_cases(workdir)
+        cache_patch = mock.patch.object(reference_cache, "REFERENCE_CACHE_DIR", os.path.join(workdir, "cache"))
+        with stub_image_fetch(images), cache_patch:
+            for name, func in cases.items():
+                if selected and selected not in name:
+                    continue
+                results[name] = measure(func, repeat)
+                print(f"  {name:<48} {results[name]['median_s'] * 1000:>9.2f} ms"
+                      f" {results[name]['peak_kb']:>11.1f} KB")
+    return results
+
+
+def compare_with_baseline(results: dict, baseline: dict, time_threshold: float,
+                          memory_threshold: float) -> list:
+    """Возвращает список регрессий относительно baseline"""
+    regressions = []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        time_delta = current["median_s"] - base["median_s"]
+        if time_delta > MIN_TIME_DELTA and current["median_s"] > base["median_s"] * (1 + time_threshold):
+            regressions.append(
+                f"{name}: время {base['median_s'] * 1000:.2f} -> {current['median_s'] * 1000:.2f} ms"
+            )
+        if current["peak_kb"] > base["peak_kb"] * (1 + memory_threshold):
+            regressions.append(
+                f"{name}: память {base['peak_kb']:.0f} -> {current['peak_kb']:.0f} KB"
+            )
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Микробенчмарки обработки изображений")
+    parser.add_argument("--baseline", default=BENCH_BASELINE_FILE, help="Файл baseline (JSON)")
+    parser.add_argument("--save-baseline", action="store_true", help="Записать результаты как baseline")
+    parser.add_argument("--filter", help="Запускать только бенчмарки, содержащие подстроку")
+    parser.add_argument("--repeat", type=int, default=BENCH_REPEAT)
+    parser.add_argument("--time-threshold", type=float, default=TIME_THRESHOLD)
+    parser.add_argument("--memory-threshold", type=float, default=MEMORY_THRESHOLD)
+    parser.add_argument("--output", help="Сохранить текущие результаты в JSON")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # Без baseline сравнивать не с чем: в CI это должно быть ошибкой, а не «регрессий нет»
+    if not args.save_baseline and not os.path.exists(args.baseline):
+        print(f"❌ Baseline {args.baseline} не найден, запустите с --save-baseline")
+        return 1
+
+    print("⏱  Бенчмарки обработки изображений")
+    results = run_benchmarks(args.filter, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"\n💾 Baseline сохранён: {args.baseline}")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    regressions = compare_with_baseline(results, baseline, args.time_threshold, args.memory_threshold)
+    if regressions:
+        print("\n❌ Регрессии:")
+        for line in regressions:
+            print(f"   - {line}")
+        return 1
+
+    print("\n✅ Регрессий нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
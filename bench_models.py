@@ -0,0 +1,288 @@
+"""
+Сравнение моделей генерации: задержка, размер результата и стоимость картинки
+Фиксированный набор сюжетов прогоняется по каждой модели (GENERATION_MODEL, обученная LoRA,
+дополнительные через --model) и каждому набору параметров: num_inference_steps, число референсов,
+aspect_ratio. Итог — матрица p50/p95 задержки, среднего размера и стоимости картинки по прайсу.
+
+Без сети:
+    REPLAY_MODE=replay python bench_models.py          # по записанным фикстурам (replay.py)
+    python bench_models.py --fake                      # против локальной заглушки FakeReplicateServer
+
+Пример:
+    python bench_models.py --models nano-banana,lora --steps 20,30 --refs 0,2 --aspects 1:1,3:4 --repeat 2
+"""
+
+import os
+import csv
+import sys
+import json
+import time
+import logging
+import argparse
+import itertools
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+import replay
+from usage_stats import estimate_cost, percentile
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# КОНФИГУРАЦИЯ
+# =============================================================================
+
+BENCH_PROMPTS = [
+    "samurai holding a magnifying glass",
+    "samurai with a katana sword",
+    "samurai typing on a laptop",
+    "samurai drinking tea",
+    "samurai looking through a telescope",
+]
+BENCH_BADGE_TEXT = "CODE SAMURAI"  # Текст баннера, если бот генерирует его в промпте
+BENCH_STEPS = [30]
+BENCH_REFERENCES = [0]
+BENCH_ASPECTS = ["1:1"]
+BENCH_REPEAT = 1
+BENCH_CONCURRENCY = 4       # Больше — растёт очередь у провайдера и задержка перестаёт быть честной
+BENCH_OUTPUT = "bench_models.json"
+
+# Цены моделей, которых нет в MODEL_PRICING бота: LoRA на flux-dev оплачивается по секундам GPU
+# (Nvidia A100 80GB на Replicate — $0.0014/с)
+EXTRA_PRICING = {
+    "lora": {"per_second": 0.0014},
+}
+
+# =============================================================================
+# МОДЕЛИ И ВХОДЫ
+# =============================================================================
+
+def default_models() -> dict:
+    """Модели по имени: kind определяет, как строится вход (nano — как в боте, lora — как в test_lora)"""
+    import badge_bot
+    import test_lora
+    return {
+        "nano-banana": {"model": badge_bot.GENERATION_MODEL, "kind": "nano"},
+        "lora": {"model": test_lora.LORA_MODEL, "kind": "lora"},
+    }
+
+
+def parse_model_spec(spec: str) -> tuple:
+    """'name=owner/model[:version][@kind]' -> (name, {"model", "kind"}); kind по умолчанию lora"""
+    name, _, target = spec.partition('=')
+    if not target:
+        raise ValueError(f"Model spec must be name=owner/model, got {spec}")
+    model, _, kind = target.partition('@')
+    return name, {"model": model, "kind": kind or "lora"}
+
+
+def reference_blobs(count: int) -> list:
+    """Байты референсов: из REFERENCE_IMAGES_DIR бота, недостающие — синтетические бейджи"""
+    if count <= 0:
+        return []
+    import badge_bot
+    from fake_services import make_synthetic_badge
+    blobs = []
+    for image in badge_bot.load_reference_images_from_dir(badge_bot.REFERENCE_IMAGES_DIR)[:count]:
+        image.seek(0)
+        blobs.append(image.read())
+    while len(blobs) < count:
+        blobs.append(make_synthetic_badge(512, 'JPEG', seed=len(blobs)))
+    return blobs
+
+
+def build_input(kind: str, prompt: str, steps: int, aspect: str, references: list) -> dict:
+    """Вход модели для ячейки матрицы (BytesIO референсов создаются заново на каждый вызов)"""
+    if kind == "nano":
+        import badge_bot
+        # Тот же вход, что отправляет бот; aspect_ratio — параметр матрицы
+        badge_text = BENCH_BADGE_TEXT if badge_bot.GENERATE_TEXT_IN_PROMPT else None
+        model_input = badge_bot.build_generation_input(prompt, [BytesIO(blob) for blob in references], badge_text)
+        model_input["aspect_ratio"] = aspect
+        return model_input
+
+    import test_lora
+    model_input = test_lora.lora_input(prompt)
+    model_input.update(num_inference_steps=steps, aspect_ratio=aspect, output_format="jpg")
+    return model_input
+
+
+def build_cells(models: dict, steps: list, references: list, aspects: list) -> list:
+    """
+    Ячейки матрицы: модель × параметры, применимые к её типу
+    nano-banana не знает num_inference_steps, LoRA из test_lora не принимает референсы — лишние
+    комбинации не дублируются.
+    """
+    cells = []
+    for name, spec in models.items():
+        if spec["kind"] == "nano":
+            grid = itertools.product([None], references, aspects)
+        else:
+            grid = itertools.product(steps, [0], aspects)
+        for cell_steps, cell_refs, aspect in grid:
+            cells.append({"name": name, "model": spec["model"], "kind": spec["kind"],
+                          "steps": cell_steps, "references": cell_refs, "aspect_ratio": aspect})
+    return cells
+
+
+def _cell_key(cell: dict) -> str:
+    parts = [cell["name"]]
+    if cell["steps"] is not None:
+        parts.append(f"steps={cell['steps']}")
+    if cell["kind"] == "nano":
+        parts.append(f"refs={cell['references']}")
+    parts.append(cell["aspect_ratio"])
+    return " ".join(parts)
+
+# =============================================================================
+# ПРОГОН
+# =============================================================================
+
+def run_once(cell: dict, prompt: str, references: list, pricing: dict) -> dict:
+    """Одна генерация: задержка до результата, predict_time провайдера, размер картинки, стоимость"""
+    sample = {"cell": _cell_key(cell), "prompt": prompt, "status": "failed"}
+    started = time.perf_counter()
+    try:
+        info = {}
+        output = replay.run_model(cell["model"], build_input(cell["kind"], prompt, cell["steps"] or 0,
+                                                             cell["aspect_ratio"], references), info=info)
+        sample["latency"] = round(time.perf_counter() - started, 3)
+        output = output[0] if isinstance(output, list) else output
+        if hasattr(output, 'read'):
+            sample["output_bytes"] = len(output.read())
+        else:
+            url = output.url() if callable(getattr(output, 'url', None)) else str(output)
+            sample["output_bytes"] = len(replay.fetch_bytes(url))
+        predict_time = (info.get("metrics") or {}).get("predict_time")
+        sample["predict_time"] = predict_time
+        price_key = cell["model"] if cell["model"].split(':')[0] in pricing else cell["name"]
+        sample["cost_usd"] = estimate_cost(pricing, price_key, predict_time)
+        sample["status"] = "succeeded"
+    except Exception as e:
+        sample["error"] = f"{type(e).__name__}: {e}"
+        sample["latency"] = round(time.perf_counter() - started, 3)
+    return sample
+
+
+def summarize(cell: dict, samples: list) -> dict:
+    succeeded = [sample for sample in samples if sample["status"] == "succeeded"]
+    costs = [sample["cost_usd"] for sample in succeeded]
+    return dict(
+        cell,
+        key=_cell_key(cell),
+        runs=len(samples),
+        failed=len(samples) - len(succeeded),
+        latency_p50=percentile([sample["latency"] for sample in succeeded], 50),
+        latency_p95=percentile([sample["latency"] for sample in succeeded], 95),
+        predict_p50=percentile([sample["predict_time"] for sample in succeeded], 50),
+        output_kb=round(sum(sample["output_bytes"] for sample in succeeded) / len(succeeded) / 1024, 1)
+        if succeeded else None,
+        cost_per_image=round(sum(costs) / len(costs), 5) if costs else None,
+    )
+
+
+def run_matrix(cells: list, prompts: list, repeat: int = BENCH_REPEAT, concurrency: int = BENCH_CONCURRENCY,
+               pricing: dict = None) -> dict:
+    pricing = dict(EXTRA_PRICING, **(pricing or {}))
+    references = {count: reference_blobs(count) for count in {cell["references"] for cell in cells}}
+    jobs = [(cell, prompt) for cell in cells for prompt in prompts for _ in range(repeat)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="bench-model") as pool:
+        samples = list(pool.map(lambda job: run_once(job[0], job[1], references[job[0]["references"]], pricing),
+                                jobs))
+    rows = [summarize(cell, [sample for sample in samples if sample["cell"] == _cell_key(cell)]) for cell in cells]
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "replay_mode": replay.current_mode(),
+        "prompts": prompts,
+        "repeat": repeat,
+        "concurrency": concurrency,
+        "wall_seconds": round(time.perf_counter() - started, 2),
+        "matrix": rows,
+        "samples": samples,
+    }
+
+
+def _fmt(value, unit: str = "", digits: int = 2) -> str:
+    return f"{value:.{digits}f}{unit}" if value is not None else "—"
+
+
+def print_matrix(result: dict):
+    print(f"\n{'конфигурация':<40} {'p50':>8} {'p95':>8} {'GPU p50':>8} {'KB':>8} {'$/img':>9} {'ошибок':>7}")
+    for row in result["matrix"]:
+        print(f"{row['key']:<40} {_fmt(row['latency_p50'], 's'):>8} {_fmt(row['latency_p95'], 's'):>8} "
+              f"{_fmt(row['predict_p50'], 's'):>8} {_fmt(row['output_kb'], '', 0):>8} "
+              f"{_fmt(row['cost_per_image'], '', 4):>9} {row['failed']:>4}/{row['runs']}")
+    print(f"\n⏱  {len(result['samples'])} генераций за {result['wall_seconds']}s (режим {result['replay_mode']})")
+
+
+def write_matrix_csv(rows: list, path: str):
+    fields = ["key", "name", "model", "steps", "references", "aspect_ratio", "runs", "failed",
+              "latency_p50", "latency_p95", "predict_p50", "output_kb", "cost_per_image"]
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Матрица задержки и стоимости моделей генерации")
+    parser.add_argument("--models", default="nano-banana,lora", help="Имена моделей через запятую")
+    parser.add_argument("--model", action="append", default=[], metavar="NAME=OWNER/MODEL[:VER][@nano|lora]",
+                        help="Дополнительная модель (можно несколько)")
+    parser.add_argument("--steps", default=",".join(map(str, BENCH_STEPS)), help="num_inference_steps (LoRA)")
+    parser.add_argument("--refs", default=",".join(map(str, BENCH_REFERENCES)), help="Число референсов (nano)")
+    parser.add_argument("--aspects", default=",".join(BENCH_ASPECTS), help="aspect_ratio через запятую")
+    parser.add_argument("--prompts", type=int, default=len(BENCH_PROMPTS), help="Сколько сюжетов из набора")
+    parser.add_argument("--repeat", type=int, default=BENCH_REPEAT)
+    parser.add_argument("--concurrency", type=int, default=BENCH_CONCURRENCY)
+    parser.add_argument("--fake", action="store_true", help="Прогон против локальной заглушки FakeReplicateServer")
+    parser.add_argument("--output", default=BENCH_OUTPUT, help="JSON с матрицей и всеми замерами")
+    parser.add_argument("--csv", help="Сохранить матрицу в CSV")
+    args = parser.parse_args(argv)
+
+    models = default_models()
+    # badge_bot при импорте включает INFO; здесь нужна только таблица
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    for spec in args.model:
+        name, config = parse_model_spec(spec)
+        models[name] = config
+    selected = [name.strip() for name in args.models.split(',') if name.strip()] + \
+        [parse_model_spec(spec)[0] for spec in args.model]
+    unknown = [name for name in selected if name not in models]
+    if unknown:
+        print(f"❌ Неизвестные модели: {', '.join(unknown)} (есть: {', '.join(models)})")
+        return 1
+    models = {name: models[name] for name in dict.fromkeys(selected)}
+
+    cells = build_cells(models, [int(v) for v in args.steps.split(',')], [int(v) for v in args.refs.split(',')],
+                        [v.strip() for v in args.aspects.split(',')])
+    prompts = BENCH_PROMPTS[:max(1, args.prompts)]
+    print(f"🧪 {len(cells)} конфигураций × {len(prompts)} сюжетов × {args.repeat}")
+
+    fake = None
+    if args.fake:
+        from fake_services import FakeReplicateServer
+        fake = FakeReplicateServer(seed=0).start()
+        os.environ["REPLICATE_BASE_URL"] = fake.url
+        os.environ["REPLICATE_API_TOKEN"] = "r8_fake"
+    try:
+        import badge_bot
+        result = run_matrix(cells, prompts, args.repeat, args.concurrency, badge_bot.MODEL_PRICING)
+    finally:
+        if fake is not None:
+            fake.stop()
+
+    print_matrix(result)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"💾 Результаты: {args.output}")
+    if args.csv:
+        write_matrix_csv(result["matrix"], args.csv)
+        print(f"💾 Матрица: {args.csv}")
+    return 0 if all(row["failed"] == 0 for row in result["matrix"]) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,312 @@
+"""
+Пакетная генерация бейджей по списку участников
+Задания (имя, сюжет, текст на баннере) читаются из CSV или JSONL и проходят тот же путь, что и в боте:
+перевод сюжета, подбор референсов, generate_image_with_lora, наложение текста (add_text_to_badge).
+Генерации идут параллельно (не больше --concurrency) и не чаще --rate в минуту; готовые бейджи
+пишутся в папку, каждое завершённое задание отмечается в checkpoint.jsonl, так что прерванный прогон
+продолжается с того же места без повторной генерации.
+
+    python bulk_badges.py roster.csv --output badges/ --concurrency 4 --rate 20
+    python bulk_badges.py roster.jsonl --fake          # против локальной заглушки FakeReplicateServer
+
+Формат CSV (заголовок обязателен):
+    name,scene,text
+    Иван Петров,самурай с ноутбуком,CODE SAMURAI
+"""
+
+import os
+import re
+import csv
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# КОНФИГУРАЦИЯ
+# =============================================================================
+
+BULK_OUTPUT_DIR = "badges"
+BULK_CONCURRENCY = 4          # Одновременных генераций: остальная ёмкость токенов остаётся боту
+BULK_RATE_PER_MINUTE = 30     # Не чаще стольких запусков в минуту (0 = без ограничения)
+BULK_RETRIES = 2              # Повторов задания после временной ошибки (сеть, 429/5xx, все токены в карантине)
+BULK_RETRY_DELAY = 10         # секунд до первого повтора, дальше вдвое больше
+BULK_USER_ID = 0              # user_id в логах и учёте предсказаний (feature="bulk")
+CHECKPOINT_NAME = "checkpoint.jsonl"
+TEXT_COLUMNS = ("text", "badge_text", "banner")  # Допустимые имена колонки с текстом баннера
+
+# =============================================================================
+# ЗАДАНИЯ
+# =============================================================================
+
+def read_jobs(path: str) -> list:
+    """Задания из CSV или JSONL: [{"row", "name", "scene", "text", "key"}]; строки без сюжета пропускаются"""
+    with open(path, encoding='utf-8-sig') as f:
+        if path.lower().endswith(('.jsonl', '.json')):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    jobs = []
+    for number, row in enumerate(rows, start=1):
+        row = {str(key).strip().lower(): (value or "").strip() if isinstance(value, str) else value
+               for key, value in row.items() if key}
+        text = next((row[column] for column in TEXT_COLUMNS if row.get(column)), "")
+        if not row.get("scene"):
+            logger.warning(f"Row {number}: no scene, skipped")
+            continue
+        job = {"row": number, "name": row.get("name") or f"row{number}", "scene": row["scene"], "text": text}
+        job["key"] = job_key(job)
+        jobs.append(job)
+    return jobs
+
+
+def job_key(job: dict) -> str:
+    """Ключ задания по содержимому: изменённая строка списка генерируется заново, переставленная — нет"""
+    payload = "\0".join((job["name"], job["scene"], job["text"]))
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def output_name(job: dict, extension: str) -> str:
+    slug = re.sub(r'[^\w-]+', '_', job["name"], flags=re.UNICODE).strip('_')[:60] or "badge"
+    return f"{slug}-{job['key'][:8]}{extension}"
+
+# =============================================================================
+# ЧЕКПОИНТ
+# =============================================================================
+
+class Checkpoint:
+    """Журнал завершённых заданий (JSONL, запись на задание); последняя запись по ключу главнее"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = {}
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Строка, дописанная в момент прерывания
+                        continue
+                    self.entries[entry["key"]] = entry
+        except OSError:
+            pass
+
+    def done(self, job: dict, output_dir: str) -> bool:
+        entry = self.entries.get(job["key"])
+        return bool(entry and entry["status"] == "done"
+                    and os.path.exists(os.path.join(output_dir, entry["file"])))
+
+    def record(self, entry: dict):
+        with self._lock:
+            self.entries[entry["key"]] = entry
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+# =============================================================================
+# ОГРАНИЧЕНИЕ ЧАСТОТЫ
+# =============================================================================
+
+class RateLimiter:
+    """Равномерные запуски: не чаще rate_per_minute, потоки занимают слоты по очереди"""
+
+    def __init__(self, rate_per_minute: float, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0.0
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = self._clock()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            self._sleep(slot - now)
+
+# =============================================================================
+# ГЕНЕРАЦИЯ
+# =============================================================================
+
+def make_badge(job: dict) -> tuple:
+    """Бейдж для одного задания тем же путём, что и в боте; возвращает (байты, данные предсказания)"""
+    import badge_bot
+
+    scene_en, reference_images = badge_bot.prepare_request(job["scene"], BULK_USER_ID)
+    image, prediction = badge_bot.make_badge(scene_en, reference_images, job["text"], BULK_USER_ID, "bulk")
+    prediction["scene_en"] = scene_en
+    return image, prediction
+
+
+def write_badge(path: str, image: bytes):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(image)
+    os.replace(temp_path, path)
+
+
+def is_transient(error: Exception) -> bool:
+    """Стоит ли повторять задание: все токены в карантине, сбой сети или 429/5xx у Replicate
+    Остальное (модель не найдена, ошибка конфигурации, сбой самой модели) при повторе не исправится"""
+    import httpx
+    import requests
+    from provider_pool import ProviderUnavailableError, error_status
+
+    if isinstance(error, ProviderUnavailableError):
+        return True
+    # generate_image_with_lora заворачивает ReplicateError в ValueError — статус у исходной ошибки
+    cause = error.__cause__ or error
+    status = error_status(cause)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(cause, (ConnectionError, TimeoutError, httpx.TransportError,
+                              requests.ConnectionError, requests.Timeout))
+
+
+def run_job(job: dict, output_dir: str, limiter: RateLimiter, retries: int = BULK_RETRIES) -> dict:
+    """Одно задание с повторами временных ошибок; возвращает запись чекпоинта"""
+    from provider_pool import ProviderUnavailableError
+
+    started = time.monotonic()
+    delay = BULK_RETRY_DELAY
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            image, prediction = make_badge(job)
+            break
+        except Exception as e:
+            if attempt == retries or not is_transient(e):
+                logger.error(f"Bulk row {job['row']} ({job['name']}) failed: {e}")
+                return {"key": job["key"], "row": job["row"], "name": job["name"], "status": "failed",
+                        "error": str(e), "attempts": attempt + 1}
+            # Все токены в карантине — ждём, сколько просит пул, а не свою паузу
+            wait = e.retry_after if isinstance(e, ProviderUnavailableError) else delay
+            logger.warning(f"Bulk row {job['row']} attempt {attempt + 1} failed: {e}; retry in {wait:.0f}s")
+            time.sleep(wait)
+            delay *= 2
+
+    extension = ".png" if image.startswith(b'\x89PNG') else ".jpg"
+    filename = output_name(job, extension)
+    write_badge(os.path.join(output_dir, filename), image)
+    return {
+        "key": job["key"],
+        "row": job["row"],
+        "name": job["name"],
+        "scene": job["scene"],
+        "scene_en": prediction.get("scene_en"),
+        "text": job["text"],
+        "status": "done",
+        "file": filename,
+        "prediction_id": prediction.get("id"),
+        "seconds": round(time.monotonic() - started, 2),
+        "attempts": attempt + 1,
+    }
+
+
+def run_bulk(jobs: list, output_dir: str = BULK_OUTPUT_DIR, concurrency: int = BULK_CONCURRENCY,
+             rate_per_minute: float = BULK_RATE_PER_MINUTE, retries: int = BULK_RETRIES) -> dict:
+    """Генерирует бейджи для невыполненных заданий; итог: done / failed / skipped и время"""
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = Checkpoint(os.path.join(output_dir, CHECKPOINT_NAME))
+    pending = [job for job in jobs if not checkpoint.done(job, output_dir)]
+    summary = {"total": len(jobs), "skipped": len(jobs) - len(pending), "done": 0, "failed": 0, "failures": []}
+    if summary["skipped"]:
+        print(f"⏭  Уже готово: {summary['skipped']} (по {CHECKPOINT_NAME})")
+    if not pending:
+        summary["seconds"] = 0.0
+        return summary
+
+    print(f"🎨 Генерирую {len(pending)} бейджей (параллельно {concurrency}, "
+          f"{f'до {rate_per_minute:g}/мин' if rate_per_minute else 'без ограничения частоты'})")
+    limiter = RateLimiter(rate_per_minute)
+    started = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="bulk")
+    try:
+        futures = [executor.submit(run_job, job, output_dir, limiter, retries) for job in pending]
+        for finished, future in enumerate(as_completed(futures), start=1):
+            entry = future.result()
+            checkpoint.record(entry)
+            summary[entry["status"]] += 1
+            if entry["status"] == "done":
+                print(f"   ✅ [{finished}/{len(pending)}] {entry['name']} → {entry['file']} ({entry['seconds']:.1f} с)")
+            else:
+                summary["failures"].append(entry)
+                print(f"   ❌ [{finished}/{len(pending)}] {entry['name']}: {entry['error']}")
+    finally:
+        # При прерывании не начинаем новые задания; уже идущие генерации не отменить
+        executor.shutdown(wait=False, cancel_futures=True)
+    summary["seconds"] = round(time.monotonic() - started, 1)
+    return summary
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Пакетная генерация бейджей по списку участников")
+    parser.add_argument("jobs", help="CSV (name,scene,text) или JSONL с заданиями")
+    parser.add_argument("--output", default=BULK_OUTPUT_DIR, help="Папка для бейджей и чекпоинта")
+    parser.add_argument("--concurrency", type=int, default=BULK_CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=BULK_RATE_PER_MINUTE, help="Запусков в минуту (0 = без ограничения)")
+    parser.add_argument("--retries", type=int, default=BULK_RETRIES)
+    parser.add_argument("--limit", type=int, help="Только первые N заданий")
+    parser.add_argument("--fake", action="store_true", help="Прогон против локальной заглушки FakeReplicateServer")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.jobs):
+        print(f"❌ Файл {args.jobs} не найден!")
+        return 1
+    try:
+        jobs = read_jobs(args.jobs)
+    except (ValueError, csv.Error) as e:
+        print(f"❌ Не удалось прочитать задания: {e}")
+        return 1
+    if args.limit:
+        jobs = jobs[:args.limit]
+    if not jobs:
+        print("❌ В файле нет заданий (нужны колонки name, scene, text)")
+        return 1
+
+    fake = None
+    if args.fake:
+        from fake_services import FakeReplicateServer
+        fake = FakeReplicateServer(seed=0).start()
+        os.environ["REPLICATE_BASE_URL"] = fake.url
+        os.environ["REPLICATE_API_TOKEN"] = "r8_fake"
+    elif os.getenv("REPLICATE_API_TOKEN", "YOUR_REPLICATE_TOKEN") == "YOUR_REPLICATE_TOKEN" \
+            and os.getenv("REPLAY_MODE", "off") not in ("replay", "replay_fast"):
+        print("❌ Установите REPLICATE_API_TOKEN в окружении!")
+        return 1
+
+    try:
+        import badge_bot  # noqa: F401 — токены и модель читаются при импорте
+        # badge_bot при импорте включает INFO; в консоли нужен только ход пакета
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        summary = run_bulk(jobs, args.output, args.concurrency, args.rate, args.retries)
+    except KeyboardInterrupt:
+        print(f"\n⏸  Прервано; готовые бейджи отмечены в {os.path.join(args.output, CHECKPOINT_NAME)}, "
+              f"повторный запуск продолжит")
+        return 130
+    finally:
+        if fake is not None:
+            fake.stop()
+
+    print(f"\n📊 Готово {summary['done']}, пропущено {summary['skipped']}, ошибок {summary['failed']} "
+          f"из {summary['total']} за {summary['seconds']:.1f} с")
+    print(f"💾 Бейджи: {args.output}")
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
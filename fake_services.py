@@ -0,0 +1,405 @@
+"""
+Локальные заглушки внешних сервисов для офлайн-тестов и нагрузочных прогонов
+- FakeReplicateServer: predictions и trainings API Replicate с настраиваемой задержкой и ошибками
+- FakeTelegramServer: Bot API, который принимает ответы бота и фиксирует их время
+"""
+
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from PIL import Image, ImageDraw
+
+# =============================================================================
+# СИНТЕТИЧЕСКИЕ ИЗОБРАЖЕНИЯ
+# =============================================================================
+
+def make_synthetic_badge(size: int = 1024, fmt: str = 'JPEG', seed: int = 0) -> bytes:
+    """Рисует бейдж, похожий на результат модели: красный круг и жёлтый баннер внизу"""
+    rng = random.Random(seed)
+    img = Image.new('RGB', (size, size), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+
+    margin = size // 8
+    draw.ellipse((margin, margin, size - margin, size - margin), fill=(200, 30, 40))
+    for _ in range(6):
+        x = rng.randint(margin, size - margin)
+        draw.line((x, margin, x + size // 6, size - margin), fill=(255, 255, 255), width=max(2, size // 128))
+
+    # Жёлтый баннер в зоне поиска find_yellow_banner_center (нижние 40%)
+    banner_top = int(size * 0.86)
+    banner_bottom = int(size * 0.97)
+    draw.rectangle((size // 10, banner_top, size - size // 10, banner_bottom), fill=(240, 200, 60))
+
+    output = BytesIO()
+    img.save(output, format=fmt, quality=90)
+    return output.getvalue()
+
+
+def _utc_now() -> str:
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+class _QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _BaseFakeServer:
+    """Общий запуск/остановка HTTP-сервера в фоновом потоке"""
+
+    handler_class = None
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        handler = type('BoundHandler', (self.handler_class,), {'service': self})
+        self.httpd = _QuietServer((host, port), handler)
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status: int, payload=None, body: bytes = None, content_type: str = 'application/json'):
+        if body is None:
+            body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# =============================================================================
+# FAKE REPLICATE
+# =============================================================================
+
+class LatencyModel:
+    """Распределение задержки предсказания: fixed, uniform или lognormal (секунды)"""
+
+    def __init__(self, kind: str = "lognormal", median: float = 2.0, spread: float = 0.4,
+                 seed: int = None):
+        if kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {kind}")
+        self.kind = kind
+        self.median = median
+        self.spread = spread
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self) -> float:
+        with self.lock:
+            if self.kind == "fixed":
+                return self.median
+            if self.kind == "uniform":
+                return self.rng.uniform(self.median * (1 - self.spread), self.median * (1 + self.spread))
+            return self.rng.lognormvariate(0, self.spread) * self.median
+
+
+class _ReplicateHandler(_JSONHandler):
+
+    def do_POST(self):
+        body = json.loads(self._read_body() or b'{}')
+        match = re.fullmatch(r'/v1/models/([^/]+)/([^/]+)/versions/([^/]+)/trainings', self.path)
+        if match:
+            status, payload = self.service.create_training(
+                f"{match.group(1)}/{match.group(2)}", match.group(3), body.get('input', {}), body.get('destination')
+            )
+            return self._send(status, payload)
+
+        match = re.fullmatch(r'/v1/models/([^/]+)/([^/]+)/predictions', self.path)
+        if match:
+            model = f"{match.group(1)}/{match.group(2)}"
+        elif self.path == '/v1/predictions':
+            model = body.get('version', 'unknown')
+        else:
+            return self._send(404, {"detail": "not found", "status": 404})
+
+        token = self.headers.get('Authorization', '').split(' ')[-1]
+        status, payload = self.service.create_prediction(model, body.get('input', {}), token)
+        self._send(status, payload)
+
+    def do_GET(self):
+        match = re.fullmatch(r'/v1/trainings/([^/]+)', self.path)
+        if match:
+            training = self.service.get_training(match.group(1))
+            if training is None:
+                return self._send(404, {"detail": "training not found", "status": 404})
+            return self._send(200, training)
+
+        match = re.fullmatch(r'/v1/predictions/([^/]+)', self.path)
+        if match:
+            prediction = self.service.get_prediction(match.group(1))
+            if prediction is None:
+                return self._send(404, {"detail": "prediction not found", "status": 404})
+            return self._send(200, prediction)
+
+        # Версия модели: replicate.run("owner/name:version") запрашивает её схему выхода
+        match = re.fullmatch(r'/v1/models/([^/]+)/([^/]+)/versions/([^/]+)', self.path)
+        if match:
+            return self._send(200, {"id": match.group(3), "created_at": "2024-01-01T00:00:00Z",
+                                    "cog_version": "0.9.0", "openapi_schema": {}})
+
+        match = re.fullmatch(r'/files/([^/]+)\.(jpg|png)', self.path)
+        if match:
+            return self._send(200, body=self.service.output_image(match.group(2)),
+                              content_type=f"image/{'jpeg' if match.group(2) == 'jpg' else 'png'}")
+
+        self._send(404, {"detail": "not found", "status": 404})
+
+
+class FakeReplicateServer(_BaseFakeServer):
+    """
+    Имитация Replicate predictions и trainings API
+    Направить клиент: REPLICATE_BASE_URL=<server.url>, REPLICATE_API_TOKEN=<любой>
+    """
+
+    handler_class = _ReplicateHandler
+
+    def __init__(self, latency: LatencyModel = None, failure_rate: float = 0.0,
+                 http_error_rate: float = 0.0, image_size: int = 1024,
+                 host: str = "127.0.0.1", port: int = 0, seed: int = None, token_statuses: dict = None,
+                 training_latency: LatencyModel = None):
+        super().__init__(host, port)
+        self.latency = latency or LatencyModel()
+        self.training_latency = training_latency or self.latency
+        self.failure_rate = failure_rate  # prediction завершается со статусом failed
+        self.http_error_rate = http_error_rate  # создание отклоняется с 429
+        self.token_statuses = dict(token_statuses or {})  # токен -> HTTP-статус (отозван 401, нет денег 402...)
+        self.created_by_token = {}
+        self.rng = random.Random(seed)
+        self.predictions = {}
+        self.trainings = {}
+        self.lock = threading.Lock()
+        self.created_count = 0
+        self.images = {
+            'jpg': make_synthetic_badge(image_size, 'JPEG'),
+            'png': make_synthetic_badge(image_size, 'PNG'),
+        }
+
+    def create_prediction(self, model: str, prediction_input: dict, token: str = None) -> tuple:
+        with self.lock:
+            roll_http = self.rng.random()
+            roll_fail = self.rng.random()
+            token_status = self.token_statuses.get(token)
+        if token_status:
+            return token_status, {"title": "Token rejected", "detail": f"token error {token_status}",
+                                  "status": token_status}
+        if roll_http < self.http_error_rate:
+            return 429, {"title": "Too Many Requests", "detail": "rate limit exceeded", "status": 429}
+
+        prediction_id = uuid.uuid4().hex[:20]
+        ext = 'png' if prediction_input.get('format') == 'png' else 'jpg'
+        record = {
+            "id": prediction_id,
+            "model": model,
+            "version": "fake",
+            "status": "starting",
+            "input": {k: v for k, v in prediction_input.items() if isinstance(v, (str, int, float, bool))},
+            "output": None,
+            "logs": "",
+            "error": None,
+            "metrics": {},
+            "created_at": _utc_now(),
+            "started_at": None,
+            "completed_at": None,
+            "urls": {"get": f"{self.url}/v1/predictions/{prediction_id}"},
+            "_created": time.monotonic(),
+            "_duration": self.latency.sample(),
+            "_fail": roll_fail < self.failure_rate,
+            "_ext": ext,
+        }
+        with self.lock:
+            self.predictions[prediction_id] = record
+            self.created_count += 1
+            self.created_by_token[token] = self.created_by_token.get(token, 0) + 1
+        return 201, self._public(record)
+
+    def get_prediction(self, prediction_id: str):
+        with self.lock:
+            record = self.predictions.get(prediction_id)
+            if record is None:
+                return None
+            elapsed = time.monotonic() - record["_created"]
+            if record["status"] in ("starting", "processing"):
+                if elapsed >= record["_duration"]:
+                    record["completed_at"] = _utc_now()
+                    record["metrics"] = {"predict_time": round(record["_duration"], 3)}
+                    if record["_fail"]:
+                        record["status"] = "failed"
+                        record["error"] = "Fake model failure"
+                    else:
+                        record["status"] = "succeeded"
+                        record["output"] = f"{self.url}/files/{prediction_id}.{record['_ext']}"
+                else:
+                    record["status"] = "processing"
+                    record["started_at"] = record["started_at"] or _utc_now()
+            return self._public(record)
+
+    def create_training(self, model: str, version: str, training_input: dict, destination: str = None) -> tuple:
+        if not destination:
+            return 422, {"title": "Invalid request", "detail": "destination is required", "status": 422}
+        with self.lock:
+            roll_fail = self.rng.random()
+        training_id = uuid.uuid4().hex[:20]
+        record = {
+            "id": training_id,
+            "model": model,
+            "version": version,
+            "destination": destination,
+            "status": "starting",
+            "input": {k: v for k, v in training_input.items() if isinstance(v, (str, int, float, bool))},
+            "output": None,
+            "logs": "",
+            "error": None,
+            "created_at": _utc_now(),
+            "started_at": None,
+            "completed_at": None,
+            "urls": {"get": f"{self.url}/v1/trainings/{training_id}"},
+            "_created": time.monotonic(),
+            "_duration": self.training_latency.sample(),
+            "_fail": roll_fail < self.failure_rate,
+        }
+        with self.lock:
+            self.trainings[training_id] = record
+        return 201, self._public(record)
+
+    def get_training(self, training_id: str):
+        with self.lock:
+            record = self.trainings.get(training_id)
+            if record is None:
+                return None
+            if record["status"] in ("starting", "processing"):
+                if time.monotonic() - record["_created"] >= record["_duration"]:
+                    record["completed_at"] = _utc_now()
+                    if record["_fail"]:
+                        record["status"] = "failed"
+                        record["error"] = "Fake training failure"
+                    else:
+                        record["status"] = "succeeded"
+                        record["output"] = {"version": f"{record['destination']}:{uuid.uuid4().hex}",
+                                            "weights": f"{self.url}/files/{training_id}.tar"}
+                else:
+                    record["status"] = "processing"
+                    record["started_at"] = record["started_at"] or _utc_now()
+            return self._public(record)
+
+    def output_image(self, ext: str) -> bytes:
+        return self.images[ext]
+
+    @staticmethod
+    def _public(record: dict) -> dict:
+        return {k: v for k, v in record.items() if not k.startswith('_')}
+
+
+# =============================================================================
+# FAKE TELEGRAM
+# =============================================================================
+
+class _TelegramHandler(_JSONHandler):
+
+    def do_POST(self):
+        match = re.fullmatch(r'/bot[^/]+/(\w+)', self.path)
+        if not match:
+            return self._send(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+        method = match.group(1)
+        body = self._read_body()
+        result = self.service.handle(method, self._parse_params(body))
+        self._send(200, {"ok": True, "result": result})
+
+    def _parse_params(self, body: bytes) -> dict:
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('multipart/form-data'):
+            # Файлы не разбираем: нужны только простые поля (chat_id, caption...)
+            params = {}
+            for name, value in re.findall(rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, re.S):
+                params[name.decode()] = value.decode('utf-8', 'replace')
+            params['_payload_bytes'] = len(body)
+            return params
+        from urllib.parse import parse_qs
+        return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+
+class FakeTelegramServer(_BaseFakeServer):
+    """
+    Имитация Telegram Bot API: отвечает на методы бота и вызывает on_event(chat_id, method, params)
+    Подключение: Application.builder().base_url(f"{server.url}/bot")
+    """
+
+    handler_class = _TelegramHandler
+
+    def __init__(self, on_event=None, host: str = "127.0.0.1", port: int = 0):
+        super().__init__(host, port)
+        self.on_event = on_event
+        self.message_id = 0
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def handle(self, method: str, params: dict):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.message_id += 1
+            message_id = self.message_id
+
+        if method == 'getMe':
+            return {"id": 1, "is_bot": True, "first_name": "FakeBadgeBot", "username": "fake_badge_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": False,
+                    "supports_inline_queries": False}
+        if method in ('deleteWebhook', 'deleteMessage', 'setMyCommands', 'close', 'logOut'):
+            return True
+        if method == 'getUpdates':
+            return []
+
+        chat_id = int(params.get('chat_id', 0) or 0)
+        if self.on_event:
+            self.on_event(chat_id, method, params)
+
+        message = {
+            "message_id": int(params.get('message_id', message_id)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "FakeBadgeBot"},
+            "text": params.get('text', ''),
+        }
+        if method in ('sendPhoto', 'sendDocument'):
+            message.pop("text")
+            message["caption"] = params.get('caption', '')
+            # Повторная отправка по file_id приходит строкой, новая загрузка — файлом в multipart
+            file_id = params.get('photo') if isinstance(params.get('photo'), str) else None
+            file_id = file_id or f"fake-file-{message_id}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": f"u{message_id}",
+                                 "width": 1024, "height": 1024}]
+        return message
@@ -0,0 +1,101 @@
+"""
+История генераций в SQLite
+Хранит входные данные (сюжет, перевод, текст, seed, модель), id предсказания Replicate и file_id
+фото в Telegram: повторная отправка по file_id не загружает картинку заново, а перегенерация
+берёт уже переведённый сюжет.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id       INTEGER NOT NULL,
+    chat_id       INTEGER,
+    created_at    REAL    NOT NULL,
+    scene         TEXT    NOT NULL,
+    scene_en      TEXT    NOT NULL,
+    badge_text    TEXT    NOT NULL,
+    seed          INTEGER,
+    model         TEXT,
+    prediction_id TEXT,
+    file_id       TEXT,
+    extra         TEXT
+);
+CREATE INDEX IF NOT EXISTS generations_user_time ON generations (user_id, created_at DESC);
+"""
+
+
+class GenerationHistory:
+    """Потокобезопасная обёртка над одной SQLite базой"""
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+
+    def add(self, user_id: int, scene: str, scene_en: str, badge_text: str, chat_id: int = None,
+            seed: int = None, model: str = None, prediction_id: str = None, file_id: str = None,
+            extra: dict = None) -> int:
+        """Сохраняет генерацию и возвращает её id"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO generations (user_id, chat_id, created_at, scene, scene_en, badge_text, seed, model, "
+                "prediction_id, file_id, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, chat_id, time.time(), scene, scene_en, badge_text, seed, model, prediction_id, file_id,
+                 json.dumps(extra, ensure_ascii=False) if extra else None)
+            )
+            return cursor.lastrowid
+
+    def recent(self, user_id: int, limit: int = 10) -> list:
+        """Последние генерации пользователя, новые первыми"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM generations WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT ?",
+                (user_id, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def nth(self, user_id: int, position: int = 1):
+        """Генерация пользователя по номеру в /history (1 = последняя) или None"""
+        if position < 1:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM generations WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET ?",
+                (user_id, position - 1)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def popular(self, since: float, limit: int = 10, min_uses: int = 2) -> list:
+        """Самые частые пары (сюжет, текст) всех пользователей с момента since; сюжет — последний исходный"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT scene, scene_en, badge_text, COUNT(*) AS uses, MAX(created_at) AS last_used "
+                "FROM generations WHERE created_at >= ? GROUP BY lower(scene_en), upper(badge_text) "
+                "HAVING uses >= ? ORDER BY uses DESC, last_used DESC LIMIT ?",
+                (since, min_uses, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def forget_file_id(self, generation_id: int):
+        """file_id больше не принимается Telegram (например, сменился бот)"""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE generations SET file_id = NULL WHERE id = ?", (generation_id,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,85 @@
+"""
+Проверки живости и готовности для оркестратора
+- /healthz (liveness): процесс жив и event loop не завис (heartbeat обновляется фоновой задачей)
+- /readyz (readiness): обязательные стартовые проверки (прогрев кешей и т.п.) завершились успешно
+Стартовые проверки выполняются параллельно в потоках и не задерживают запуск polling.
+"""
+
+import json
+import time
+import asyncio
+import logging
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 5    # секунд между отметками event loop
+LIVENESS_TIMEOUT = 30     # без отметки дольше — loop считается зависшим
+
+READY = metrics.gauge("bot_ready", "1 when all required startup checks passed")
+
+
+class Readiness:
+    """Состояние стартовых проверок и heartbeat event loop"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started_at = clock()
+        self.heartbeat_at = None
+        self.checks = {}  # имя -> {"status": pending|ok|failed, "required": bool, "seconds": float, "error": str}
+        READY.set(0)
+
+    @property
+    def ready(self) -> bool:
+        if not self.checks:
+            return False
+        return all(check["status"] == "ok" for check in self.checks.values() if check["required"])
+
+    @property
+    def alive(self) -> bool:
+        if self.heartbeat_at is None:
+            # Loop ещё не запущен (идёт старт) — даём стартовый запас в 4 таймаута
+            return self.clock() - self.started_at < LIVENESS_TIMEOUT * 4
+        return self.clock() - self.heartbeat_at < LIVENESS_TIMEOUT
+
+    async def _run_check(self, name: str, check, required: bool):
+        started = self.clock()
+        try:
+            detail = await asyncio.to_thread(check)
+            self.checks[name].update(status="ok", detail=detail)
+        except Exception as e:
+            self.checks[name].update(status="failed", error=str(e))
+            log = logger.error if required else logger.warning
+            log(f"Startup check {name} failed: {e}")
+        self.checks[name]["seconds"] = round(self.clock() - started, 3)
+
+    async def run_checks(self, checks: list) -> bool:
+        """checks: [(имя, функция без аргументов, обязательная?)]; все выполняются одновременно"""
+        started = self.clock()
+        for name, _, required in checks:
+            self.checks[name] = {"status": "pending", "required": required}
+        await asyncio.gather(*(self._run_check(name, check, required) for name, check, required in checks))
+        READY.set(1 if self.ready else 0)
+        summary = ", ".join(f"{name} {check['status']} {check['seconds']}s" for name, check in self.checks.items())
+        logger.info(f"Startup checks finished in {self.clock() - started:.2f}s: {summary}")
+        return self.ready
+
+    async def heartbeat(self):
+        """Фоновая задача: отметка event loop раз в HEARTBEAT_INTERVAL"""
+        while True:
+            self.heartbeat_at = self.clock()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def liveness_response(self) -> tuple:
+        status = 200 if self.alive else 503
+        return status, "text/plain", "ok\n" if status == 200 else "event loop stalled\n"
+
+    def readiness_response(self) -> tuple:
+        ready = self.ready and self.alive
+        body = {"ready": ready, "uptime_s": round(self.clock() - self.started_at, 1), "checks": self.checks}
+        return (200 if ready else 503), "application/json", json.dumps(body, default=str, indent=2)
+
+    def register_routes(self):
+        metrics.add_route("/healthz", self.liveness_response)
+        metrics.add_route("/readyz", self.readiness_response)
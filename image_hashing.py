@@ -0,0 +1,64 @@
+"""
+Перцептивные хеши изображений на NumPy (pHash, dHash) и расстояние Хэмминга
+Хеш — 64-битное число; близкие по содержанию картинки дают хеши с малым расстоянием.
+"""
+
+import numpy as np
+from PIL import Image
+
+HASH_SIZE = 8          # 8x8 = 64 бита
+PHASH_IMAGE_SIZE = 32  # pHash считается по DCT картинки 32x32
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+_dct_matrices = {}
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """Матрица DCT-II размера n x n (ортонормированная)"""
+    matrix = _dct_matrices.get(n)
+    if matrix is None:
+        k = np.arange(n)[:, None]
+        i = np.arange(n)[None, :]
+        matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+        matrix[0, :] /= np.sqrt(2)
+        _dct_matrices[n] = matrix
+    return matrix
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.astype(np.uint8).ravel()).tobytes(), 'big')
+
+
+def _grayscale(img: Image.Image, size: tuple) -> np.ndarray:
+    return np.asarray(img.convert('L').resize(size, Image.LANCZOS), dtype=np.float64)
+
+
+def phash(img: Image.Image) -> int:
+    """pHash: знаки низкочастотных DCT-коэффициентов относительно медианы"""
+    pixels = _grayscale(img, (PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE))
+    dct = _dct_matrix(PHASH_IMAGE_SIZE)
+    coefficients = dct @ pixels @ dct.T
+    low = coefficients[:HASH_SIZE, :HASH_SIZE]
+    median = np.median(low.ravel()[1:])  # без DC-компоненты (средней яркости)
+    return _bits_to_int(low > median)
+
+
+def dhash(img: Image.Image) -> int:
+    """dHash: знаки горизонтальных градиентов картинки 9x8"""
+    pixels = _grayscale(img, (HASH_SIZE + 1, HASH_SIZE))
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def hamming_distances(hashes: np.ndarray, value: int) -> np.ndarray:
+    """Расстояния Хэмминга от value до каждого хеша массива uint64"""
+    return pairwise_hamming(hashes, np.uint64(value))
+
+
+def pairwise_hamming(a: np.ndarray, b) -> np.ndarray:
+    """Поэлементные расстояния Хэмминга между массивами uint64 (или массивом и числом)"""
+    xor = np.ascontiguousarray(np.bitwise_xor(np.asarray(a, dtype=np.uint64), np.asarray(b, dtype=np.uint64)))
+    return _POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
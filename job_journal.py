@@ -0,0 +1,159 @@
+"""
+Журнал заданий на генерацию в SQLite
+Каждое задание записывается до начала работы и обновляется по ходу: статусное сообщение,
+ключ запроса, id предсказания Replicate, стадия. После перезапуска бот находит незавершённые
+задания и дожидается уже оплаченных предсказаний вместо повторной генерации.
+
+Стадии: queued → generating → predicting → delivered | failed | abandoned
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STAGES = ("delivered", "failed", "abandoned")
+KNOWN_PREDICTIONS = 1000  # сколько выполняющихся (ключ запроса -> id предсказания) держать в памяти
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id                INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id           INTEGER NOT NULL,
+    chat_id           INTEGER NOT NULL,
+    chat_type         TEXT,
+    message_id        INTEGER,
+    status_message_id INTEGER,
+    scene             TEXT    NOT NULL,
+    scene_en          TEXT,
+    badge_text        TEXT    NOT NULL,
+    caption           TEXT,
+    quick             INTEGER NOT NULL DEFAULT 0,
+    request_key       TEXT,
+    model             TEXT,
+    prediction_id     TEXT,
+    provider          TEXT,
+    stage             TEXT    NOT NULL,
+    attempts          INTEGER NOT NULL DEFAULT 0,
+    error             TEXT,
+    created_at        REAL    NOT NULL,
+    updated_at        REAL    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_stage ON jobs (stage);
+CREATE INDEX IF NOT EXISTS jobs_request_key ON jobs (request_key);
+"""
+
+COLUMNS = ("chat_type", "message_id", "status_message_id", "scene_en", "caption", "request_key", "model",
+           "prediction_id", "provider", "stage", "attempts", "error")
+
+
+class JobJournal:
+    """Потокобезопасный журнал заданий; запись фиксируется сразу (WAL), чтобы пережить падение процесса"""
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._predictions = OrderedDict()  # ключ запроса -> (id предсказания, токен), пока генерация идёт
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            existing = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            if "provider" not in existing:
+                # Журнал из версии без пула токенов
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN provider TEXT")
+
+    def start(self, user_id: int, chat_id: int, scene: str, badge_text: str, **fields) -> int:
+        """Новое задание в стадии queued; возвращает его id"""
+        fields.setdefault("stage", "queued")
+        fields = {name: value for name, value in fields.items() if name in COLUMNS or name == "quick"}
+        now = time.time()
+        names = ["user_id", "chat_id", "scene", "badge_text", "created_at", "updated_at"] + list(fields)
+        values = [user_id, chat_id, scene, badge_text, now, now] + [
+            int(value) if isinstance(value, bool) else value for value in fields.values()
+        ]
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                f"INSERT INTO jobs ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})", values
+            )
+            return cursor.lastrowid
+
+    def update(self, job_id: int, **fields):
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {sorted(unknown)}")
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ?",
+                list(fields.values()) + [time.time(), job_id]
+            )
+
+    def mark_generating(self, job_id: int, request_key: str, scene_en: str, model: str):
+        """
+        Задание ждёт генерацию с ключом request_key
+        Если предсказание с этим ключом уже создано и ещё выполняется (запрос объединён с другим),
+        id подставляется сразу.
+        """
+        with self._lock, self._conn:
+            prediction_id, provider = self._predictions.get(request_key, (None, None))
+            self._conn.execute(
+                "UPDATE jobs SET request_key = ?, scene_en = ?, model = ?, prediction_id = ?, provider = ?, "
+                "stage = ?, updated_at = ? WHERE id = ?",
+                (request_key, scene_en, model, prediction_id, provider,
+                 "predicting" if prediction_id else "generating", time.time(), job_id)
+            )
+
+    def attach_prediction(self, request_key: str, prediction_id: str, provider: str = None):
+        """Предсказание создано (токеном provider): id получают все незавершённые задания с этим ключом"""
+        with self._lock, self._conn:
+            self._predictions[request_key] = (prediction_id, provider)
+            self._predictions.move_to_end(request_key)
+            while len(self._predictions) > KNOWN_PREDICTIONS:
+                self._predictions.popitem(last=False)
+            self._conn.execute(
+                f"UPDATE jobs SET prediction_id = ?, provider = ?, stage = 'predicting', updated_at = ? "
+                f"WHERE request_key = ? AND stage NOT IN ({', '.join('?' * len(FINISHED_STAGES))})",
+                (prediction_id, provider, time.time(), request_key) + FINISHED_STAGES
+            )
+
+    def forget_prediction(self, request_key: str):
+        """Генерация по ключу закончилась: следующий запрос с этим ключом создаст новое предсказание,
+        и id прошлого (возможно, упавшего) ему подставлять нельзя"""
+        with self._lock:
+            self._predictions.pop(request_key, None)
+
+    def finish(self, job_id: int, stage: str = "delivered", error: str = None):
+        if stage not in FINISHED_STAGES:
+            raise ValueError(f"Unknown final stage {stage}")
+        self.update(job_id, stage=stage, error=error)
+
+    def unfinished(self) -> list:
+        """Незавершённые задания, старые первыми"""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM jobs WHERE stage NOT IN ({', '.join('?' * len(FINISHED_STAGES))}) "
+                f"ORDER BY created_at, id",
+                FINISHED_STAGES
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def prune(self, older_than: float) -> int:
+        """Удаляет завершённые задания старше older_than секунд"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                f"DELETE FROM jobs WHERE stage IN ({', '.join('?' * len(FINISHED_STAGES))}) AND updated_at < ?",
+                FINISHED_STAGES + (time.time() - older_than,)
+            )
+            return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,163 @@
+"""
+Деградация качества под нагрузкой
+Контроллер следит за числом генераций в полёте и недавней задержкой и переключает уровни:
+пропуск удаления фона → уменьшенные референсы → быстрая модель → отказ с оценкой ожидания.
+Повышение уровня — сразу, понижение — по одному уровню после RECOVERY секунд без давления.
+"""
+
+import math
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, fields
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LATENCY_WINDOW = 20      # последних генераций в оценке задержки
+LATENCY_MAX_AGE = 300    # секунд: старые замеры не держат уровень, когда генераций нет
+
+DEGRADATION_LEVEL = metrics.gauge("badge_degradation_level", "Current load-shedding level (0 = full quality)")
+DEGRADATION_CHANGES = metrics.counter("badge_degradation_changes_total", "Load-shedding level changes")
+GENERATIONS_IN_FLIGHT = metrics.gauge("badge_generations_in_flight", "Badge generations currently running")
+REQUESTS_REFUSED = metrics.counter("badge_requests_refused_total", "Requests refused by load shedding")
+
+
+@dataclass(frozen=True)
+class DegradationLevel:
+    """Уровень деградации; включается, если выполнено любое из условий queue_depth / latency_p90"""
+    name: str
+    queue_depth: int = None          # генераций в полёте >= порога
+    latency_p90: float = None        # p90 задержки недавних генераций (сек) >= порога
+    skip_background_removal: bool = False
+    reference_max_side: int = None   # None = размер по умолчанию
+    model: str = None                # None = основная модель
+    refuse: bool = False
+
+    def triggered(self, in_flight: int, latency_p90: float) -> bool:
+        if self.queue_depth is not None and in_flight >= self.queue_depth:
+            return True
+        return self.latency_p90 is not None and latency_p90 is not None and latency_p90 >= self.latency_p90
+
+
+FULL_QUALITY = DegradationLevel(name="full")
+LEVEL_FIELDS = {f.name for f in fields(DegradationLevel)}
+
+
+class LoadShedder:
+    """Контроллер уровня деградации (потокобезопасный)"""
+
+    def __init__(self, levels: list, recovery_seconds: float = 30, parallelism: int = 1, clock=time.monotonic):
+        self.levels = [FULL_QUALITY] + list(levels)
+        self.recovery_seconds = recovery_seconds
+        self.parallelism = max(1, parallelism)
+        self.clock = clock
+        self.index = 0
+        self.in_flight = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # (время завершения, задержка)
+        self._active_at = clock()  # начало или конец последней генерации
+        self._pressure_seen_at = clock()
+        self._lock = threading.Lock()
+        DEGRADATION_LEVEL.set(0)
+
+    @property
+    def current(self) -> DegradationLevel:
+        return self.levels[self.index]
+
+    def _recent_latencies(self) -> list:
+        oldest = self.clock() - LATENCY_MAX_AGE
+        return sorted(latency for finished_at, latency in self.latencies if finished_at >= oldest)
+
+    def latency_p90(self):
+        recent = self._recent_latencies()
+        if not recent:
+            return None
+        return recent[min(len(recent) - 1, int(math.ceil(0.9 * len(recent))) - 1)]
+
+    def _set_index(self, index: int, in_flight: int, latency_p90):
+        previous = self.current
+        self.index = index
+        DEGRADATION_LEVEL.set(index)
+        DEGRADATION_CHANGES.inc(**{"from": previous.name, "to": self.current.name})
+        latency = f"{latency_p90:.1f}s" if latency_p90 is not None else "n/a"
+        message = (f"Load shedding level {previous.name} -> {self.current.name} "
+                   f"(in flight: {in_flight}, p90 latency: {latency})")
+        if index > self.levels.index(previous):
+            logger.warning(message)
+        else:
+            logger.info(message)
+
+    def level(self) -> DegradationLevel:
+        """Пересчитывает и возвращает текущий уровень"""
+        with self._lock:
+            latency_p90 = self.latency_p90()
+            target = 0
+            for index, level in enumerate(self.levels[1:], start=1):
+                if level.triggered(self.in_flight, latency_p90):
+                    target = index
+
+            now = self.clock()
+            if target >= self.index:
+                if target > self.index:
+                    self._set_index(target, self.in_flight, latency_p90)
+                self._pressure_seen_at = now
+            else:
+                # Вниз по одной ступени за каждые recovery_seconds без давления,
+                # считая с момента, когда давление видели последний раз (в том числе во время простоя)
+                steps = int((now - self._pressure_seen_at) // self.recovery_seconds)
+                if steps > 0:
+                    self._set_index(max(target, self.index - steps), self.in_flight, latency_p90)
+                    self._pressure_seen_at += steps * self.recovery_seconds
+            return self.current
+
+    @contextmanager
+    def track(self):
+        """Учитывает генерацию в полёте и её задержку"""
+        started = self.clock()
+        with self._lock:
+            self.in_flight += 1
+            self._active_at = started
+            GENERATIONS_IN_FLIGHT.set(self.in_flight)
+        try:
+            yield
+        finally:
+            finished = self.clock()
+            with self._lock:
+                if self.current.triggered(self.in_flight, self.latency_p90()):
+                    self._pressure_seen_at = finished
+                self.in_flight -= 1
+                GENERATIONS_IN_FLIGHT.set(self.in_flight)
+                self.latencies.append((finished, finished - started))
+                self._active_at = finished
+
+    def idle_seconds(self) -> float:
+        """Сколько секунд нет генераций (0, пока хоть одна идёт); отсчёт — с запуска процесса"""
+        with self._lock:
+            return 0.0 if self.in_flight else self.clock() - self._active_at
+
+    def eta_seconds(self) -> float:
+        """Оценка, через сколько стоит повторить: очередь / параллелизм × медианная задержка + пауза восстановления"""
+        with self._lock:
+            recent = self._recent_latencies()
+            median = recent[len(recent) // 2] if recent else 30.0
+            batches = math.ceil(max(1, self.in_flight) / self.parallelism)
+            return batches * median + self.recovery_seconds
+
+    def refused(self):
+        REQUESTS_REFUSED.inc()
+
+
+def compile_degradation_levels(levels: list) -> list:
+    """Проверяет декларативные уровни (список словарей) и превращает их в DegradationLevel"""
+    compiled = []
+    for index, level in enumerate(levels):
+        unknown = set(level) - LEVEL_FIELDS
+        if unknown or "name" not in level:
+            raise ValueError(f"Invalid degradation level #{index}: {level.get('name', '?')} {sorted(unknown)}")
+        if level.get("queue_depth") is None and level.get("latency_p90") is None:
+            raise ValueError(f"Degradation level {level['name']} has no trigger (queue_depth / latency_p90)")
+        compiled.append(DegradationLevel(**level))
+    return compiled
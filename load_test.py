@@ -0,0 +1,333 @@
+"""
+Офлайн нагрузочный прогон бота: N виртуальных пользователей, фейковые Telegram и Replicate
+Прогоняет реальные обработчики ConversationHandler (диалог /create и быстрый путь "сюжет | текст")
+и строит отчёт: p50/p95/p99 end-to-end, пропускная способность, глубина очереди, память.
+
+Пример:
+    python load_test.py --users 50 --iterations 2 --latency-median 3 --failure-rate 0.02
+"""
+
+import os
+
+# Настройки клиента Replicate читаются при импорте, поэтому задаём их до импорта бота
+os.environ.setdefault("REPLICATE_POLL_INTERVAL", "0.1")
+os.environ["REPLICATE_API_TOKEN"] = "fake-load-test-token"
+# История, журнал заданий и учёт предсказаний прогона не должны попадать в рабочие базы
+# (иначе бот после перезапуска попытается доставить бейджи виртуальным пользователям)
+os.environ.setdefault("HISTORY_DB_PATH", os.path.join(
+    os.getenv("TMPDIR", "/tmp"), f"load_test_history_{os.getpid()}.sqlite3"))
+os.environ.setdefault("JOB_JOURNAL_PATH", os.path.join(
+    os.getenv("TMPDIR", "/tmp"), f"load_test_jobs_{os.getpid()}.sqlite3"))
+os.environ.setdefault("USAGE_DB_PATH", os.path.join(
+    os.getenv("TMPDIR", "/tmp"), f"load_test_usage_{os.getpid()}.sqlite3"))
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from telegram import Update
+
+import badge_bot
+from fake_services import FakeReplicateServer, FakeTelegramServer, LatencyModel
+from memory_profile import current_rss_mb
+from provider_pool import ProviderPool
+from usage_stats import percentile
+
+logger = logging.getLogger("load_test")
+
+# =============================================================================
+# КОНФИГУРАЦИЯ
+# =============================================================================
+
+FAKE_TELEGRAM_TOKEN = "123456:LOAD-TEST-TOKEN"
+
+# Латиница, чтобы не обращаться к переводчику (прогон полностью офлайн)
+LOAD_SCENES = [
+    "plays the guitar",
+    "ninja in meditation",
+    "in battle stance with a katana",
+    "girl with a laptop",
+    "with a hammer",
+    "drinking tea under the moon",
+]
+LOAD_BADGE_TEXTS = ["CODE SAMURAI", "UX NINJA", "DEBUG MASTER", "API WARRIOR", "DATA SENSEI"]
+
+# Какими вызовами Bot API заканчивается каждый шаг
+STEP_REPLY = {"sendMessage"}
+FINAL_REPLY = {"sendPhoto", "editMessageText"}
+
+# =============================================================================
+# ВИРТУАЛЬНЫЕ ПОЛЬЗОВАТЕЛИ
+# =============================================================================
+
+class LoadContext:
+    """Связывает фейковый Telegram с Application: отправка апдейтов и ожидание ответов"""
+
+    def __init__(self, application, loop: asyncio.AbstractEventLoop, step_timeout: float):
+        self.application = application
+        self.loop = loop
+        self.step_timeout = step_timeout
+        self.replies = {}
+        self.update_id = 0
+        self.message_id = 0
+        self.in_flight = 0
+        self.results = []
+
+    def on_telegram_event(self, chat_id: int, method: str, params: dict):
+        """Вызывается из потока фейкового сервера"""
+        queue = self.replies.get(chat_id)
+        if queue is not None:
+            self.loop.call_soon_threadsafe(queue.put_nowait, method)
+
+    def make_update(self, user_id: int, text: str) -> Update:
+        self.update_id += 1
+        self.message_id += 1
+        entities = []
+        if text.startswith('/'):
+            entities.append({"type": "bot_command", "offset": 0, "length": len(text.split()[0])})
+        data = {
+            "update_id": self.update_id,
+            "message": {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": f"Load{user_id}"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}"},
+                "text": text,
+                "entities": entities,
+            },
+        }
+        return Update.de_json(data, self.application.bot)
+
+    async def send(self, user_id: int, text: str, expect: set) -> str:
+        """Отправляет сообщение от пользователя и ждёт ответ бота нужного типа"""
+        queue = self.replies.setdefault(user_id, asyncio.Queue())
+        await self.application.update_queue.put(self.make_update(user_id, text))
+        deadline = self.loop.time() + self.step_timeout
+        while True:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError(f"No {expect} reply for user {user_id}")
+            method = await asyncio.wait_for(queue.get(), timeout=remaining)
+            if method in expect:
+                return method
+
+
+async def run_virtual_user(ctx: LoadContext, user_id: int, iterations: int,
+                           quick_ratio: float, start_delay: float, rng: random.Random):
+    """Один пользователь: последовательно проходит iterations сценариев"""
+    await asyncio.sleep(start_delay)
+    for _ in range(iterations):
+        flow = "quick" if rng.random() < quick_ratio else "create"
+        scene = rng.choice(LOAD_SCENES)
+        badge_text = rng.choice(LOAD_BADGE_TEXTS)
+
+        ctx.in_flight += 1
+        started = time.monotonic()
+        outcome = "error"
+        step = "text"
+        try:
+            if flow == "quick":
+                final = await ctx.send(user_id, f"{scene} | {badge_text}", FINAL_REPLY)
+            else:
+                step = "/create"
+                await ctx.send(user_id, "/create", STEP_REPLY)
+                step = "scene"
+                await ctx.send(user_id, scene, STEP_REPLY)
+                step = "text"
+                final = await ctx.send(user_id, badge_text, FINAL_REPLY)
+            outcome = "ok" if final == "sendPhoto" else "error"
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+        finally:
+            ctx.in_flight -= 1
+
+        ctx.results.append({
+            "user_id": user_id,
+            "flow": flow,
+            "outcome": outcome,
+            "step": step,
+            "started": started,
+            "latency": time.monotonic() - started,
+        })
+
+
+async def sample_timeline(ctx: LoadContext, interval: float, timeline: list, t0: float):
+    """Периодически снимает глубину очереди, число активных сценариев и память
+    update_queue при параллельной обработке сразу разбирается в задачи, поэтому очередь — это апдейты,
+    ждущие замка диалога или слота в PerChatUpdateProcessor"""
+    processor = ctx.application.update_processor
+    while True:
+        timeline.append({
+            "t": round(time.monotonic() - t0, 2),
+            "queue_depth": getattr(processor, "waiting", 0),
+            "generations_in_flight": badge_bot.LOAD_SHEDDER.in_flight,
+            "in_flight": ctx.in_flight,
+            "completed": len(ctx.results),
+            "rss_mb": round(current_rss_mb(), 1),
+        })
+        await asyncio.sleep(interval)
+
+
+# =============================================================================
+# ОТЧЁТ
+# =============================================================================
+
+def build_report(results: list, timeline: list, wall_time: float, settings: dict) -> dict:
+    """Сводный отчёт по результатам прогона"""
+    def summarize(items):
+        latencies = [r["latency"] for r in items if r["outcome"] == "ok"]
+
+        def rank(pct):
+            value = percentile(latencies, pct)
+            return round(value, 3) if value is not None else 0.0
+
+        return {
+            "count": len(items),
+            "ok": len(latencies),
+            "errors": sum(1 for r in items if r["outcome"] == "error"),
+            "timeouts": sum(1 for r in items if r["outcome"] == "timeout"),
+            "p50": rank(50),
+            "p95": rank(95),
+            "p99": rank(99),
+            "max": round(max(latencies), 3) if latencies else 0.0,
+        }
+
+    ok_count = sum(1 for r in results if r["outcome"] == "ok")
+    return {
+        "settings": settings,
+        "wall_time": round(wall_time, 2),
+        "throughput_per_min": round(ok_count / wall_time * 60, 2) if wall_time else 0.0,
+        "overall": summarize(results),
+        "flows": {
+            flow: summarize([r for r in results if r["flow"] == flow])
+            for flow in ("quick", "create")
+        },
+        "max_queue_depth": max((s["queue_depth"] for s in timeline), default=0),
+        "max_generations_in_flight": max((s["generations_in_flight"] for s in timeline), default=0),
+        "peak_rss_mb": max((s["rss_mb"] for s in timeline), default=0.0),
+        "timeouts_by_step": {
+            step: sum(1 for r in results if r["outcome"] == "timeout" and r["step"] == step)
+            for step in sorted({r["step"] for r in results if r["outcome"] == "timeout"})
+        },
+        "timeline": timeline,
+    }
+
+
+def print_report(report: dict):
+    print("=" * 70)
+    print("📈 РЕЗУЛЬТАТЫ НАГРУЗОЧНОГО ПРОГОНА")
+    print("=" * 70)
+    settings = report["settings"]
+    print(f"Пользователей: {settings['users']} × {settings['iterations']} сценариев, "
+          f"задержка модели ~{settings['latency_median']} с ({settings['latency_dist']})")
+    print(f"Время прогона: {report['wall_time']} с, "
+          f"пропускная способность: {report['throughput_per_min']} бейджей/мин")
+    print(f"\n{'Сценарий':<10}{'всего':>7}{'ok':>6}{'err':>6}{'t/o':>6}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, stats in [("all", report["overall"])] + list(report["flows"].items()):
+        print(f"{name:<10}{stats['count']:>7}{stats['ok']:>6}{stats['errors']:>6}{stats['timeouts']:>6}"
+              f"{stats['p50']:>9.2f}{stats['p95']:>9.2f}{stats['p99']:>9.2f}")
+    print(f"\nМакс. глубина очереди апдейтов: {report['max_queue_depth']}, "
+          f"генераций в полёте: {report['max_generations_in_flight']}")
+    print(f"Пиковый RSS: {report['peak_rss_mb']} МБ")
+
+
+# =============================================================================
+# ЗАПУСК
+# =============================================================================
+
+async def run_load_test(args) -> dict:
+    loop = asyncio.get_running_loop()
+    rng = random.Random(args.seed)
+
+    # Пул фейковых токенов; первые --revoked-tokens отвечают 401 и должны уйти в карантин
+    tokens = [f"fake-load-test-token-{i}" for i in range(1, max(1, args.tokens) + 1)]
+    replicate_server = FakeReplicateServer(
+        latency=LatencyModel(args.latency_dist, args.latency_median, args.latency_spread, seed=args.seed),
+        failure_rate=args.failure_rate,
+        http_error_rate=args.http_error_rate,
+        seed=args.seed,
+        token_statuses={token: 401 for token in tokens[:args.revoked_tokens]},
+    ).start()
+    os.environ["REPLICATE_BASE_URL"] = replicate_server.url
+    badge_bot.PROVIDER_POOL = ProviderPool.from_tokens(tokens, max_concurrency=args.token_concurrency)
+
+    ctx = None
+    telegram_server = FakeTelegramServer(on_event=lambda *a: ctx and ctx.on_telegram_event(*a)).start()
+
+    application = badge_bot.build_application(FAKE_TELEGRAM_TOKEN, base_url=f"{telegram_server.url}/bot")
+    ctx = LoadContext(application, loop, args.timeout)
+
+    timeline = []
+    await application.initialize()
+    await application.start()
+    t0 = time.monotonic()
+    sampler = asyncio.create_task(sample_timeline(ctx, args.sample_interval, timeline, t0))
+    try:
+        await asyncio.gather(*[
+            run_virtual_user(
+                ctx, 100000 + i, args.iterations, args.quick_ratio,
+                start_delay=args.ramp_up * i / max(1, args.users),
+                rng=random.Random(rng.random()),
+            )
+            for i in range(args.users)
+        ])
+    finally:
+        wall_time = time.monotonic() - t0
+        sampler.cancel()
+        await application.stop()
+        await application.shutdown()
+        telegram_server.stop()
+        replicate_server.stop()
+
+    settings = {k: v for k, v in vars(args).items() if k not in ("report", "verbose")}
+    settings["predictions_created"] = replicate_server.created_count
+    usage = badge_bot.get_usage()
+    if usage is not None:
+        # Оценка затрат прогона по прайсу MODEL_PRICING, если бы он шёл против настоящего Replicate
+        settings["usage"] = usage.report(days=1)["total"]
+    settings["predictions_by_token"] = {token[-2:]: count for token, count in replicate_server.created_by_token.items()}
+    return build_report(ctx.results, timeline, wall_time, settings)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн нагрузочный прогон badge_bot")
+    parser.add_argument("--users", type=int, default=50, help="Число одновременных пользователей")
+    parser.add_argument("--iterations", type=int, default=1, help="Сценариев на пользователя")
+    parser.add_argument("--quick-ratio", type=float, default=0.5, help="Доля быстрых запросов 'сюжет | текст'")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="За сколько секунд подключаются все пользователи")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--latency-median", type=float, default=2.0, help="Медианная задержка модели, с")
+    parser.add_argument("--latency-spread", type=float, default=0.4, help="Разброс (sigma/доля)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Доля предсказаний со статусом failed")
+    parser.add_argument("--http-error-rate", type=float, default=0.0, help="Доля отказов 429 при создании")
+    parser.add_argument("--tokens", type=int, default=1, help="Сколько токенов в пуле провайдера")
+    parser.add_argument("--token-concurrency", type=int, default=badge_bot.PROVIDER_TOKEN_CONCURRENCY,
+                        help="Одновременных вызовов на токен")
+    parser.add_argument("--revoked-tokens", type=int, default=0, help="Сколько токенов отвечают 401")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Таймаут одного шага, с")
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="Период снятия метрик, с")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--report", default="load_report.json", help="Куда сохранить JSON отчёт")
+    parser.add_argument("--verbose", action="store_true", help="Показывать логи бота")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    report = asyncio.run(run_load_test(args))
+    print_report(report)
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Отчёт сохранён: {args.report}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
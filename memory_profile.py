@@ -0,0 +1,258 @@
+"""
+Профилирование памяти работающего бота без перезапуска
+- tracemalloc включается по команде; каждый отчёт сравнивает снимок с базовым (момент включения)
+  и с предыдущим отчётом — видно, какие строки кода продолжают накапливать память
+- живые BytesIO и изображения PIL: число и объём буферов
+- размер состояния диалогов (context.user_data / chat_data) по пользователям и ключам
+- дополнительные источники (кеши бота) регистрируются через add_source
+"""
+
+import os
+import gc
+import io
+import sys
+import time
+import logging
+import threading
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+TRACE_FRAMES = 10        # Глубина стека на выделение: больше — точнее место, но дороже трассировка
+TOP_SITES = 15           # Сколько мест выделения показывать
+TOP_CONVERSATIONS = 10   # Сколько самых тяжёлых диалогов показывать
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def current_rss_mb() -> float:
+    """Текущий RSS процесса в МБ (на не-Linux — пиковый)"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _pil_image_class():
+    """Класс PIL.Image.Image, если PIL уже импортирован (профилирование не должно его импортировать)"""
+    module = sys.modules.get("PIL.Image")
+    return getattr(module, "Image", None)
+
+
+def buffer_size(buffer: io.BytesIO) -> int:
+    try:
+        with buffer.getbuffer() as view:
+            return view.nbytes
+    except ValueError:
+        # Закрытый буфер памяти не держит
+        return 0
+
+
+def image_size(image) -> int:
+    """Оценка памяти под пиксели: ширина × высота × байт на пиксель"""
+    try:
+        return image.width * image.height * len(image.getbands())
+    except Exception:
+        return 0
+
+
+def deep_size(obj, seen: set = None) -> int:
+    """Оценка памяти объекта вместе с содержимым: буферы BytesIO, пиксели PIL, вложенные коллекции"""
+    image_class = _pil_image_class()
+    seen = set() if seen is None else seen
+    total = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        # Для BytesIO getsizeof уже включает буфер
+        total += sys.getsizeof(item, 0)
+        if image_class is not None and isinstance(item, image_class):
+            total += image_size(item)
+        elif isinstance(item, dict):
+            # list() копирует за один шаг: словарь могут менять в цикле событий, пока идёт обход
+            for key, value in list(item.items()):
+                stack.extend((key, value))
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(list(item))
+    return total
+
+
+def live_objects() -> dict:
+    """Живые BytesIO и изображения PIL после сборки мусора: число и объём"""
+    gc.collect()
+    image_class = _pil_image_class()
+    counts = {"bytesio": {"count": 0, "bytes": 0}, "pil_images": {"count": 0, "bytes": 0}}
+    for obj in gc.get_objects():
+        if isinstance(obj, io.BytesIO):
+            counts["bytesio"]["count"] += 1
+            counts["bytesio"]["bytes"] += buffer_size(obj)
+        elif image_class is not None and isinstance(obj, image_class):
+            counts["pil_images"]["count"] += 1
+            counts["pil_images"]["bytes"] += image_size(obj)
+    return counts
+
+
+def _largest(mapping, top: int) -> list:
+    """Самые тяжёлые записи {id: dict} с разбивкой по ключам"""
+    entries = []
+    for owner, data in list(mapping.items()):
+        keys = {str(key): deep_size(value) for key, value in list(data.items())}
+        entries.append({"id": owner, "bytes": sum(keys.values()), "keys": keys})
+    entries.sort(key=lambda entry: entry["bytes"], reverse=True)
+    return entries[:top]
+
+
+def conversation_sizes(application, top: int = TOP_CONVERSATIONS) -> dict:
+    """Состояние диалогов Application: user_data и chat_data по владельцам, число активных диалогов"""
+    if application is None:
+        return {}
+    user_data, chat_data = application.user_data, application.chat_data
+    active = 0
+    for handlers in list(application.handlers.values()):
+        for handler in handlers:
+            # У ConversationHandler нет публичного счётчика состояний
+            active += len(getattr(handler, "_conversations", ()) or ())
+    return {
+        "active_conversations": active,
+        "users": len(user_data),
+        "chats": len(chat_data),
+        "user_data_bytes": sum(deep_size(data) for data in list(user_data.values())),
+        "chat_data_bytes": sum(deep_size(data) for data in list(chat_data.values())),
+        "top_users": _largest(user_data, top),
+        "top_chats": [entry for entry in _largest(chat_data, top) if entry["bytes"]],
+    }
+
+
+def _top_sites(current, previous, top: int) -> list:
+    sites = []
+    for stat in current.compare_to(previous, 'lineno')[:top]:
+        if stat.size_diff <= 0:
+            break
+        frame = stat.traceback[0]
+        # Путь целиком (site-packages) не влезает в сообщение: пакет и файл достаточно
+        filename = os.sep.join(frame.filename.split(os.sep)[-2:])
+        sites.append({
+            "site": f"{filename}:{frame.lineno}",
+            "size_kb": round(stat.size / 1024, 1),
+            "size_diff_kb": round(stat.size_diff / 1024, 1),
+            "count_diff": stat.count_diff,
+        })
+    return sites
+
+
+class MemoryProfiler:
+    """Снимки tracemalloc по требованию; базовый и предыдущий снимки сами занимают память, пока трассировка включена"""
+
+    def __init__(self, frames: int = TRACE_FRAMES):
+        self.frames = frames
+        self.application = None
+        self.sources = {}  # имя -> функция без аргументов, возвращающая размер в байтах или dict
+        self.started_at = None
+        self._baseline = None
+        self._previous = None
+        self._lock = threading.Lock()
+
+    def attach(self, application):
+        self.application = application
+
+    def add_source(self, name: str, func):
+        self.sources[name] = func
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+    def start(self, frames: int = None):
+        """Включает tracemalloc (если ещё не включён) и запоминает базовый снимок"""
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames or self.frames)
+            self._baseline = self._previous = self._snapshot()
+            self.started_at = time.time()
+        logger.info(f"Memory tracing started ({tracemalloc.get_tracemalloc_memory() / 1024 / 1024:.1f} MB overhead)")
+
+    def stop(self):
+        with self._lock:
+            self._baseline = self._previous = None
+            self.started_at = None
+            tracemalloc.stop()
+        logger.info("Memory tracing stopped")
+
+    def report(self, top: int = TOP_SITES, advance: bool = True) -> dict:
+        """
+        Отчёт о памяти; при включённой трассировке — места выделения, выросшие с момента включения
+        и с прошлого отчёта (advance=False не сдвигает точку «прошлого отчёта»)
+        """
+        report = {"rss_mb": round(current_rss_mb(), 1), "tracing": False}
+        with self._lock:
+            if tracemalloc.is_tracing() and self._baseline is not None:
+                current = self._snapshot()
+                traced, peak = tracemalloc.get_traced_memory()
+                report.update(
+                    tracing=True,
+                    tracing_minutes=round((time.time() - self.started_at) / 60, 1),
+                    traced_mb=round(traced / 1024 / 1024, 1),
+                    traced_peak_mb=round(peak / 1024 / 1024, 1),
+                    since_start=_top_sites(current, self._baseline, top),
+                    since_previous=_top_sites(current, self._previous, top),
+                )
+                if advance:
+                    self._previous = current
+        report["objects"] = live_objects()
+        report["conversations"] = conversation_sizes(self.application)
+        sources = {}
+        for name, func in self.sources.items():
+            try:
+                sources[name] = func()
+            except Exception as e:
+                sources[name] = f"error: {e}"
+        report["sources"] = sources
+        return report
+
+
+def _kb(value: int) -> str:
+    return f"{value / 1024:.0f} KB" if value < 1024 * 1024 else f"{value / 1024 / 1024:.1f} MB"
+
+
+def format_report(report: dict, top: int = 5) -> str:
+    """Короткая сводка для Telegram"""
+    objects = report["objects"]
+    lines = [
+        f"🧠 RSS: {report['rss_mb']} MB",
+        f"BytesIO: {objects['bytesio']['count']} шт., {_kb(objects['bytesio']['bytes'])}",
+        f"PIL: {objects['pil_images']['count']} шт., {_kb(objects['pil_images']['bytes'])}",
+    ]
+    conversations = report.get("conversations") or {}
+    if conversations:
+        lines.append(f"Диалоги: {conversations['active_conversations']} активных, user_data {conversations['users']} "
+                     f"польз. ({_kb(conversations['user_data_bytes'])}), chat_data {_kb(conversations['chat_data_bytes'])}")
+        for entry in conversations["top_users"][:top]:
+            if entry["bytes"]:
+                heavy = ", ".join(f"{key} {_kb(size)}" for key, size in
+                                  sorted(entry["keys"].items(), key=lambda item: -item[1])[:3])
+                lines.append(f"   {entry['id']}: {_kb(entry['bytes'])} ({heavy})")
+    for name, value in report.get("sources", {}).items():
+        lines.append(f"{name}: {_kb(value) if isinstance(value, int) else value}")
+    if not report["tracing"]:
+        lines.append("\ntracemalloc выключен: /memory on")
+        return "\n".join(lines)
+    lines.append(f"\n📈 tracemalloc {report['tracing_minutes']} мин: {report['traced_mb']} MB "
+                 f"(пик {report['traced_peak_mb']} MB)")
+    for title, key in (("С включения", "since_start"), ("С прошлого отчёта", "since_previous")):
+        lines.append(f"{title}:")
+        for site in report[key][:top] or [{"site": "нет роста", "size_diff_kb": 0, "count_diff": 0}]:
+            lines.append(f"   +{site['size_diff_kb']} KB ({site['count_diff']:+d}) {site['site']}")
+    return "\n".join(lines)
@@ -0,0 +1,145 @@
+"""
+Метрики процесса в текстовом формате Prometheus
+Счётчики и gauge с метками живут в одном реестре; start_metrics_server отдаёт их по HTTP (/metrics).
+"""
+
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(key: tuple) -> str:
+    if not key:
+        return ""
+    parts = []
+    for name, value in key:
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{escaped}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(_label_key(labels), 0.0)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value:g}")
+        return lines
+
+
+class Counter(_Metric):
+    """Монотонно растущий счётчик"""
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """Текущее значение (уровень, размер очереди)"""
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+def _register(cls, name: str, description: str):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = cls(name, description)
+            _registry[name] = metric
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} already registered as {metric.kind}")
+        return metric
+
+
+def counter(name: str, description: str) -> Counter:
+    return _register(Counter, name, description)
+
+
+def gauge(name: str, description: str) -> Gauge:
+    return _register(Gauge, name, description)
+
+
+def render_metrics() -> str:
+    """Все метрики реестра в текстовом формате Prometheus"""
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda m: m.name)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# =============================================================================
+# HTTP
+# =============================================================================
+
+# Дополнительные GET-пути: путь -> функция без аргументов, возвращающая (код, content-type, тело)
+_routes = {"/metrics": lambda: (200, "text/plain; version=0.0.4", render_metrics())}
+
+
+def add_route(path: str, handler):
+    """Регистрирует GET-обработчик на сервере метрик"""
+    _routes[path] = handler
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        handler = _routes.get(self.path.split('?', 1)[0])
+        if handler is None:
+            status, content_type, body = 404, "text/plain", "not found\n"
+        else:
+            try:
+                status, content_type, body = handler()
+            except Exception as e:
+                logger.error(f"Metrics endpoint {self.path} failed: {e}")
+                status, content_type, body = 500, "text/plain", f"{e}\n"
+        payload = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Запускает HTTP-сервер метрик в фоновом потоке"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info(f"Metrics server listening on {host}:{server.server_address[1]}")
+    return server
@@ -0,0 +1,154 @@
+"""
+Прогрев моделей Replicate и учёт холодных/тёплых стартов
+- ModelLatencyTracker: каждый вызов модели помечается как cold (модель простаивала дольше
+  COLD_IDLE_SECONDS) или warm, задержки копятся отдельно — видно, окупается ли прогрев
+- ModelWarmer: в часы мероприятий шлёт дешёвые keep-alive предсказания моделям,
+  которые простаивают дольше интервала; живой трафик прогрев не тратит
+"""
+
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+COLD_IDLE_SECONDS = 300   # Простой, после которого вызов считается холодным
+LATENCY_SAMPLES = 200     # Сколько последних задержек хранить на (модель, старт)
+
+PREDICTIONS = metrics.counter("model_predictions_total", "Model predictions by start type and source")
+PREDICTION_SECONDS = metrics.counter("model_prediction_seconds_total", "Wall time of model predictions")
+
+
+def _median(values: list):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2] if ordered else None
+
+
+class ModelLatencyTracker:
+    """Задержки вызовов моделей с разделением на холодные и тёплые (потокобезопасный)"""
+
+    def __init__(self, cold_idle_seconds: float = COLD_IDLE_SECONDS, clock=time.monotonic):
+        self.cold_idle_seconds = cold_idle_seconds
+        self.clock = clock
+        self.last_finished = {}  # модель -> время завершения последнего вызова
+        self.samples = {}        # (модель, "cold"/"warm") -> deque задержек
+        self.warmup_count = 0
+        self.warmup_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def idle_seconds(self, model: str):
+        """Сколько модель простаивает; None — ещё не вызывалась в этом процессе"""
+        with self._lock:
+            last = self.last_finished.get(model)
+        return None if last is None else self.clock() - last
+
+    @contextmanager
+    def track(self, model: str, source: str = "user"):
+        """Замеряет вызов модели; source = user | warmup"""
+        started = self.clock()
+        with self._lock:
+            last = self.last_finished.get(model)
+        # Первый вызов после запуска процесса тоже считаем холодным: о провайдере ничего не известно
+        start = "cold" if last is None or started - last >= self.cold_idle_seconds else "warm"
+        # Неудачные вызовы в статистику не попадают: модель от них не прогревается
+        yield start
+        finished = self.clock()
+        elapsed = finished - started
+        with self._lock:
+            self.last_finished[model] = max(finished, self.last_finished.get(model, finished))
+            self.samples.setdefault((model, start), deque(maxlen=LATENCY_SAMPLES)).append(elapsed)
+            if source == "warmup":
+                self.warmup_count += 1
+                self.warmup_seconds += elapsed
+        PREDICTIONS.inc(model=model, start=start, source=source)
+        PREDICTION_SECONDS.inc(elapsed, model=model, start=start, source=source)
+        logger.info(f"Model {model.split(':')[0]}: {start} {source} prediction took {elapsed:.1f}s")
+
+    def summary(self) -> dict:
+        """Медианы cold/warm по моделям и затраты на прогрев"""
+        with self._lock:
+            models = {}
+            for (model, start), values in self.samples.items():
+                models.setdefault(model, {})[start] = {"count": len(values), "median_s": _median(list(values))}
+            return {
+                "models": models,
+                "warmup_predictions": self.warmup_count,
+                "warmup_seconds": round(self.warmup_seconds, 1),
+            }
+
+
+def parse_hours(spec: str) -> list:
+    """'9-13,15-21' -> [(9, 13), (15, 21)]; пустая строка = круглосуточно"""
+    ranges = []
+    for part in (spec or "").split(','):
+        part = part.strip()
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        ranges.append((int(start), int(end or int(start) + 1)))
+    return ranges
+
+
+def within_hours(hours: list, now: datetime = None) -> bool:
+    if not hours:
+        return True
+    hour = (now or datetime.now()).hour
+    for start, end in hours:
+        if start <= end and start <= hour < end:
+            return True
+        if start > end and (hour >= start or hour < end):  # через полночь: 22-2
+            return True
+    return False
+
+
+class ModelWarmer:
+    """Фоновые keep-alive предсказания по расписанию"""
+
+    def __init__(self, tracker: ModelLatencyTracker, warm_inputs: dict, run_model,
+                 interval: float = 240, hours: list = None, check_every: float = 30):
+        # warm_inputs: модель -> функция без аргументов, возвращающая дешёвый input
+        # run_model(model, model_input) — синхронный вызов модели (выполняется в потоке)
+        self.tracker = tracker
+        self.warm_inputs = warm_inputs
+        self.run_model = run_model
+        self.interval = interval
+        self.hours = hours or []
+        self.check_every = check_every
+        self._last_attempt = {}  # модель -> время последней попытки (неудачные не повторяем чаще interval)
+
+    def due_models(self) -> list:
+        """Модели, которым пора прогреться: идут часы мероприятия и простой >= interval"""
+        if not within_hours(self.hours):
+            return []
+        due = []
+        for model in self.warm_inputs:
+            idle = self.tracker.idle_seconds(model)
+            attempted = self._last_attempt.get(model)
+            if attempted is not None and self.tracker.clock() - attempted < self.interval:
+                continue
+            if idle is None or idle >= self.interval:
+                due.append(model)
+        return due
+
+    def warm(self, model: str):
+        self._last_attempt[model] = self.tracker.clock()
+        try:
+            with self.tracker.track(model, source="warmup"):
+                self.run_model(model, self.warm_inputs[model]())
+        except Exception as e:
+            logger.warning(f"Warm-up of {model.split(':')[0]} failed: {e}")
+
+    async def run(self):
+        """Цикл прогрева; отменяется вместе с задачей"""
+        logger.info(f"Model warmer started: {len(self.warm_inputs)} model(s), every {self.interval}s, "
+                    f"hours {self.hours or 'all day'}")
+        while True:
+            for model in self.due_models():
+                await asyncio.to_thread(self.warm, model)
+            await asyncio.sleep(self.check_every)
@@ -0,0 +1,120 @@
+"""
+Конвейер из стадий с зависимостями (DAG) на asyncio
+Стадия стартует, как только готовы все её зависимости, поэтому независимые стадии идут параллельно.
+Результат стадии кладётся в контекст под её именем; время каждой стадии замеряется.
+
+    pipeline = Pipeline("badge", [
+        Stage("translate", translate, run_in_thread=True),
+        Stage("status", send_status),
+        Stage("generate", generate, after=("translate",)),
+        Stage("reply", reply, after=("generate", "status")),
+    ])
+    ctx = await pipeline.run({"scene": "..."})
+"""
+
+import time
+import asyncio
+import inspect
+import logging
+from dataclasses import dataclass
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+STAGE_SECONDS = metrics.counter("pipeline_stage_seconds_total", "Time spent in pipeline stages")
+STAGE_RUNS = metrics.counter("pipeline_stage_runs_total", "Pipeline stage runs by outcome")
+
+
+@dataclass(frozen=True)
+class Stage:
+    """Стадия конвейера: func(ctx) — корутина или обычная функция (run_in_thread=True — в пуле потоков)"""
+    name: str
+    func: object
+    after: tuple = ()
+    run_in_thread: bool = False
+
+
+class Pipeline:
+    """Набор стадий; порядок объявления должен быть топологическим (зависимости раньше)"""
+
+    def __init__(self, name: str, stages: list, executor=None):
+        self.name = name
+        self.stages = {}
+        for stage in stages:
+            missing = [dep for dep in stage.after if dep not in self.stages]
+            if stage.name in self.stages or missing:
+                raise ValueError(f"Invalid stage {stage.name} in pipeline {name}: unknown dependencies {missing}")
+            if stage.run_in_thread and inspect.iscoroutinefunction(stage.func):
+                raise ValueError(f"Stage {stage.name}: coroutine cannot run in a thread")
+            self.stages[stage.name] = stage
+        self.executor = executor
+
+    def _needed(self, targets) -> list:
+        """Стадии, нужные для targets (вместе с зависимостями), в порядке объявления"""
+        if targets is None:
+            return list(self.stages)
+        needed, pending = set(), list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in needed:
+                needed.add(name)
+                pending.extend(self.stages[name].after)
+        return [name for name in self.stages if name in needed]
+
+    async def _run_stage(self, stage: Stage, ctx: dict, tasks: dict):
+        for dep in stage.after:
+            await tasks[dep]
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            if stage.run_in_thread:
+                result = await asyncio.get_running_loop().run_in_executor(self.executor, stage.func, ctx)
+            else:
+                result = stage.func(ctx)
+                if inspect.isawaitable(result):
+                    result = await result
+            ctx[stage.name] = result
+            return result
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            ctx["timings"][stage.name] = elapsed
+            STAGE_SECONDS.inc(elapsed, pipeline=self.name, stage=stage.name)
+            STAGE_RUNS.inc(pipeline=self.name, stage=stage.name, outcome=outcome)
+
+    async def run(self, ctx: dict, targets: list = None) -> dict:
+        """
+        Выполняет стадии (или только нужные для targets) и возвращает ctx с результатами
+        Стадии, результат которых уже есть в ctx, не выполняются.
+        При ошибке дожидается остальных стадий и поднимает исключение самой ранней упавшей стадии;
+        её имя — в атрибуте failed_stage исключения.
+        """
+        ctx.setdefault("timings", {})
+        started = time.perf_counter()
+        tasks = {}
+        for name in self._needed(targets):
+            if name in ctx:
+                done = asyncio.get_running_loop().create_future()
+                done.set_result(ctx[name])
+                tasks[name] = done
+            else:
+                tasks[name] = asyncio.ensure_future(self._run_stage(self.stages[name], ctx, tasks))
+
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+        timings = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in ctx["timings"].items())
+        logger.info(f"Pipeline {self.name} finished in {time.perf_counter() - started:.2f}s: {timings}")
+
+        for name, result in zip(tasks, results):
+            if isinstance(result, BaseException):
+                # Зависимые стадии получают то же исключение; первая по порядку — источник
+                if not hasattr(result, "failed_stage"):
+                    try:
+                        result.failed_stage = name
+                    except AttributeError:
+                        pass
+                raise result
+        return ctx
@@ -0,0 +1,232 @@
+"""
+Предварительная генерация популярных бейджей в простое
+- PrefetchStore: готовые бейджи в SQLite по ключу запроса (badge_request_key); каждый отдаётся
+  одному пользователю, затем место заполняется новой генерацией — одинаковые запросы не получают
+  одну и ту же картинку
+- Prefetcher: когда в боте нет генераций, по одной готовит бейджи для самых частых недавних
+  запросов и примеров из /examples в пределах дневного бюджета (число генераций и $)
+"""
+
+import os
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+
+import metrics
+from model_warmup import within_hours
+
+logger = logging.getLogger(__name__)
+
+FAILED_RETRY_SECONDS = 3600  # Запрос, генерация которого упала, пропускается на это время
+
+PREFETCH_HITS = metrics.counter("prefetch_hits_total", "Badge requests served from the prefetch store")
+PREFETCH_GENERATIONS = metrics.counter("prefetch_generations_total", "Badges generated ahead of time by status")
+PREFETCH_COST = metrics.counter("prefetch_cost_usd_total", "Estimated cost of prefetch generations")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS badges (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    request_key   TEXT    NOT NULL,
+    scene         TEXT    NOT NULL,
+    scene_en      TEXT    NOT NULL,
+    badge_text    TEXT    NOT NULL,
+    image         BLOB    NOT NULL,
+    model         TEXT,
+    seed          INTEGER,
+    prediction_id TEXT,
+    created_at    REAL    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS badges_request_key ON badges (request_key, created_at);
+CREATE TABLE IF NOT EXISTS spend (
+    day         TEXT    PRIMARY KEY,
+    generations INTEGER NOT NULL DEFAULT 0,
+    cost_usd    REAL    NOT NULL DEFAULT 0,
+    hits        INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def _today() -> str:
+    return datetime.now().strftime("%Y-%m-%d")
+
+
+class PrefetchStore:
+    """Потокобезопасное хранилище готовых бейджей и дневных затрат на них"""
+
+    def __init__(self, path: str, max_age: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_age = max_age
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+
+    def put(self, request_key: str, image: bytes, scene: str, scene_en: str, badge_text: str,
+            model: str = None, seed: int = None, prediction_id: str = None) -> int:
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO badges (request_key, scene, scene_en, badge_text, image, model, seed, prediction_id, "
+                "created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (request_key, scene, scene_en, badge_text, image, model, seed, prediction_id, time.time())
+            )
+            return cursor.lastrowid
+
+    def take(self, request_key: str):
+        """Забирает самый старый готовый бейдж по ключу (он удаляется) или None"""
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT * FROM badges WHERE request_key = ? AND created_at >= ? ORDER BY created_at LIMIT 1",
+                (request_key, time.time() - self.max_age)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("DELETE FROM badges WHERE id = ?", (row["id"],))
+            self._conn.execute(
+                "INSERT INTO spend (day, hits) VALUES (?, 1) ON CONFLICT(day) DO UPDATE SET hits = hits + 1",
+                (_today(),)
+            )
+        PREFETCH_HITS.inc()
+        return dict(row)
+
+    def available(self, request_key: str) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM badges WHERE request_key = ? AND created_at >= ?",
+                (request_key, time.time() - self.max_age)
+            ).fetchone()[0]
+
+    def add_spend(self, cost_usd: float, day: str = None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO spend (day, generations, cost_usd) VALUES (?, 1, ?) "
+                "ON CONFLICT(day) DO UPDATE SET generations = generations + 1, cost_usd = cost_usd + excluded.cost_usd",
+                (day or _today(), cost_usd)
+            )
+
+    def spent(self, day: str = None) -> dict:
+        """{"generations", "cost_usd", "hits"} за день (по умолчанию сегодня)"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM spend WHERE day = ?", (day or _today(),)).fetchone()
+        return {"generations": row["generations"], "cost_usd": round(row["cost_usd"], 4), "hits": row["hits"]} \
+            if row else {"generations": 0, "cost_usd": 0.0, "hits": 0}
+
+    def prune(self) -> int:
+        """Удаляет устаревшие бейджи; возвращает их число"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute("DELETE FROM badges WHERE created_at < ?", (time.time() - self.max_age,))
+            return cursor.rowcount
+
+    def summary(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT scene_en, badge_text, COUNT(*) AS ready FROM badges WHERE created_at >= ? "
+                "GROUP BY request_key ORDER BY ready DESC, scene_en",
+                (time.time() - self.max_age,)
+            ).fetchall()
+        return {"today": self.spent(), "ready": [dict(row) for row in rows]}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Prefetcher:
+    """Фоновая генерация популярных запросов, пока в боте нет живых генераций"""
+
+    def __init__(self, store: PrefetchStore, candidates, resolve, produce, idle_seconds,
+                 daily_limit: int = 50, daily_budget_usd: float = None, per_key: int = 1,
+                 idle_after: float = 60, hours: list = None, check_every: float = 30):
+        # candidates() -> [(сюжет, текст)] по убыванию приоритета
+        # resolve(сюжет, текст) -> ключ запроса (перевод и подбор референсов, как в боте)
+        # produce(сюжет, текст) -> {"key", "image", "scene_en", "model", "seed", "prediction_id", "cost_usd"}
+        # idle_seconds() -> сколько секунд в боте нет генераций (0, если идут)
+        self.store = store
+        self.candidates = candidates
+        self.resolve = resolve
+        self.produce = produce
+        self.idle_seconds = idle_seconds
+        self.daily_limit = daily_limit
+        self.daily_budget_usd = daily_budget_usd
+        self.per_key = per_key
+        self.idle_after = idle_after
+        self.hours = hours or []
+        self.check_every = check_every
+        self._keys = {}         # (сюжет, текст) -> ключ: перевод не повторяется на каждом круге
+        self._failed_at = {}    # (сюжет, текст) -> время последней неудачи
+
+    def budget_left(self) -> bool:
+        spent = self.store.spent()
+        if self.daily_limit is not None and spent["generations"] >= self.daily_limit:
+            return False
+        return self.daily_budget_usd is None or spent["cost_usd"] < self.daily_budget_usd
+
+    def can_run(self) -> bool:
+        return within_hours(self.hours) and self.idle_seconds() >= self.idle_after and self.budget_left()
+
+    def key_for(self, scene: str, badge_text: str) -> str:
+        if (scene, badge_text) not in self._keys:
+            self._keys[(scene, badge_text)] = self.resolve(scene, badge_text)
+        return self._keys[(scene, badge_text)]
+
+    def next_candidate(self):
+        """Первый по приоритету запрос, для которого готовых бейджей меньше per_key"""
+        now = time.monotonic()
+        for scene, badge_text in self.candidates():
+            failed_at = self._failed_at.get((scene, badge_text))
+            if failed_at is not None and now - failed_at < FAILED_RETRY_SECONDS:
+                continue
+            if self.store.available(self.key_for(scene, badge_text)) < self.per_key:
+                return scene, badge_text
+        return None
+
+    def prefetch(self, scene: str, badge_text: str):
+        try:
+            result = self.produce(scene, badge_text)
+        except Exception as e:
+            self._failed_at[(scene, badge_text)] = time.monotonic()
+            PREFETCH_GENERATIONS.inc(status="failed")
+            logger.warning(f"Prefetch of '{scene}' | '{badge_text}' failed: {e}")
+            return
+        # Ключ мог измениться (например, обновились референсы) — кладём под тем, с которым считали
+        self._keys[(scene, badge_text)] = result["key"]
+        self.store.put(result["key"], result["image"], scene, result["scene_en"], badge_text,
+                       model=result.get("model"), seed=result.get("seed"), prediction_id=result.get("prediction_id"))
+        self.store.add_spend(result.get("cost_usd") or 0.0)
+        PREFETCH_GENERATIONS.inc(status="succeeded")
+        PREFETCH_COST.inc(result.get("cost_usd") or 0.0)
+        logger.info(f"Prefetched badge '{scene}' | '{badge_text}' (${result.get('cost_usd') or 0:.3f})")
+
+    def step(self) -> bool:
+        """Одна генерация, если бот простаивает и бюджет не исчерпан; True, если она была"""
+        if not self.can_run():
+            return False
+        candidate = self.next_candidate()
+        # Пока выбирали (перевод), мог прийти живой запрос
+        if candidate is None or self.idle_seconds() < self.idle_after:
+            return False
+        self.prefetch(*candidate)
+        return True
+
+    async def run(self):
+        """Цикл предгенерации; отменяется вместе с задачей"""
+        logger.info(f"Prefetcher started: up to {self.daily_limit} generations/day"
+                    f"{f', ${self.daily_budget_usd:g}/day' if self.daily_budget_usd is not None else ''}, "
+                    f"after {self.idle_after:g}s idle, hours {self.hours or 'all day'}")
+        while True:
+            try:
+                pruned = await asyncio.to_thread(self.store.prune)
+                if pruned:
+                    logger.info(f"Prefetch store: {pruned} expired badge(s) removed")
+                # Подряд, пока бот простаивает: живой запрос остановит серию после текущей генерации
+                while await asyncio.to_thread(self.step):
+                    pass
+            except Exception as e:
+                logger.warning(f"Prefetcher step failed: {e}")
+            await asyncio.sleep(self.check_every)
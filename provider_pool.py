@@ -0,0 +1,204 @@
+"""
+Пул токенов Replicate
+У каждого токена свой клиент, лимит одновременных вызовов и состояние здоровья.
+Вызов уходит наименее загруженному здоровому токену; при ошибке авторизации (401/403)
+или квоты (402/429) токен уходит в карантин, а вызов повторяется на другом токене, если
+вызывающий подтверждает, что предсказание ещё не создано (can_retry). Ошибка при опросе уже
+созданного предсказания не повторяется: новый вызов оплатил бы второе предсказание.
+
+    pool = ProviderPool.from_tokens(["r8_aaa", "r8_bbb"], max_concurrency=8)
+    output = pool.call(lambda provider: provider.client.run(model, input=model_input))
+"""
+
+import time
+import logging
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+AUTH_STATUSES = (401, 403)
+QUOTA_STATUSES = (402, 429)
+AUTH_QUARANTINE_SECONDS = 3600   # неверный или отозванный токен сам не починится
+QUOTA_QUARANTINE_SECONDS = 60    # лимит запросов / закончились деньги на аккаунте
+ACQUIRE_TIMEOUT = 300            # сколько ждать свободного слота, когда все токены заняты
+
+PROVIDER_IN_FLIGHT = metrics.gauge("provider_calls_in_flight", "Provider calls currently running per token")
+PROVIDER_HEALTHY = metrics.gauge("provider_token_healthy", "1 when the provider token is not quarantined")
+PROVIDER_CALLS = metrics.counter("provider_calls_total", "Provider calls by token and outcome")
+PROVIDER_QUARANTINES = metrics.counter("provider_quarantines_total", "Provider token quarantines by reason")
+
+
+class ProviderUnavailableError(RuntimeError):
+    """Все токены в карантине; retry_after — через сколько секунд освободится первый"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def error_status(error: Exception):
+    """HTTP-статус ошибки провайдера (ReplicateError.status или httpx-ответ), если он есть"""
+    status = getattr(error, "status", None)
+    if status is None:
+        response = getattr(error, "response", None)
+        status = getattr(response, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+class Provider:
+    """Один токен: клиент создаётся при первом вызове"""
+
+    def __init__(self, name: str, token: str, max_concurrency: int, client_factory=None):
+        self.name = name
+        self.token = token
+        self.max_concurrency = max(1, max_concurrency)
+        self.client_factory = client_factory
+        self.in_flight = 0
+        self.quarantined_until = 0.0
+        self.quarantine_reason = None
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            if self.client_factory is not None:
+                self._client = self.client_factory(self.token)
+            else:
+                import replicate
+                self._client = replicate.Client(api_token=self.token)
+        return self._client
+
+    def load(self) -> float:
+        return self.in_flight / self.max_concurrency
+
+
+class ProviderPool:
+    """Диспетчер вызовов по токенам (потокобезопасный; вызовы выполняются в потоках)"""
+
+    def __init__(self, providers: list, clock=time.monotonic):
+        if not providers:
+            raise ValueError("Provider pool needs at least one token")
+        self.providers = providers
+        self.clock = clock
+        self._condition = threading.Condition()
+        for provider in providers:
+            PROVIDER_HEALTHY.set(1, provider=provider.name)
+            PROVIDER_IN_FLIGHT.set(0, provider=provider.name)
+
+    @classmethod
+    def from_tokens(cls, tokens: list, max_concurrency: int = 8, client_factory=None, **kwargs) -> "ProviderPool":
+        """Имена токенов — номер и последние 4 символа: сами токены в логи и метрики не попадают"""
+        providers = [
+            Provider(f"{index}:{token[-4:]}", token, max_concurrency, client_factory)
+            for index, token in enumerate(tokens, start=1)
+        ]
+        return cls(providers, **kwargs)
+
+    def _healthy(self, now: float) -> list:
+        healthy = []
+        for provider in self.providers:
+            if provider.quarantined_until and provider.quarantined_until <= now:
+                logger.info(f"Provider token {provider.name} is back from quarantine ({provider.quarantine_reason})")
+                provider.quarantined_until = 0.0
+                provider.quarantine_reason = None
+                PROVIDER_HEALTHY.set(1, provider=provider.name)
+            if not provider.quarantined_until:
+                healthy.append(provider)
+        return healthy
+
+    def acquire(self, exclude=(), timeout: float = ACQUIRE_TIMEOUT) -> Provider:
+        """Занимает слот наименее загруженного здорового токена; ждёт, если все заняты"""
+        deadline = self.clock() + timeout
+        with self._condition:
+            while True:
+                now = self.clock()
+                healthy = [provider for provider in self._healthy(now) if provider.name not in exclude]
+                if not healthy:
+                    quarantined = [p.quarantined_until for p in self.providers if p.quarantined_until]
+                    retry_after = max(0.0, min(quarantined) - now) if quarantined else 0.0
+                    raise ProviderUnavailableError(
+                        f"No healthy provider tokens (rate limit or auth errors), retry in {retry_after:.0f}s",
+                        retry_after
+                    )
+                free = [provider for provider in healthy if provider.in_flight < provider.max_concurrency]
+                if free:
+                    provider = min(free, key=Provider.load)
+                    provider.in_flight += 1
+                    PROVIDER_IN_FLIGHT.set(provider.in_flight, provider=provider.name)
+                    return provider
+                if now >= deadline:
+                    raise TimeoutError(f"No free provider slot within {timeout}s")
+                # Ждём освобождения слота, но не дольше секунды: карантин может закончиться сам
+                self._condition.wait(min(1.0, deadline - now))
+
+    def release(self, provider: Provider):
+        with self._condition:
+            provider.in_flight -= 1
+            PROVIDER_IN_FLIGHT.set(provider.in_flight, provider=provider.name)
+            self._condition.notify()
+
+    def quarantine(self, provider: Provider, reason: str, seconds: float):
+        with self._condition:
+            provider.quarantined_until = self.clock() + seconds
+            provider.quarantine_reason = reason
+        PROVIDER_HEALTHY.set(0, provider=provider.name)
+        PROVIDER_QUARANTINES.inc(provider=provider.name, reason=reason)
+        logger.warning(f"Provider token {provider.name} quarantined for {seconds:.0f}s: {reason}")
+
+    def classify(self, error: Exception):
+        """(причина, секунды карантина) для ошибок авторизации/квоты, иначе None"""
+        status = error_status(error)
+        if status in AUTH_STATUSES:
+            return f"auth error {status}", AUTH_QUARANTINE_SECONDS
+        if status in QUOTA_STATUSES:
+            return f"quota error {status}", QUOTA_QUARANTINE_SECONDS
+        return None
+
+    def call(self, func, can_retry=None):
+        """
+        func(provider) на наименее загруженном здоровом токене
+        Ошибки авторизации/квоты отправляют токен в карантин и повторяют вызов на следующем,
+        если can_retry() (по умолчанию — всегда) разрешает повтор.
+        """
+        tried = set()
+        while True:
+            provider = self.acquire(exclude=tried)
+            try:
+                result = func(provider)
+                PROVIDER_CALLS.inc(provider=provider.name, outcome="ok")
+                return result
+            except Exception as e:
+                quarantine = self.classify(e)
+                PROVIDER_CALLS.inc(provider=provider.name, outcome="quarantine" if quarantine else "error")
+                if quarantine is None:
+                    raise
+                self.quarantine(provider, *quarantine)
+                tried.add(provider.name)
+                if len(tried) >= len(self.providers) or (can_retry is not None and not can_retry()):
+                    raise
+            finally:
+                self.release(provider)
+
+    def get(self, name: str) -> Provider:
+        """Токен по имени (например, для возобновления предсказания тем же аккаунтом)"""
+        for provider in self.providers:
+            if provider.name == name:
+                return provider
+        raise KeyError(f"Unknown provider token {name}")
+
+    def summary(self) -> list:
+        with self._condition:
+            now = self.clock()
+            return [
+                {
+                    "provider": provider.name,
+                    "in_flight": provider.in_flight,
+                    "max_concurrency": provider.max_concurrency,
+                    "healthy": not provider.quarantined_until or provider.quarantined_until <= now,
+                    "quarantine_reason": provider.quarantine_reason,
+                    "quarantine_left_s": round(max(0.0, provider.quarantined_until - now), 1),
+                }
+                for provider in self.providers
+            ]
@@ -0,0 +1,145 @@
+"""
+Дисковый кеш подготовленных референсных изображений
+Референс уменьшается до рабочего размера модели, очищается от метаданных
+и перекодируется в JPEG. Ключ кеша = хеш содержимого + параметры обработки.
+"""
+
+import os
+import hashlib
+import logging
+import threading
+from io import BytesIO
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# КОНФИГУРАЦИЯ
+# =============================================================================
+
+REFERENCE_CACHE_DIR = os.getenv("REFERENCE_CACHE_DIR", ".cache/reference_images")
+REFERENCE_MAX_SIDE = 1024  # Рабочее разрешение входа модели (длинная сторона, px)
+REFERENCE_JPEG_QUALITY = 88
+PREPROCESS_VERSION = 1  # Увеличить при изменении алгоритма обработки
+
+# (path, mtime_ns, size) -> sha256 содержимого, чтобы не перечитывать файл на каждый запрос
+_source_digests = {}
+_lock = threading.Lock()
+
+# =============================================================================
+# ФУНКЦИИ
+# =============================================================================
+
+def file_digest(filepath: str) -> str:
+    """Возвращает sha256 содержимого файла (с кешированием по mtime/size)"""
+    stat = os.stat(filepath)
+    stamp = (os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        digest = _source_digests.get(stamp)
+    if digest:
+        return digest
+
+    hasher = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+
+    with _lock:
+        _source_digests[stamp] = digest
+    return digest
+
+
+def cache_key(digest: str, max_side: int, quality: int) -> str:
+    """Ключ кеша: содержимое исходника + параметры обработки"""
+    params = f"v{PREPROCESS_VERSION}-{max_side}-{quality}"
+    return hashlib.sha256(f"{digest}:{params}".encode()).hexdigest()[:32]
+
+
+def preprocess_reference_image(source, max_side: int = REFERENCE_MAX_SIDE,
+                               quality: int = REFERENCE_JPEG_QUALITY) -> bytes:
+    """Уменьшает изображение, убирает EXIF/ICC и перекодирует в JPEG"""
+    from PIL import Image, ImageOps  # лениво: PIL не нужен, если все референсы уже в кеше
+
+    with Image.open(source) as img:
+        # Поворот по EXIF нужно применить до того, как метаданные будут выброшены
+        img = ImageOps.exif_transpose(img)
+
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[3])
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        if max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        output = BytesIO()
+        # Без exif=/icc_profile= Pillow не переносит метаданные в новый файл
+        img.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+        return output.getvalue()
+
+
+def get_cached_reference_path(filepath: str, max_side: int = REFERENCE_MAX_SIDE,
+                              quality: int = REFERENCE_JPEG_QUALITY,
+                              cache_dir: str = None) -> str:
+    """Возвращает путь к подготовленной копии референса, создавая её при необходимости"""
+    cache_dir = cache_dir or REFERENCE_CACHE_DIR
+    key = cache_key(file_digest(filepath), max_side, quality)
+    cached_path = os.path.join(cache_dir, f"{key}.jpg")
+    if os.path.exists(cached_path):
+        return cached_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    data = preprocess_reference_image(filepath, max_side, quality)
+
+    # Атомарная запись: параллельные запросы не увидят недописанный файл
+    temp_path = f"{cached_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, cached_path)
+
+    original_size = os.path.getsize(filepath)
+    logger.info(
+        f"Preprocessed reference {os.path.basename(filepath)}: "
+        f"{original_size // 1024} KB -> {len(data) // 1024} KB"
+    )
+    return cached_path
+
+
+def load_reference_bytes(filepath: str, max_side: int = REFERENCE_MAX_SIDE,
+                         quality: int = REFERENCE_JPEG_QUALITY) -> BytesIO:
+    """Загружает подготовленный референс в BytesIO (при ошибке обработки — исходный файл)"""
+    try:
+        path = get_cached_reference_path(filepath, max_side, quality)
+    except Exception as e:
+        logger.warning(f"Failed to preprocess {filepath}, sending original: {e}")
+        path = filepath
+
+    with open(path, 'rb') as f:
+        img_bytes = BytesIO(f.read())
+    # Имя нужно Replicate для определения MIME-типа при кодировании в data URI
+    img_bytes.name = os.path.basename(path)
+    img_bytes.seek(0)
+    return img_bytes
+
+
+def warm_reference_cache(directory: str, max_side: int = REFERENCE_MAX_SIDE,
+                         quality: int = REFERENCE_JPEG_QUALITY) -> int:
+    """Подготавливает все референсы папки заранее, возвращает количество файлов"""
+    if not os.path.exists(directory):
+        return 0
+
+    supported_formats = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+    count = 0
+    for filename in sorted(os.listdir(directory)):
+        filepath = os.path.join(directory, filename)
+        if not (os.path.isfile(filepath) and filename.lower().endswith(supported_formats)):
+            continue
+        try:
+            get_cached_reference_path(filepath, max_side, quality)
+            count += 1
+        except Exception as e:
+            logger.warning(f"Failed to preprocess {filename}: {e}")
+    return count
@@ -0,0 +1,271 @@
+"""
+Индекс библиотеки референсов для выбора top-k изображений под промпт
+Для каждого файла хранятся цветовая гистограмма, pHash и теги; всё лежит в одном .npz.
+Индекс обновляется инкрементально: пересчитываются только новые и изменённые файлы.
+
+Теги берутся из имени файла и необязательного tags.json в папке референсов:
+    {"samurai_moon.jpg": ["moon", "night", "луна"], ...}
+"""
+
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+import numpy as np
+from PIL import Image
+
+from image_hashing import phash, hamming_distances
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# КОНФИГУРАЦИЯ
+# =============================================================================
+
+REFERENCE_INDEX_DIR = os.getenv("REFERENCE_INDEX_DIR", ".cache")
+REFERENCE_TAGS_FILE = "tags.json"
+HISTOGRAM_BINS = 4  # на канал: 4x4x4 = 64 корзины RGB
+DIVERSITY_WEIGHT = 0.5  # Штраф за похожесть на уже выбранные референсы
+SUPPORTED_FORMATS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+
+# Цветовые слова промпта -> RGB, для которого ищется масса в гистограмме
+COLOUR_WORDS = {
+    'red': (200, 30, 40), 'красн': (200, 30, 40),
+    'orange': (240, 140, 30), 'оранж': (240, 140, 30),
+    'yellow': (240, 210, 60), 'gold': (220, 180, 60), 'желт': (240, 210, 60), 'золот': (220, 180, 60),
+    'green': (40, 160, 60), 'зелен': (40, 160, 60),
+    'blue': (40, 80, 200), 'син': (40, 80, 200), 'голуб': (100, 170, 230),
+    'purple': (120, 50, 160), 'фиолет': (120, 50, 160),
+    'pink': (240, 140, 180), 'розов': (240, 140, 180),
+    'black': (15, 15, 15), 'night': (20, 20, 50), 'черн': (15, 15, 15), 'ноч': (20, 20, 50),
+    'white': (245, 245, 245), 'snow': (240, 240, 250), 'бел': (245, 245, 245), 'снег': (240, 240, 250),
+}
+
+_WORD_RE = re.compile(r'\w+')
+
+# =============================================================================
+# ПРИЗНАКИ
+# =============================================================================
+
+def _tokens(text: str) -> set:
+    return {word for word in _WORD_RE.findall(text.casefold().replace('ё', 'е')) if len(word) > 1}
+
+
+def colour_histogram(img: Image.Image) -> np.ndarray:
+    """Нормированная RGB-гистограмма HISTOGRAM_BINS^3 по уменьшенной копии"""
+    small = np.asarray(img.convert('RGB').resize((64, 64)), dtype=np.uint16)
+    quantized = small * HISTOGRAM_BINS // 256
+    index = (quantized[..., 0] * HISTOGRAM_BINS + quantized[..., 1]) * HISTOGRAM_BINS + quantized[..., 2]
+    hist = np.bincount(index.ravel(), minlength=HISTOGRAM_BINS ** 3).astype(np.float32)
+    return hist / hist.sum()
+
+
+def _colour_bin(rgb: tuple) -> int:
+    r, g, b = (channel * HISTOGRAM_BINS // 256 for channel in rgb)
+    return (r * HISTOGRAM_BINS + g) * HISTOGRAM_BINS + b
+
+
+def _load_tag_file(directory: str) -> dict:
+    path = os.path.join(directory, REFERENCE_TAGS_FILE)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, encoding='utf-8') as f:
+            return {name.lower(): tags for name, tags in json.load(f).items()}
+    except Exception as e:
+        logger.warning(f"Failed to read {path}: {e}")
+        return {}
+
+
+def _file_stats(directory: str) -> tuple:
+    """({референс: (mtime_ns, размер)}, (mtime_ns, размер) tags.json или None)"""
+    files = {}
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        if filename.lower().endswith(SUPPORTED_FORMATS) and os.path.isfile(path):
+            stat = os.stat(path)
+            files[filename] = (stat.st_mtime_ns, stat.st_size)
+    try:
+        stat = os.stat(os.path.join(directory, REFERENCE_TAGS_FILE))
+        tags_stat = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        tags_stat = None
+    return files, tags_stat
+
+
+# =============================================================================
+# ИНДЕКС
+# =============================================================================
+
+class ReferenceIndex:
+    """Признаки всех референсов папки в плоских NumPy массивах"""
+
+    def __init__(self, directory: str, index_path: str = None):
+        self.directory = directory
+        if index_path is None:
+            # Свой файл на каждую папку, чтобы индексы разных библиотек не перезаписывали друг друга
+            suffix = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()[:10]
+            index_path = os.path.join(REFERENCE_INDEX_DIR, f"reference_index_{suffix}.npz")
+        self.index_path = index_path
+        self.names = []
+        self.mtimes = np.zeros(0, dtype=np.int64)
+        self.sizes = np.zeros(0, dtype=np.int64)
+        self.histograms = np.zeros((0, HISTOGRAM_BINS ** 3), dtype=np.float16)
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.tags = []
+        self.scanned = None  # _file_stats папки при последнем обновлении (включая файлы, которые не прочитались)
+        self.lock = threading.Lock()
+
+    def load(self) -> bool:
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            with np.load(self.index_path, allow_pickle=False) as data:
+                if str(data["directory"]) != os.path.abspath(self.directory):
+                    return False
+                self.names = [str(name) for name in data["names"]]
+                self.mtimes = data["mtimes"]
+                self.sizes = data["sizes"]
+                self.histograms = data["histograms"]
+                self.hashes = data["hashes"]
+                self.tags = [set(str(tags).split()) for tags in data["tags"]]
+            return True
+        except Exception as e:
+            logger.warning(f"Reference index {self.index_path} is unreadable, rebuilding: {e}")
+            return False
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.savez(
+                f,
+                directory=np.array(os.path.abspath(self.directory)),
+                names=np.array(self.names, dtype=str),
+                mtimes=self.mtimes,
+                sizes=self.sizes,
+                histograms=self.histograms,
+                hashes=self.hashes,
+                tags=np.array([' '.join(sorted(tags)) for tags in self.tags], dtype=str),
+            )
+        os.replace(temp_path, self.index_path)
+
+    def update(self) -> tuple:
+        """Инкрементальное обновление; возвращает (добавлено/изменено, удалено)"""
+        with self.lock:
+            if not os.path.isdir(self.directory):
+                return 0, 0
+            self.scanned = _file_stats(self.directory)
+            current = self.scanned[0]
+            tag_file = _load_tag_file(self.directory)
+
+            known = {name: i for i, name in enumerate(self.names)}
+            keep = [known[name] for name in sorted(current)
+                    if name in known and (int(self.mtimes[known[name]]), int(self.sizes[known[name]])) == current[name]]
+            changed = sorted(name for name in current if name not in known
+                             or (int(self.mtimes[known[name]]), int(self.sizes[known[name]])) != current[name])
+            removed = sum(1 for name in self.names if name not in current)
+
+            new_rows = []
+            for filename in changed:
+                try:
+                    with Image.open(os.path.join(self.directory, filename)) as img:
+                        img.load()
+                        new_rows.append((filename, colour_histogram(img), phash(img)))
+                except Exception as e:
+                    logger.warning(f"Failed to index reference {filename}: {e}")
+
+            names = [self.names[i] for i in keep] + [row[0] for row in new_rows]
+            self.histograms = np.vstack([self.histograms[keep]] + [row[1][None, :].astype(np.float16) for row in new_rows])
+            self.hashes = np.concatenate([self.hashes[keep], np.array([row[2] for row in new_rows], dtype=np.uint64)])
+            self.mtimes = np.array([current[name][0] for name in names], dtype=np.int64)
+            self.sizes = np.array([current[name][1] for name in names], dtype=np.int64)
+            self.names = names
+            # Теги дешёвые, пересобираем для всех (tags.json мог измениться)
+            self.tags = [
+                _tokens(os.path.splitext(name)[0].replace('_', ' ').replace('-', ' '))
+                | _tokens(' '.join(tag_file.get(name.lower(), [])))
+                for name in names
+            ]
+
+            if new_rows or removed:
+                self.save()
+                logger.info(f"Reference index updated: {len(new_rows)} added/changed, {removed} removed, "
+                            f"{len(names)} total")
+            return len(new_rows), removed
+
+    def refresh_if_changed(self):
+        """Дешёвая проверка: обновить индекс, только если изменился какой-то файл (mtime, размер) или tags.json
+        mtime папки не меняется, когда файл перезаписывают на месте"""
+        try:
+            scanned = _file_stats(self.directory)
+        except OSError:
+            return
+        if scanned != self.scanned:
+            self.update()
+
+    def relevance(self, prompt: str) -> np.ndarray:
+        """Релевантность каждого референса промпту: совпадение тегов + цветовые слова"""
+        words = _tokens(prompt)
+        scores = np.zeros(len(self.names), dtype=np.float32)
+        if not words:
+            return scores
+
+        for i, tags in enumerate(self.tags):
+            if tags:
+                # Совпадение по основе: "moon" ~ "moonlight", "гор" ~ "горы"
+                hits = sum(1 for word in words if any(tag.startswith(word) or word.startswith(tag) for tag in tags))
+                scores[i] += 2.0 * hits / len(words)
+
+        histograms = self.histograms.astype(np.float32)
+        for word in words:
+            for colour_word, rgb in COLOUR_WORDS.items():
+                if word.startswith(colour_word):
+                    scores += histograms[:, _colour_bin(rgb)]
+        return scores
+
+    def select(self, prompt: str, k: int, candidates: set = None) -> list:
+        """Top-k референсов: релевантность минус похожесть на уже выбранные (MMR)"""
+        self.refresh_if_changed()
+        with self.lock:
+            pool = [i for i, name in enumerate(self.names) if candidates is None or name in candidates]
+            if len(pool) <= k:
+                return sorted(self.names[i] for i in pool)
+
+            relevance = self.relevance(prompt)[pool]
+            histograms = self.histograms[pool].astype(np.float32)
+            hashes = self.hashes[pool]
+            max_similarity = np.zeros(len(pool), dtype=np.float32)
+            chosen = []
+
+            for _ in range(k):
+                score = relevance - DIVERSITY_WEIGHT * max_similarity
+                score[chosen] = -np.inf
+                best = int(np.argmax(score))  # при равенстве — первый по порядку в индексе
+                chosen.append(best)
+
+                colour_similarity = np.minimum(histograms, histograms[best]).sum(axis=1)
+                hash_similarity = 1.0 - hamming_distances(hashes, int(hashes[best])) / 64.0
+                similarity = 0.5 * colour_similarity + 0.5 * hash_similarity
+                max_similarity = np.maximum(max_similarity, similarity)
+
+            return [self.names[pool[i]] for i in chosen]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_reference_index(directory: str) -> ReferenceIndex:
+    """Индекс папки (один на процесс): загрузка с диска и инкрементальное обновление"""
+    key = os.path.abspath(directory)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = ReferenceIndex(directory)
+            index.load()
+            index.update()
+            _indexes[key] = index
+    return index
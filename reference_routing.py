@@ -0,0 +1,101 @@
+"""
+Маршрутизация промпта по декларативным правилам
+Правило = набор ключевых слов -> набор референсов и/или фрагмент промпта.
+Все ключевые слова компилируются в одно регулярное выражение с границами слов,
+поэтому классификация — один проход по тексту независимо от числа правил.
+
+Синтаксис ключевого слова:
+    "her"      — только целое слово (не совпадает с "other")
+    "девушк*"  — слово с этой основой (девушка, девушкой, девушки)
+"""
+
+import re
+from dataclasses import dataclass, field
+
+RULE_FIELDS = {"name", "keywords", "references", "prompt_fragment"}
+
+
+@dataclass
+class RouteMatch:
+    """Результат классификации промпта"""
+    rules: list = field(default_factory=list)         # имена сработавших правил по приоритету
+    references: list = None                           # None = набор референсов по умолчанию
+    prompt_fragments: list = field(default_factory=list)
+    keywords: list = field(default_factory=list)      # найденные в тексте слова
+
+    def matched(self, rule_name: str) -> bool:
+        return rule_name in self.rules
+
+
+def _normalize(text: str) -> str:
+    return text.casefold().replace('ё', 'е')
+
+
+class ReferenceRouter:
+    """Скомпилированный набор правил маршрутизации"""
+
+    def __init__(self, rules: list):
+        self.rules = []
+        self.exact = {}     # слово -> индексы правил
+        self.prefixes = {}  # основа -> индексы правил
+        alternatives = set()
+
+        for index, rule in enumerate(rules):
+            unknown = set(rule) - RULE_FIELDS
+            if unknown or "name" not in rule or not rule.get("keywords"):
+                raise ValueError(f"Invalid routing rule #{index}: {rule.get('name', '?')} {sorted(unknown)}")
+            self.rules.append(rule)
+
+            for keyword in rule["keywords"]:
+                word = _normalize(keyword.strip())
+                if word.endswith('*'):
+                    stem = word[:-1]
+                    self.prefixes.setdefault(stem, []).append(index)
+                    alternatives.add(re.escape(stem) + r'\w*')
+                else:
+                    self.exact.setdefault(word, []).append(index)
+                    alternatives.add(re.escape(word))
+
+        # Длинные варианты первыми — меньше откатов на словах с общим началом
+        pattern = '|'.join(sorted(alternatives, key=len, reverse=True))
+        self.pattern = re.compile(rf'(?<!\w)(?:{pattern})(?!\w)') if pattern else None
+        self.prefix_lengths = sorted({len(stem) for stem in self.prefixes}, reverse=True)
+        self.special_references = sorted({
+            ref for rule in self.rules for ref in (rule.get("references") or [])
+        })
+
+    def _rules_for_token(self, token: str) -> list:
+        indexes = list(self.exact.get(token, []))
+        for length in self.prefix_lengths:
+            if length <= len(token):
+                indexes.extend(self.prefixes.get(token[:length], []))
+        return indexes
+
+    def classify(self, text: str) -> RouteMatch:
+        """Один проход по тексту: сработавшие правила, референсы и фрагменты промпта"""
+        match = RouteMatch()
+        if not self.pattern or not text:
+            return match
+
+        hit = set()
+        for found in self.pattern.finditer(_normalize(text)):
+            token = found.group(0)
+            indexes = self._rules_for_token(token)
+            if indexes:
+                match.keywords.append(token)
+                hit.update(indexes)
+
+        for index in sorted(hit):
+            rule = self.rules[index]
+            match.rules.append(rule["name"])
+            if match.references is None and rule.get("references"):
+                match.references = list(rule["references"])
+            fragment = rule.get("prompt_fragment")
+            if fragment and fragment not in match.prompt_fragments:
+                match.prompt_fragments.append(fragment)
+        return match
+
+
+def compile_routing_rules(rules: list) -> ReferenceRouter:
+    """Компилирует декларативные правила в ReferenceRouter"""
+    return ReferenceRouter(rules)
@@ -0,0 +1,307 @@
+"""
+Запись и воспроизведение ответов внешних сервисов (Replicate, загрузка картинок, перевод)
+Режим задаётся переменной окружения REPLAY_MODE:
+    off         — обычные сетевые вызовы (по умолчанию)
+    record      — реальные вызовы + сохранение ответов и задержек в REPLAY_FIXTURES_DIR
+    replay      — ответы из фикстур с исходной задержкой
+    replay_fast — ответы из фикстур без задержки
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import requests
+from io import BytesIO, IOBase
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# КОНФИГУРАЦИЯ
+# =============================================================================
+
+REPLAY_MODES = ("off", "record", "replay", "replay_fast")
+REPLAY_FIXTURES_DIR = os.getenv("REPLAY_FIXTURES_DIR", "fixtures/replay")
+HTTP_TIMEOUT = 60  # Таймаут загрузки картинок в режимах off/record, секунды
+
+_write_lock = threading.Lock()
+
+
+class ReplayMissError(RuntimeError):
+    """В режиме воспроизведения нет записанного ответа для запроса"""
+
+
+# =============================================================================
+# СЛУЖЕБНЫЕ ФУНКЦИИ
+# =============================================================================
+
+def current_mode() -> str:
+    """Текущий режим (читается при каждом вызове, чтобы его можно было сменить без перезапуска)"""
+    mode = os.getenv("REPLAY_MODE", "off").strip().lower() or "off"
+    if mode not in REPLAY_MODES:
+        raise ValueError(f"Unknown REPLAY_MODE '{mode}', expected one of {REPLAY_MODES}")
+    return mode
+
+
+def _fixtures_dir(kind: str) -> Path:
+    return Path(os.getenv("REPLAY_FIXTURES_DIR", REPLAY_FIXTURES_DIR)) / kind
+
+
+def _canonical(value):
+    """Приводит вход к JSON-сериализуемому виду: файлы заменяются хешем содержимого"""
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, (IOBase, BytesIO)) or hasattr(value, 'read'):
+        position = value.tell() if hasattr(value, 'tell') else 0
+        value.seek(0)
+        data = value.read()
+        value.seek(position)
+        return {"sha256": hashlib.sha256(data).hexdigest()}
+    if isinstance(value, bytes):
+        return {"sha256": hashlib.sha256(value).hexdigest()}
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+def request_key(kind: str, payload) -> str:
+    """Стабильный ключ фикстуры для запроса"""
+    blob = json.dumps({"kind": kind, "payload": _canonical(payload)}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode()).hexdigest()[:40]
+
+
+def _write_atomic(path: Path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    temp_path.write_bytes(data)
+    os.replace(temp_path, path)
+
+
+def _save_entry(kind: str, key: str, entry: dict, blob: bytes = None):
+    with _write_lock:
+        if blob is not None:
+            _write_atomic(_fixtures_dir(kind) / f"{key}.bin", blob)
+        _write_atomic(_fixtures_dir(kind) / f"{key}.json",
+                      json.dumps(entry, ensure_ascii=False, indent=2).encode())
+
+
+def _load_entry(kind: str, key: str, description: str) -> dict:
+    path = _fixtures_dir(kind) / f"{key}.json"
+    if not path.exists():
+        raise ReplayMissError(
+            f"No recorded {kind} response for {description} (key {key}). "
+            f"Run once with REPLAY_MODE=record to capture it."
+        )
+    return json.loads(path.read_text())
+
+
+def _replay_delay(entry: dict):
+    if current_mode() == "replay":
+        time.sleep(entry.get("latency", 0))
+
+
+def _encode_output(output, blobs: dict):
+    """Переводит выход модели в JSON; бинарные файлы складываются в blobs"""
+    if hasattr(output, 'read'):
+        data = output.read()
+        digest = hashlib.sha256(data).hexdigest()[:40]
+        blobs[digest] = data
+        return {"type": "file", "blob": digest}
+    if hasattr(output, 'url') and callable(output.url):
+        return {"type": "value", "value": output.url()}
+    if isinstance(output, (list, tuple)) or hasattr(output, '__next__'):
+        return {"type": "list", "items": [_encode_output(item, blobs) for item in output]}
+    return {"type": "value", "value": output}
+
+
+def _decode_output(encoded: dict):
+    if encoded["type"] == "file":
+        return BytesIO((_fixtures_dir("blobs") / f"{encoded['blob']}.bin").read_bytes())
+    if encoded["type"] == "list":
+        return [_decode_output(item) for item in encoded["items"]]
+    return encoded["value"]
+
+
+# =============================================================================
+# ОБЁРТКИ ВНЕШНИХ ВЫЗОВОВ
+# =============================================================================
+
+PREDICTION_FIELDS = ("id", "status", "metrics", "created_at", "started_at", "completed_at")
+
+
+def _wait(prediction, info: dict):
+    from replicate.exceptions import ModelError
+
+    prediction.wait()
+    info.update({field: getattr(prediction, field, None) for field in PREDICTION_FIELDS})
+
+    if prediction.status in ("failed", "canceled"):
+        raise ModelError(prediction.error or prediction.status)
+    return prediction.output
+
+
+def _client(client):
+    """Клиент Replicate: переданный (например, из пула токенов) или модуль с клиентом по умолчанию"""
+    if client is not None:
+        return client
+    import replicate
+    return replicate
+
+
+def _predict(model: str, model_input: dict, info: dict, on_created=None, client=None):
+    """
+    То же, что replicate.run, но через predictions API: в info попадают id, статус и метрики предсказания
+    """
+    client = _client(client)
+    name, _, version_id = model.partition(':')
+    if version_id:
+        prediction = client.predictions.create(version=version_id, input=model_input)
+    else:
+        prediction = client.models.predictions.create(model=name, input=model_input)
+    info["id"] = prediction.id
+    if on_created is not None:
+        on_created(prediction.id)
+    return _wait(prediction, info)
+
+
+def run_model(model: str, model_input: dict, info: dict = None, on_created=None, client=None):
+    """
+    Вызов модели Replicate с поддержкой записи/воспроизведения
+    info (необязательно) заполняется данными предсказания: id, status, metrics, created_at...
+    on_created(id) вызывается сразу после создания предсказания, до ожидания результата
+    """
+    info = {} if info is None else info
+    mode = current_mode()
+    if mode == "off":
+        return _predict(model, model_input, info, on_created, client)
+
+    key = request_key("prediction", {"model": model, "input": model_input})
+    if mode == "record":
+        started = time.monotonic()
+        output = _predict(model, model_input, info, on_created, client)
+        blobs = {}
+        encoded = _encode_output(output, blobs)
+        latency = time.monotonic() - started
+        for digest, data in blobs.items():
+            with _write_lock:
+                _write_atomic(_fixtures_dir("blobs") / f"{digest}.bin", data)
+        _save_entry("predictions", key, {
+            "model": model,
+            "input": _canonical(model_input),
+            "latency": round(latency, 3),
+            "output": encoded,
+            "prediction": {field: info.get(field) for field in PREDICTION_FIELDS},
+            "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        })
+        logger.info(f"Recorded prediction {model} ({latency:.1f}s) -> {key}")
+        return _decode_output(encoded)
+
+    entry = _load_entry("predictions", key, f"model {model}")
+    info.update(entry.get("prediction") or {})
+    if on_created is not None and info.get("id"):
+        on_created(info["id"])
+    _replay_delay(entry)
+    return _decode_output(entry["output"])
+
+
+def resume_prediction(prediction_id: str, info: dict = None, client=None):
+    """
+    Дожидается уже созданного предсказания (например, после перезапуска) и возвращает его выход
+    В режимах воспроизведения ищет запись с этим id среди фикстур.
+    """
+    info = {} if info is None else info
+    if current_mode() in ("off", "record"):
+        return _wait(_client(client).predictions.get(prediction_id), info)
+
+    for path in sorted(_fixtures_dir("predictions").glob("*.json")):
+        entry = json.loads(path.read_text())
+        if (entry.get("prediction") or {}).get("id") == prediction_id:
+            info.update(entry["prediction"])
+            return _decode_output(entry["output"])
+    raise ReplayMissError(f"No recorded prediction with id {prediction_id}")
+
+
+def fetch_bytes(url: str, timeout: float = HTTP_TIMEOUT) -> bytes:
+    """HTTP GET картинки (выход модели) с поддержкой записи/воспроизведения"""
+    mode = current_mode()
+    if mode == "off":
+        response = requests.get(url, timeout=timeout)
+        response.raise_for_status()
+        return response.content
+
+    key = request_key("http", url)
+    if mode == "record":
+        started = time.monotonic()
+        response = requests.get(url, timeout=timeout)
+        response.raise_for_status()
+        latency = time.monotonic() - started
+        _save_entry("http", key, {
+            "url": url,
+            "latency": round(latency, 3),
+            "size": len(response.content),
+            "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }, blob=response.content)
+        return response.content
+
+    entry = _load_entry("http", key, f"GET {url}")
+    _replay_delay(entry)
+    return (_fixtures_dir("http") / f"{key}.bin").read_bytes()
+
+
+def fetch_to_file(url: str, path: str, timeout: float = HTTP_TIMEOUT, chunk_size: int = 1024 * 1024) -> int:
+    """
+    Скачивает файл потоком прямо на диск (целиком в памяти не держится); возвращает размер
+    В режимах записи/воспроизведения работает через fetch_bytes (фикстуры и так хранятся целиком).
+    """
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        if current_mode() == "off":
+            size = 0
+            with requests.get(url, timeout=timeout, stream=True) as response:
+                response.raise_for_status()
+                with open(temp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size):
+                        f.write(chunk)
+                        size += len(chunk)
+        else:
+            data = fetch_bytes(url, timeout)
+            size = len(data)
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+        os.replace(temp_path, path)
+        return size
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def translate(text: str, source: str = 'ru', target: str = 'en') -> str:
+    """GoogleTranslator.translate с поддержкой записи/воспроизведения"""
+    mode = current_mode()
+    if mode == "off":
+        from deep_translator import GoogleTranslator
+        return GoogleTranslator(source=source, target=target).translate(text)
+
+    key = request_key("translation", {"text": text, "source": source, "target": target})
+    if mode == "record":
+        from deep_translator import GoogleTranslator
+        started = time.monotonic()
+        translated = GoogleTranslator(source=source, target=target).translate(text)
+        _save_entry("translations", key, {
+            "text": text,
+            "source": source,
+            "target": target,
+            "latency": round(time.monotonic() - started, 3),
+            "translated": translated,
+            "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        })
+        return translated
+
+    entry = _load_entry("translations", key, f"translation of '{text}'")
+    _replay_delay(entry)
+    return entry["translated"]
@@ -0,0 +1,157 @@
+"""
+Дедупликация запросов
+- SingleFlight: одинаковые запросы, пришедшие пока первый ещё выполняется, ждут его результат
+- RecentUpdateIds: помнит последние update_id Telegram, чтобы повторная доставка не обрабатывалась
+- PerChatUpdateProcessor: апдейты разных диалогов обрабатываются параллельно, одного пользователя в чате — по порядку
+"""
+
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+UNLIMITED_UPDATES = 2 ** 31 - 1  # лимит для семафора PTB (см. PerChatUpdateProcessor)
+
+
+class SingleFlight:
+    """Объединение одинаковых запросов в полёте (asyncio)"""
+
+    def __init__(self, linger: float = 0.0):
+        # linger: сколько секунд успешный результат ещё отдаётся повторам
+        # (апдейты одного чата идут по очереди, поэтому дубль пользователя приходит после первого)
+        self.linger = linger
+        self._in_flight = {}
+        self._recent = OrderedDict()  # ключ -> (время завершения, задача)
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    def recent_results(self) -> list:
+        """Результаты, которые ещё держатся для повторов (устаревшие удаляются только при следующем do)"""
+        return [task.result() for _, task in list(self._recent.values())]
+
+    def _finished(self, key: str, task: asyncio.Future):
+        self._in_flight.pop(key, None)
+        if self.linger > 0 and not task.cancelled() and task.exception() is None:
+            self._recent[key] = (time.monotonic(), task)
+
+    def _recent_task(self, key: str):
+        deadline = time.monotonic() - self.linger
+        while self._recent:
+            finished_at, _ = next(iter(self._recent.values()))
+            if finished_at >= deadline:
+                break
+            self._recent.popitem(last=False)
+        entry = self._recent.get(key)
+        return entry[1] if entry else None
+
+    async def do(self, key: str, factory):
+        """
+        Выполняет factory() один раз на ключ; параллельные вызовы с тем же ключом
+        получают тот же результат (или то же исключение)
+        """
+        task = self._in_flight.get(key) or self._recent_task(key)
+        if task is None:
+            # Отдельная задача: отмена первого вызывающего не отменяет работу для остальных
+            task = asyncio.ensure_future(factory())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        else:
+            self.coalesced += 1
+            logger.info(f"Coalesced duplicate request {key[:32]}")
+        return await asyncio.shield(task)
+
+
+class RecentUpdateIds:
+    """Ограниченное множество недавно обработанных update_id"""
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+        self.dropped = 0
+
+    def seen(self, update_id: int) -> bool:
+        """True, если update_id уже встречался; иначе запоминает его"""
+        if update_id in self._ids:
+            self.dropped += 1
+            return True
+        self._ids[update_id] = None
+        if len(self._ids) > self.maxsize:
+            self._ids.popitem(last=False)
+        return False
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка апдейтов с сохранением порядка внутри диалога (чат + пользователь)
+    ConversationHandler сохраняет новое состояние только после возврата обработчика,
+    поэтому следующее сообщение того же пользователя нельзя начинать раньше.
+    Слот из max_concurrent_updates занимается только после замка диалога: пользователь,
+    присылающий сообщения во время своей генерации, не держит слоты, нужные остальным.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        # Семафор PTB берётся до do_process_update, то есть до ожидания замка диалога,
+        # поэтому он фактически снят, а лимит держит собственный семафор
+        super().__init__(UNLIMITED_UPDATES)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}
+        self.waiting = 0  # апдейты, ждущие замка диалога или свободного слота
+
+    @staticmethod
+    def _conversation_key(update):
+        """(чат, пользователь) — как ключ диалога ConversationHandler (per_chat и per_user)
+        В группе генерация одного участника не задерживает сообщения остальных"""
+        chat = getattr(update, "effective_chat", None)
+        user = getattr(update, "effective_user", None)
+        if chat is None and user is None:
+            return None
+        return (chat.id if chat is not None else None, user.id if user is not None else None)
+
+    async def _run(self, coroutine):
+        """Ждёт свободный слот и обрабатывает апдейт"""
+        try:
+            await self._slots.acquire()
+        finally:
+            # Слот получен или ожидание отменено — апдейт больше не ждёт
+            self.waiting -= 1
+        try:
+            await coroutine
+        finally:
+            self._slots.release()
+
+    async def do_process_update(self, update, coroutine):
+        key = self._conversation_key(update)
+        self.waiting += 1
+        if key is None:
+            await self._run(coroutine)
+            return
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])  # [замок, сколько апдейтов его держат/ждут]
+        entry[1] += 1
+        try:
+            try:
+                await entry[0].acquire()
+            except BaseException:
+                self.waiting -= 1
+                raise
+            try:
+                await self._run(coroutine)
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            # Замок больше никому не нужен — убираем, чтобы словарь не рос с числом диалогов
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
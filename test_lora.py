@@ -4,16 +4,21 @@
 """
 
 import os
-import replicate
-from PIL import Image
-import requests
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageDraw, ImageFont
 from io import BytesIO
+import replay
+from usage_stats import percentile
 
 # =============================================================================
 # КОНФИГУРАЦИЯ
 # =============================================================================
 
-REPLICATE_API_TOKEN = "YOUR_REPLICATE_TOKEN"
+REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN", "YOUR_REPLICATE_TOKEN")
 LORA_MODEL = "your-username/samurai-badge-lora"
 TRIGGER_WORD = "aidbox_samurai_style"
 
@@ -26,10 +31,27 @@ TEST_PROMPTS = [
     "telescope",
 ]
 
+# Оценка: все промпты параллельно, отчёт и контактный лист
+EVAL_CONCURRENCY = 5          # Одновременных генераций (обычно = числу промптов)
+EVAL_OUTPUT_DIR = "test_results/eval"
+EVAL_DOWNLOAD_TIMEOUT = 60    # Секунды на скачивание одного результата
+CONTACT_SHEET_THUMB = 384     # Сторона миниатюры в контактном листе, px
+FONT_PATH = "fonts/Golos-Text_Bold.ttf"
+
 # =============================================================================
 # ФУНКЦИИ ТЕСТИРОВАНИЯ
 # =============================================================================
 
+def lora_input(prompt: str) -> dict:
+    """Вход модели для тестового промпта"""
+    return {
+        "prompt": f"{TRIGGER_WORD}, samurai warrior badge, character holding {prompt}, cartoon illustration, white background",
+        "negative_prompt": "text, letters, words, signature, realistic",
+        "num_inference_steps": 30,
+        "guidance_scale": 7.5,
+    }
+
+
 def test_lora_generation(prompt: str, save_path: str = None) -> bool:
     """
     Тестирует генерацию одного изображения
@@ -37,25 +59,14 @@ def test_lora_generation(prompt: str, save_path: str = None) -> bool:
     try:
         print(f"\n🎨 Генерирую: {prompt}")
         
-        full_prompt = f"{TRIGGER_WORD}, samurai warrior badge, character holding {prompt}, cartoon illustration, white background"
-        
-        output = replicate.run(
-            LORA_MODEL,
-            input={
-                "prompt": full_prompt,
-                "negative_prompt": "text, letters, words, signature, realistic",
-                "num_inference_steps": 30,
-                "guidance_scale": 7.5,
-            }
-        )
+        output = replay.run_model(LORA_MODEL, lora_input(prompt))
         
         image_url = output[0] if isinstance(output, list) else output
         print(f"✅ Изображение сгенерировано: {image_url}")
         
         # Загружаем и сохраняем
         if save_path:
-            response = requests.get(image_url)
-            img = Image.open(BytesIO(response.content))
+            img = Image.open(BytesIO(replay.fetch_bytes(image_url)))
             img.save(save_path)
             print(f"💾 Сохранено в: {save_path}")
         
@@ -168,15 +179,174 @@ def interactive_test():
         counter += 1
 
 
+# =============================================================================
+# ОЦЕНКА (ПАРАЛЛЕЛЬНО)
+# =============================================================================
+
+def _slug(prompt: str) -> str:
+    return "".join(c if c.isalnum() else "_" for c in prompt.lower()).strip("_")[:40] or "prompt"
+
+
+def evaluate_prompt(index: int, prompt: str, model: str, output_dir: str) -> dict:
+    """Одна генерация: время модели и скачивания, размер результата; ошибки попадают в запись"""
+    entry = {"index": index, "prompt": prompt, "status": "failed"}
+    started = time.perf_counter()
+    try:
+        info = {}
+        output = replay.run_model(model, lora_input(prompt), info=info)
+        entry["generate_seconds"] = round(time.perf_counter() - started, 3)
+        entry["prediction_id"] = info.get("id")
+        entry["predict_time"] = (info.get("metrics") or {}).get("predict_time")
+
+        output = output[0] if isinstance(output, list) else output
+        downloaded = time.perf_counter()
+        if hasattr(output, 'read'):
+            data = output.read()
+            path = os.path.join(output_dir, f"{index:02d}_{_slug(prompt)}.png")
+            with open(path, 'wb') as f:
+                f.write(data)
+            entry["output_bytes"] = len(data)
+        else:
+            url = output.url() if callable(getattr(output, 'url', None)) else str(output)
+            extension = os.path.splitext(url.split('?')[0])[1] or ".png"
+            path = os.path.join(output_dir, f"{index:02d}_{_slug(prompt)}{extension}")
+            entry["url"] = url
+            entry["output_bytes"] = replay.fetch_to_file(url, path, timeout=EVAL_DOWNLOAD_TIMEOUT)
+        entry["download_seconds"] = round(time.perf_counter() - downloaded, 3)
+        with Image.open(path) as img:
+            entry.update(path=path, width=img.width, height=img.height, format=img.format)
+        entry["status"] = "succeeded"
+    except Exception as e:
+        entry["error"] = f"{type(e).__name__}: {e}"
+    entry["total_seconds"] = round(time.perf_counter() - started, 3)
+    return entry
+
+
+def make_contact_sheet(entries: list, path: str, thumb: int = CONTACT_SHEET_THUMB) -> str:
+    """Все результаты одной картинкой: миниатюры с промптом и временем генерации"""
+    columns = min(len(entries), 5) or 1
+    rows = (len(entries) + columns - 1) // columns
+    caption = 28
+    sheet = Image.new('RGB', (columns * thumb, rows * (thumb + caption)), (255, 255, 255))
+    draw = ImageDraw.Draw(sheet)
+    try:
+        font = ImageFont.truetype(FONT_PATH, 16)
+    except OSError:
+        font = ImageFont.load_default()
+    for position, entry in enumerate(entries):
+        x, y = (position % columns) * thumb, (position // columns) * (thumb + caption)
+        if entry["status"] == "succeeded":
+            with Image.open(entry["path"]) as img:
+                img.thumbnail((thumb, thumb), Image.LANCZOS)
+                tile = img.convert('RGBA')
+                sheet.paste(tile, (x + (thumb - tile.width) // 2, y + (thumb - tile.height) // 2), tile)
+            label = f"{entry['prompt']} · {entry['total_seconds']:.1f}s"
+        else:
+            draw.rectangle((x + 4, y + 4, x + thumb - 4, y + thumb - 4), outline=(220, 60, 60), width=3)
+            label = f"{entry['prompt']} · failed"  # шрифт по умолчанию без кириллицы
+        draw.text((x + 8, y + thumb + 4), label, fill=(0, 0, 0), font=font)
+    sheet.save(path, format='JPEG', quality=90)
+    return path
+
+
+def evaluate_lora(prompts: list = None, model: str = None, concurrency: int = EVAL_CONCURRENCY,
+                  output_dir: str = EVAL_OUTPUT_DIR) -> dict:
+    """
+    Прогоняет промпты с ограниченной параллельностью
+    Пишет отчёт eval_report.json (время и размер по каждому промпту) и контактный лист contact_sheet.jpg.
+    """
+    prompts = prompts or TEST_PROMPTS
+    model = model or LORA_MODEL
+    os.makedirs(output_dir, exist_ok=True)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="lora-eval") as pool:
+        futures = [pool.submit(evaluate_prompt, index, prompt, model, output_dir)
+                   for index, prompt in enumerate(prompts, 1)]
+        entries = []
+        for future in futures:
+            entry = future.result()
+            icon = "✅" if entry["status"] == "succeeded" else "❌"
+            print(f"   {icon} [{entry['index']}/{len(prompts)}] {entry['prompt']}: {entry['total_seconds']:.1f}s"
+                  + (f", {entry['output_bytes'] / 1024:.0f} KB" if entry.get("output_bytes") else "")
+                  + (f" — {entry['error']}" if entry.get("error") else ""))
+            entries.append(entry)
+    wall = time.perf_counter() - started
+
+    succeeded = [entry for entry in entries if entry["status"] == "succeeded"]
+    latencies = [entry["total_seconds"] for entry in succeeded]
+    report = {
+        "model": model,
+        "replay_mode": replay.current_mode(),
+        "concurrency": concurrency,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "summary": {
+            "prompts": len(entries),
+            "succeeded": len(succeeded),
+            "wall_seconds": round(wall, 2),
+            "sequential_seconds": round(sum(entry["total_seconds"] for entry in entries), 2),
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95),
+            "output_bytes_avg": round(sum(entry["output_bytes"] for entry in succeeded) / len(succeeded))
+            if succeeded else None,
+        },
+        "prompts": entries,
+    }
+    if entries:
+        report["contact_sheet"] = make_contact_sheet(entries, os.path.join(output_dir, "contact_sheet.jpg"))
+    with open(os.path.join(output_dir, "eval_report.json"), 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def run_evaluation(model: str = None, concurrency: int = EVAL_CONCURRENCY, prompts: list = None) -> bool:
+    """Оценка с проверкой конфигурации и итоговой сводкой"""
+    model = model or LORA_MODEL
+    if replay.current_mode() in ("off", "record"):
+        if REPLICATE_API_TOKEN == "YOUR_REPLICATE_TOKEN":
+            print("\n❌ Установите REPLICATE_API_TOKEN!")
+            return False
+        if model == "your-username/samurai-badge-lora":
+            print("\n❌ Установите правильное имя LORA_MODEL!")
+            return False
+        os.environ["REPLICATE_API_TOKEN"] = REPLICATE_API_TOKEN
+
+    prompts = prompts or TEST_PROMPTS
+    print(f"\n🧪 Оценка {model}: {len(prompts)} промптов, параллельно {concurrency}")
+    report = evaluate_lora(prompts, model, concurrency)
+    summary = report["summary"]
+    print(f"\n⏱  {summary['wall_seconds']}s вместо {summary['sequential_seconds']}s по очереди; "
+          f"p50 {summary['latency_p50']}s, p95 {summary['latency_p95']}s")
+    print(f"✅ Успешно: {summary['succeeded']}/{summary['prompts']}")
+    if report.get("contact_sheet"):
+        print(f"🖼  Контактный лист: {report['contact_sheet']}")
+    print(f"📝 Отчёт: {os.path.join(EVAL_OUTPUT_DIR, 'eval_report.json')}")
+    return summary["succeeded"] == summary["prompts"]
+
+
 # =============================================================================
 # ГЛАВНОЕ МЕНЮ
 # =============================================================================
 
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Тестирование LoRA модели")
+    parser.add_argument("--eval", action="store_true", help="Оценка без меню: все промпты параллельно")
+    parser.add_argument("--model", help=f"Модель (по умолчанию {LORA_MODEL})")
+    parser.add_argument("--concurrency", type=int, default=EVAL_CONCURRENCY)
+    parser.add_argument("--prompts", help="Файл с промптами, по одному в строке")
+    args = parser.parse_args(argv)
+
+    if args.eval:
+        prompts = None
+        if args.prompts:
+            with open(args.prompts) as f:
+                prompts = [line.strip() for line in f if line.strip()]
+        return 0 if run_evaluation(args.model, args.concurrency, prompts) else 1
+
     print("\n📋 Выберите режим тестирования:")
     print("1. Автоматический тест (5 предустановленных промптов)")
     print("2. Интерактивный тест (вводите свои промпты)")
     print("3. Быстрая проверка (1 тест)")
+    print("4. Оценка: все промпты параллельно, отчёт и контактный лист")
     print("0. Выход")
     
     choice = input("\nВаш выбор: ").strip()
@@ -189,6 +359,8 @@ def main():
         os.environ["REPLICATE_API_TOKEN"] = REPLICATE_API_TOKEN
         os.makedirs("test_results", exist_ok=True)
         test_lora_generation("magnifying glass", "test_results/quick_test.png")
+    elif choice == "4":
+        run_evaluation()
     elif choice == "0":
         print("👋 До встречи!")
     else:
@@ -196,4 +368,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -4,32 +4,59 @@
 """
 
 import os
-import zipfile
 import replicate
 from pathlib import Path
 
+from training_data import (
+    prepare_training_images, prepared_files, print_report, TRAINING_CACHE_DIR, TRAINING_RESOLUTION,
+)
+from training_archive import build_training_archive, print_diff
+from artifact_store import upload_artifact, ARTIFACT_SERVER_URL
+from training_dedup import find_near_duplicates, print_duplicates, DEDUP_PHASH_THRESHOLD
+
 # =============================================================================
 # КОНФИГУРАЦИЯ
 # =============================================================================
 
-REPLICATE_API_TOKEN = "YOUR_REPLICATE_TOKEN"  # Ваш токен от replicate.com
+REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN", "YOUR_REPLICATE_TOKEN")  # Ваш токен от replicate.com
 MODEL_NAME = "samurai-badge-lora"  # Название вашей модели
 TRIGGER_WORD = "aidbox_samurai_style"  # Уникальное слово-триггер
 
 # Папка с обучающими изображениями
 TRAINING_IMAGES_DIR = "./training_images"
 
+# Подготовленные копии (проверенные, приведённые к разрешению тренера JPEG) и отчёт по файлам
+PREPARED_IMAGES_DIR = TRAINING_CACHE_DIR
+
+# Почти-дубли (одинаковые кадры в разном качестве, пересланные несколько раз фото)
+DEDUP_ENABLED = True
+DEDUP_DROP_DUPLICATES = True   # Исключать лишние копии из архива (исходные файлы не трогаются)
+DEDUP_THRESHOLD = DEDUP_PHASH_THRESHOLD
+
 # Параметры обучения
 TRAINING_STEPS = 1000
 LEARNING_RATE = 0.0004
+TRAINER_VERSION = "ostris/flux-dev-lora-trainer:4ffd32160efd92e956d39c5338a9b8fbafca58e03f791f6d8011f3e20e8ea6fa"
 
 # =============================================================================
 # ФУНКЦИИ
 # =============================================================================
 
+def training_files(report: dict) -> list:
+    """Файлы для архива: годные подготовленные изображения без лишних почти-дублей"""
+    exclude = ()
+    if DEDUP_ENABLED:
+        duplicates = find_near_duplicates(report, DEDUP_THRESHOLD)
+        print_duplicates(duplicates)
+        if DEDUP_DROP_DUPLICATES:
+            exclude = set(duplicates["drop"])
+    return prepared_files(report, exclude=exclude)
+
+
 def validate_images(images_dir: str) -> bool:
     """
     Проверяет наличие и корректность обучающих изображений
+    Каждый файл декодируется целиком (параллельно), годные приводятся к разрешению тренера.
     """
     images_path = Path(images_dir)
     
@@ -38,43 +65,44 @@ def validate_images(images_dir: str) -> bool:
         print(f"Создайте папку и добавьте туда 15-25 изображений.")
         return False
     
-    # Поддерживаемые форматы
-    valid_extensions = {'.png', '.jpg', '.jpeg', '.webp'}
-    images = [f for f in images_path.iterdir() 
-              if f.is_file() and f.suffix.lower() in valid_extensions]
+    report = prepare_training_images(images_dir, PREPARED_IMAGES_DIR, resolution=TRAINING_RESOLUTION)
+    print_report(report)
+    images = training_files(report)
     
     if len(images) < 10:
-        print(f"⚠️  Найдено только {len(images)} изображений.")
+        print(f"⚠️  Годных изображений только {len(images)}.")
         print(f"Рекомендуется минимум 15 изображений для хорошего результата.")
         return False
     
-    print(f"✅ Найдено {len(images)} изображений для обучения:")
-    for img in sorted(images)[:5]:
-        print(f"   - {img.name}")
-    if len(images) > 5:
-        print(f"   ... и ещё {len(images) - 5}")
+    if len(images) < report["summary"]["total"]:
+        print(f"⚠️  {report['summary']['total'] - len(images)} файлов не попадут в обучение (см. отчёт выше)")
     
+    print(f"✅ Готово к обучению: {len(images)} изображений")
     return True
 
 
 def create_training_archive(images_dir: str, output_zip: str = "training_data.zip") -> str:
     """
-    Создаёт ZIP архив с обучающими изображениями
+    Создаёт ZIP архив с подготовленными обучающими изображениями
     """
     print(f"\n📦 Создаю архив {output_zip}...")
     
-    images_path = Path(images_dir)
-    valid_extensions = {'.png', '.jpg', '.jpeg', '.webp'}
-    images = [f for f in images_path.iterdir() 
-              if f.is_file() and f.suffix.lower() in valid_extensions]
+    # Неизменённые файлы берутся из кеша подготовки
+    report = prepare_training_images(images_dir, PREPARED_IMAGES_DIR, resolution=TRAINING_RESOLUTION)
+    images = training_files(report)
     
-    with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for img in images:
-            zipf.write(img, arcname=img.name)
+    # Архив пересобирается, только если изменилось содержимое набора
+    result = build_training_archive(images, output_zip)
     
-    file_size = os.path.getsize(output_zip) / (1024 * 1024)  # MB
-    print(f"✅ Архив создан: {output_zip} ({file_size:.1f} MB)")
-    print(f"📸 Упаковано изображений: {len(images)}")
+    file_size = result["archive_bytes"] / (1024 * 1024)  # MB
+    if result["built"]:
+        print(f"✅ Архив создан: {output_zip} ({file_size:.1f} MB)")
+    else:
+        print(f"✅ Набор не изменился, архив актуален: {output_zip} ({file_size:.1f} MB)")
+    print(f"📸 Упаковано изображений: {len(images)}, версия набора {result['dataset_hash'][:12]}")
+    if result["diff"] and result["built"]:
+        print(f"🔀 Изменения с версии {result['previous_hash'][:12]}:")
+        print_diff(result["diff"])
     
     return output_zip
 
@@ -84,9 +112,20 @@ def upload_to_replicate(zip_path: str) -> str:
     Загружает архив на Replicate и возвращает URL
     
     Примечание: Replicate не предоставляет прямой upload API для обучающих данных.
-    Вам нужно загрузить архив на любой файловый хостинг (Google Drive, Dropbox, etc)
-    и получить прямую ссылку для скачивания.
+    Если задан ARTIFACT_SERVER_URL, архив загружается частями в хранилище артефактов
+    (artifact_store.py) и ссылка возвращается сразу. Иначе архив нужно загрузить
+    на любой файловый хостинг (Google Drive, Dropbox, etc) и получить прямую ссылку.
     """
+    if ARTIFACT_SERVER_URL:
+        print(f"\n📤 Загружаю {zip_path} в хранилище {ARTIFACT_SERVER_URL}...")
+        try:
+            zip_url = upload_artifact(zip_path)
+            print(f"✅ Архив загружен и проверен: {zip_url}")
+            return zip_url
+        except Exception as e:
+            print(f"❌ Не удалось загрузить архив: {e}")
+            print(f"Можно загрузить вручную:")
+    
     print(f"\n⚠️  ВАЖНО: Загрузите {zip_path} на файловый хостинг")
     print(f"\nВарианты:")
     print(f"1. Google Drive:")
@@ -111,34 +150,38 @@ def upload_to_replicate(zip_path: str) -> str:
     return zip_url
 
 
-def start_training(training_images_url: str) -> replicate.Training:
+def start_training(training_images_url: str, steps: int = None, learning_rate: float = None,
+                   destination: str = None) -> replicate.training.Training:
     """
     Запускает процесс обучения LoRA на Replicate
+    steps / learning_rate / destination по умолчанию берутся из конфигурации
     """
+    steps = steps or TRAINING_STEPS
+    learning_rate = learning_rate or LEARNING_RATE
+    destination = destination or MODEL_NAME
     print(f"\n🚀 Запускаю обучение LoRA...")
     print(f"📊 Параметры:")
-    print(f"   - Модель: {MODEL_NAME}")
+    print(f"   - Модель: {destination}")
     print(f"   - Trigger word: {TRIGGER_WORD}")
-    print(f"   - Steps: {TRAINING_STEPS}")
-    print(f"   - Learning rate: {LEARNING_RATE}")
+    print(f"   - Steps: {steps}")
+    print(f"   - Learning rate: {learning_rate}")
     
     # Устанавливаем API токен
     os.environ["REPLICATE_API_TOKEN"] = REPLICATE_API_TOKEN
     
     try:
-        # Получаем username из API
         client = replicate.Client(api_token=REPLICATE_API_TOKEN)
         
         # Запускаем обучение
-        training = replicate.trainings.create(
-            version="ostris/flux-dev-lora-trainer:4ffd32160efd92e956d39c5338a9b8fbafca58e03f791f6d8011f3e20e8ea6fa",
+        training = client.trainings.create(
+            version=TRAINER_VERSION,
             input={
                 "input_images": training_images_url,
                 "trigger_word": TRIGGER_WORD,
-                "steps": TRAINING_STEPS,
-                "learning_rate": LEARNING_RATE,
+                "steps": steps,
+                "learning_rate": learning_rate,
             },
-            destination=f"{MODEL_NAME}"  # Replicate автоматически добавит ваш username
+            destination=destination  # Replicate автоматически добавит ваш username
         )
         
         print(f"\n✅ Обучение запущено!")
@@ -0,0 +1,256 @@
+"""
+Серия обучений LoRA по сетке параметров без интерактивного меню
+Запускает start_training для каждой пары TRAINING_STEPS × LEARNING_RATE, затем следит за всеми
+обучениями одновременно (asyncio, опрос с нарастающим интервалом) и записывает статусы, длительность
+и итоговую версию модели в файл результатов. Прерванное наблюдение продолжается флагом --watch.
+
+    python train_sweep.py --images-url https://.../training_data.zip --steps 500,1000,1500 --learning-rates 0.0002,0.0004
+    python train_sweep.py --archive training_data.zip --steps 500,1000    # загрузить через ARTIFACT_SERVER_URL
+    python train_sweep.py --watch          # продолжить наблюдение за незавершёнными обучениями
+    python train_sweep.py --summary        # таблица результатов
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import itertools
+
+import replicate
+
+import train_lora
+from usage_stats import parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# КОНФИГУРАЦИЯ
+# =============================================================================
+
+SWEEP_RESULTS_PATH = os.getenv("SWEEP_RESULTS_PATH", "data/training_sweeps.json")
+POLL_MIN_INTERVAL = 15       # Первый опрос и опрос после смены статуса (секунды)
+POLL_MAX_INTERVAL = 300      # Дольше 5 минут не ждём: обучение идёт 30-60 минут
+POLL_BACKOFF = 1.5           # Интервал растёт, пока статус не меняется
+POLL_JITTER = 0.1            # ±10%, чтобы опросы разных обучений не шли пачкой
+WATCH_TIMEOUT = 6 * 3600     # Дольше не ждём; --watch продолжит позже
+FINISHED_STATUSES = ("succeeded", "failed", "canceled")
+
+# =============================================================================
+# ФАЙЛ РЕЗУЛЬТАТОВ
+# =============================================================================
+
+def load_results(path: str) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"runs": []}
+
+
+def save_results(path: str, results: dict):
+    """Пишется после каждого изменения атомарно: прерывание не теряет id запущенных обучений"""
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, path)
+
+
+def _seconds(start, end):
+    start, end = parse_timestamp(start), parse_timestamp(end)
+    if start is None or end is None:
+        return None
+    return round(max(0.0, (end - start).total_seconds()), 1)
+
+
+def apply_training(run: dict, training) -> bool:
+    """Переносит состояние обучения Replicate в запись; True, если что-то изменилось"""
+    output = training.output if isinstance(training.output, dict) else {}
+    update = {
+        "status": training.status,
+        "created_at": str(training.created_at) if training.created_at else None,
+        "started_at": str(training.started_at) if training.started_at else None,
+        "completed_at": str(training.completed_at) if training.completed_at else None,
+        "destination": output.get("version") or run.get("destination"),
+        "weights": output.get("weights"),
+        "error": str(training.error) if training.error else None,
+    }
+    update["queue_seconds"] = _seconds(update["created_at"], update["started_at"])
+    update["train_seconds"] = _seconds(update["started_at"], update["completed_at"])
+    update["total_seconds"] = _seconds(update["created_at"], update["completed_at"])
+    changed = any(run.get(key) != value for key, value in update.items())
+    run.update(update)
+    return changed
+
+# =============================================================================
+# ЗАПУСК
+# =============================================================================
+
+def parse_grid(value: str, cast) -> list:
+    return [cast(item) for item in value.split(',') if item.strip()]
+
+
+def launch_sweep(images_url: str, steps: list, learning_rates: list, destination: str = None,
+                 results_path: str = SWEEP_RESULTS_PATH) -> list:
+    """Запускает обучение для каждой пары параметров; возвращает записи запущенных"""
+    results = load_results(results_path)
+    sweep_id = time.strftime("%Y%m%d-%H%M%S")
+    runs = []
+    for run_steps, learning_rate in itertools.product(steps, learning_rates):
+        run = {
+            "sweep": sweep_id,
+            "id": None,
+            "steps": run_steps,
+            "learning_rate": learning_rate,
+            "images_url": images_url,
+            "destination": destination or train_lora.MODEL_NAME,
+            "launched_at": time.time(),
+            "status": "launching",
+        }
+        training = train_lora.start_training(images_url, steps=run_steps, learning_rate=learning_rate,
+                                             destination=destination)
+        if training is None:
+            run["status"] = "launch_failed"
+        else:
+            run["id"] = training.id
+            apply_training(run, training)
+        results["runs"].append(run)
+        save_results(results_path, results)
+        runs.append(run)
+    return runs
+
+# =============================================================================
+# НАБЛЮДЕНИЕ
+# =============================================================================
+
+async def watch_run(client, run: dict, results: dict, results_path: str, deadline: float,
+                    poll_min: float = POLL_MIN_INTERVAL, poll_max: float = POLL_MAX_INTERVAL):
+    """Опрашивает одно обучение до завершения или дедлайна; интервал растёт, пока ничего не меняется"""
+    interval = poll_min
+    while run["status"] not in FINISHED_STATUSES and time.monotonic() < deadline:
+        await asyncio.sleep(min(interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER),
+                                max(0.0, deadline - time.monotonic())))
+        try:
+            training = await client.trainings.async_get(run["id"])
+        except Exception as e:
+            # Сеть или 5xx: обучение идёт и без нас, просто спросим позже
+            logger.warning(f"Training {run['id']} status check failed: {e}")
+            interval = min(poll_max, interval * POLL_BACKOFF)
+            continue
+        run["polls"] = run.get("polls", 0) + 1
+        previous = run["status"]
+        if apply_training(run, training):
+            save_results(results_path, results)
+        if run["status"] != previous:
+            print(f"   {_status_icon(run['status'])} {run['id']} "
+                  f"(steps={run['steps']}, lr={run['learning_rate']}): {previous} → {run['status']}")
+            interval = poll_min
+        else:
+            interval = min(poll_max, interval * POLL_BACKOFF)
+
+
+async def watch_runs(runs: list, results: dict, results_path: str, timeout: float = WATCH_TIMEOUT,
+                     poll_min: float = POLL_MIN_INTERVAL, poll_max: float = POLL_MAX_INTERVAL):
+    """Следит за всеми обучениями одновременно"""
+    client = replicate.Client(api_token=train_lora.REPLICATE_API_TOKEN)
+    deadline = time.monotonic() + timeout
+    watched = [run for run in runs if run.get("id") and run["status"] not in FINISHED_STATUSES]
+    print(f"\n👀 Слежу за {len(watched)} обучениями (опрос {poll_min:g}–{poll_max:g} с)")
+    await asyncio.gather(*(
+        watch_run(client, run, results, results_path, deadline, poll_min, poll_max) for run in watched
+    ))
+
+# =============================================================================
+# ОТЧЁТ
+# =============================================================================
+
+def _status_icon(status: str) -> str:
+    return {"succeeded": "✅", "failed": "❌", "canceled": "⛔", "launch_failed": "❌"}.get(status, "⏳")
+
+
+def _minutes(seconds) -> str:
+    return f"{seconds / 60:.1f} мин" if seconds is not None else "—"
+
+
+def print_summary(runs: list):
+    print(f"\n📊 Результаты ({len(runs)} обучений):")
+    for run in sorted(runs, key=lambda item: (item.get("sweep", ""), item["steps"], item["learning_rate"])):
+        print(f"   {_status_icon(run['status'])} steps={run['steps']:<5} lr={run['learning_rate']:<8} "
+              f"{run['status']:<10} обучение {_minutes(run.get('train_seconds'))}, "
+              f"всего {_minutes(run.get('total_seconds'))}  {run.get('destination') or ''}")
+        if run.get("error"):
+            print(f"      {run['error']}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Серия обучений LoRA по сетке параметров")
+    parser.add_argument("--images-url", help="Прямая ссылка на архив с обучающими изображениями")
+    parser.add_argument("--archive", help="Локальный архив: загрузить в хранилище артефактов (ARTIFACT_SERVER_URL)")
+    parser.add_argument("--steps", default=str(train_lora.TRAINING_STEPS), help="Значения steps через запятую")
+    parser.add_argument("--learning-rates", default=str(train_lora.LEARNING_RATE),
+                        help="Значения learning rate через запятую")
+    parser.add_argument("--destination", help=f"Модель для весов (по умолчанию {train_lora.MODEL_NAME})")
+    parser.add_argument("--results", default=SWEEP_RESULTS_PATH, help="Файл результатов (JSON)")
+    parser.add_argument("--watch", action="store_true", help="Только следить за незавершёнными обучениями")
+    parser.add_argument("--summary", action="store_true", help="Только показать результаты")
+    parser.add_argument("--no-watch", action="store_true", help="Запустить и не ждать")
+    parser.add_argument("--dry-run", action="store_true", help="Показать сетку и ничего не запускать")
+    parser.add_argument("--timeout", type=float, default=WATCH_TIMEOUT / 3600, help="Сколько часов следить")
+    parser.add_argument("--poll-min", type=float, default=POLL_MIN_INTERVAL)
+    parser.add_argument("--poll-max", type=float, default=POLL_MAX_INTERVAL)
+    args = parser.parse_args(argv)
+
+    if args.summary:
+        print_summary(load_results(args.results)["runs"])
+        return 0
+
+    if train_lora.REPLICATE_API_TOKEN == "YOUR_REPLICATE_TOKEN":
+        print("❌ Установите REPLICATE_API_TOKEN в окружении!")
+        return 1
+
+    if args.watch:
+        results = load_results(args.results)
+        runs = results["runs"]
+    else:
+        if args.archive and not args.dry_run:
+            from artifact_store import upload_artifact
+            try:
+                args.images_url = upload_artifact(args.archive)
+            except Exception as e:
+                print(f"❌ Не удалось загрузить архив: {e}")
+                return 1
+            print(f"📤 Архив загружен: {args.images_url}")
+        if not args.dry_run and (not args.images_url or not args.images_url.startswith('http')):
+            print("❌ Укажите --images-url с прямой ссылкой на архив или --archive")
+            return 1
+        grid = list(itertools.product(parse_grid(args.steps, int), parse_grid(args.learning_rates, float)))
+        print(f"🧪 Сетка: {len(grid)} обучений")
+        for steps, learning_rate in grid:
+            print(f"   - steps={steps}, lr={learning_rate}")
+        if args.dry_run:
+            return 0
+        launched = launch_sweep(args.images_url, parse_grid(args.steps, int), parse_grid(args.learning_rates, float),
+                                args.destination, args.results)
+        results = load_results(args.results)
+        ids = {run["id"] for run in launched if run["id"]}
+        runs = [run for run in results["runs"] if run["id"] in ids]
+        if args.no_watch:
+            print_summary(runs)
+            return 0
+
+    try:
+        asyncio.run(watch_runs(runs, results, args.results, args.timeout * 3600, args.poll_min, args.poll_max))
+    except KeyboardInterrupt:
+        print(f"\n⏸  Наблюдение прервано; продолжить: python train_sweep.py --watch --results {args.results}")
+    print_summary(runs)
+    print(f"💾 Результаты: {args.results}")
+    return 0 if all(run["status"] == "succeeded" for run in runs) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""
+Инкрементальная сборка обучающего архива
+Содержимое файлов хешируется, и если набор не изменился с прошлой сборки, архив не пересобирается.
+Уже сжатые форматы (JPEG, PNG, WebP) кладутся без повторного сжатия (ZIP_STORED), файлы копируются
+в архив потоком по частям. Рядом с архивом пишется манифест (имя, sha256, размер каждого файла),
+копия манифеста каждой версии набора сохраняется, так что две версии можно сравнить:
+
+    python training_archive.py ./training_images --output training_data.zip
+    python training_archive.py --diff 1a2b3c4d5e6f 9f8e7d6c5b4a    # хеши версий или пути к манифестам
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import hashlib
+import logging
+import argparse
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# КОНФИГУРАЦИЯ
+# =============================================================================
+
+MANIFEST_HISTORY_DIR = os.getenv("TRAINING_MANIFEST_DIR", ".cache/training_manifests")
+STORED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.zip'}  # Повторное сжатие ничего не даёт
+HASH_CHUNK_SIZE = 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)  # Одинаковый набор — байт-в-байт одинаковый архив
+
+# =============================================================================
+# МАНИФЕСТ
+# =============================================================================
+
+def manifest_path(output_zip: str) -> str:
+    return f"{os.path.splitext(output_zip)[0]}.manifest.json"
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def dataset_hash(entries: list) -> str:
+    """Хеш версии набора: имена в архиве и хеши содержимого"""
+    digest = hashlib.sha256()
+    for entry in sorted(entries, key=lambda item: item["name"]):
+        digest.update(f"{entry['name']}\0{entry['sha256']}\n".encode())
+    return digest.hexdigest()
+
+
+def load_manifest(path: str) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(path: str, payload: dict):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, path)
+
+
+def hash_files(files: list, previous: dict = None) -> list:
+    """
+    Записи манифеста для [(путь, имя в архиве)], отсортированные по имени
+    Хеш файла с тем же путём, размером и mtime берётся из прошлого манифеста без чтения файла.
+    """
+    known = {entry.get("source"): entry for entry in (previous or {}).get("files", [])}
+    names = set()
+    entries = []
+    for path, name in files:
+        if name in names:
+            raise ValueError(f"Duplicate archive name: {name}")
+        names.add(name)
+        stat = os.stat(path)
+        old = known.get(os.path.abspath(path))
+        if old and old.get("bytes") == stat.st_size and old.get("mtime_ns") == stat.st_mtime_ns:
+            sha256 = old["sha256"]
+        else:
+            sha256 = file_sha256(path)
+        entries.append({
+            "name": name,
+            "sha256": sha256,
+            "bytes": stat.st_size,
+            "compression": "stored" if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS else "deflated",
+            "source": os.path.abspath(path),
+            "mtime_ns": stat.st_mtime_ns,
+        })
+    return sorted(entries, key=lambda entry: entry["name"])
+
+
+def diff_manifests(old: dict, new: dict) -> dict:
+    """Что изменилось между двумя версиями набора: added / removed / changed (имена файлов)"""
+    old_files = {entry["name"]: entry["sha256"] for entry in old.get("files", [])}
+    new_files = {entry["name"]: entry["sha256"] for entry in new.get("files", [])}
+    return {
+        "added": sorted(set(new_files) - set(old_files)),
+        "removed": sorted(set(old_files) - set(new_files)),
+        "changed": sorted(name for name in set(old_files) & set(new_files) if old_files[name] != new_files[name]),
+        "unchanged": sum(1 for name in set(old_files) & set(new_files) if old_files[name] == new_files[name]),
+    }
+
+# =============================================================================
+# АРХИВ
+# =============================================================================
+
+def write_archive(entries: list, fileobj):
+    """
+    Пишет ZIP в fileobj потоком: файлы копируются частями, целиком в памяти ничего не держится
+    fileobj может быть и непозиционируемым (сокет, pipe) — zipfile тогда пишет дескрипторы данных.
+    """
+    with zipfile.ZipFile(fileobj, 'w', allowZip64=True) as zipf:
+        for entry in entries:
+            info = zipfile.ZipInfo(entry["name"], date_time=ZIP_DATE_TIME)
+            info.compress_type = zipfile.ZIP_STORED if entry["compression"] == "stored" else zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            with open(entry["source"], 'rb') as source, \
+                    zipf.open(info, 'w', force_zip64=entry["bytes"] > 2 ** 31) as target:
+                shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+
+
+def build_training_archive(files: list, output_zip: str = "training_data.zip", force: bool = False) -> dict:
+    """
+    Собирает архив из [(путь, имя в архиве)], если набор изменился (или force)
+    Возвращает манифест с полями built (собирался ли архив) и diff (изменения с прошлой версии).
+    """
+    started = time.perf_counter()
+    previous = load_manifest(manifest_path(output_zip))
+    entries = hash_files(files, previous)
+    version = dataset_hash(entries)
+
+    up_to_date = (
+        not force
+        and previous.get("dataset_hash") == version
+        and os.path.exists(output_zip)
+        and os.path.getsize(output_zip) == previous.get("archive_bytes")
+    )
+    if not up_to_date:
+        temp_path = f"{output_zip}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                write_archive(entries, f)
+            os.replace(temp_path, output_zip)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    manifest = {
+        "dataset_hash": version,
+        "archive": os.path.basename(output_zip),
+        "archive_bytes": os.path.getsize(output_zip),
+        "created_at": previous.get("created_at") if up_to_date else time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "files": entries,
+    }
+    _write_json(manifest_path(output_zip), manifest)
+    _write_json(os.path.join(MANIFEST_HISTORY_DIR, f"{version[:12]}.json"), manifest)
+    logger.info(f"Training archive {output_zip} {'rebuilt' if not up_to_date else 'up to date'}: "
+                f"{len(entries)} files, version {version[:12]}, {time.perf_counter() - started:.2f}s")
+    return dict(
+        manifest,
+        built=not up_to_date,
+        diff=diff_manifests(previous, manifest) if previous else None,
+        previous_hash=previous.get("dataset_hash"),
+    )
+
+
+def resolve_manifest(ref: str) -> dict:
+    """Манифест по пути или по префиксу хеша версии из истории"""
+    if os.path.exists(ref):
+        return load_manifest(ref)
+    if os.path.isdir(MANIFEST_HISTORY_DIR):
+        matches = [name for name in os.listdir(MANIFEST_HISTORY_DIR) if name.startswith(ref[:12])]
+        if len(matches) == 1:
+            return load_manifest(os.path.join(MANIFEST_HISTORY_DIR, matches[0]))
+    raise FileNotFoundError(f"Manifest {ref} not found")
+
+
+def print_diff(diff: dict):
+    print(f"   ➕ добавлено: {len(diff['added'])}, ➖ удалено: {len(diff['removed'])}, "
+          f"✏️  изменено: {len(diff['changed'])}, без изменений: {diff['unchanged']}")
+    for sign, key in (("+", "added"), ("-", "removed"), ("~", "changed")):
+        for name in diff[key][:20]:
+            print(f"   {sign} {name}")
+        if len(diff[key]) > 20:
+            print(f"   {sign} ... и ещё {len(diff[key]) - 20}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Сборка обучающего архива и сравнение версий набора")
+    parser.add_argument("images_dir", nargs="?", default="./training_images")
+    parser.add_argument("--output", default="training_data.zip", help="Путь к архиву")
+    parser.add_argument("--force", action="store_true", help="Пересобрать, даже если набор не изменился")
+    parser.add_argument("--raw", action="store_true", help="Упаковать исходники без подготовки (training_data.py)")
+    parser.add_argument("--diff", nargs=2, metavar=("OLD", "NEW"), help="Сравнить две версии (манифест или хеш)")
+    args = parser.parse_args(argv)
+
+    if args.diff:
+        try:
+            old, new = (resolve_manifest(ref) for ref in args.diff)
+        except FileNotFoundError as e:
+            print(f"❌ {e}")
+            return 1
+        print(f"🔀 {old['dataset_hash'][:12]} → {new['dataset_hash'][:12]}")
+        print_diff(diff_manifests(old, new))
+        return 0
+
+    if not os.path.isdir(args.images_dir):
+        print(f"❌ Папка {args.images_dir} не найдена!")
+        return 1
+    if args.raw:
+        from training_data import list_training_images
+        files = [(path, os.path.basename(path)) for path in list_training_images(args.images_dir)]
+    else:
+        from training_data import prepare_training_images, prepared_files
+        files = prepared_files(prepare_training_images(args.images_dir))
+
+    result = build_training_archive(files, args.output, force=args.force)
+    print(f"{'📦 Архив собран' if result['built'] else '✅ Архив не изменился'}: {args.output} "
+          f"({result['archive_bytes'] / 1024 / 1024:.1f} MB, {len(result['files'])} файлов, "
+          f"версия {result['dataset_hash'][:12]})")
+    if result["diff"] and result["previous_hash"] != result["dataset_hash"]:
+        print(f"🔀 Изменения с версии {result['previous_hash'][:12]}:")
+        print_diff(result["diff"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,323 @@
+"""
+Проверка и подготовка обучающих изображений для LoRA
+Каждый файл полностью декодируется (битые и обрезанные файлы находятся до платного обучения),
+проверяются размеры и режим, картинка приводится к рабочему разрешению тренера и
+перекодируется в компактный JPEG. Файлы обрабатываются параллельно в пуле процессов.
+Результаты кешируются по содержимому и параметрам: неизменённые файлы при повторном
+запуске не декодируются. Отчёт по каждому файлу — в <output_dir>/report.json.
+
+    python training_data.py ./training_images
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+from io import BytesIO
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# КОНФИГУРАЦИЯ
+# =============================================================================
+
+TRAINING_CACHE_DIR = os.getenv("TRAINING_CACHE_DIR", ".cache/training_images")
+TRAINING_RESOLUTION = 1024    # Разрешение тренера (длинная сторона после подготовки, px)
+TRAINING_MIN_SIDE = 256       # Меньше — файл отклоняется: тренеру нечему учиться
+TRAINING_MAX_PIXELS = 60_000_000  # Больше — отклоняется до декодирования (защита от «бомб»)
+TRAINING_MAX_ASPECT = 2.0     # Более вытянутые кадры обрезаются по центру до этого соотношения
+TRAINING_JPEG_QUALITY = 92
+PREPARE_VERSION = 2           # Увеличить при изменении алгоритма обработки (2: перцептивные хеши)
+
+SUPPORTED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp'}
+MANIFEST_NAME = "manifest.json"
+REPORT_NAME = "report.json"
+PREPARED_NAME_RE = re.compile(r'^[0-9a-f]{32}\.jpg$')  # имена подготовленных файлов (_cache_key)
+
+# =============================================================================
+# ОБРАБОТКА ОДНОГО ФАЙЛА (выполняется в процессе пула)
+# =============================================================================
+
+def prepare_params(resolution: int = TRAINING_RESOLUTION, quality: int = TRAINING_JPEG_QUALITY) -> dict:
+    return {
+        "version": PREPARE_VERSION,
+        "resolution": resolution,
+        "quality": quality,
+        "min_side": TRAINING_MIN_SIDE,
+        "max_pixels": TRAINING_MAX_PIXELS,
+        "max_aspect": TRAINING_MAX_ASPECT,
+    }
+
+
+def _cache_key(digest: str, params: dict) -> str:
+    blob = json.dumps(params, sort_keys=True)
+    return hashlib.sha256(f"{digest}:{blob}".encode()).hexdigest()[:32]
+
+
+def _center_crop_box(width: int, height: int, max_aspect: float) -> tuple:
+    """Прямоугольник центральной обрезки до соотношения сторон max_aspect (или None)"""
+    if width / height > max_aspect:
+        new_width = int(height * max_aspect)
+        left = (width - new_width) // 2
+        return left, 0, left + new_width, height
+    if height / width > max_aspect:
+        new_height = int(width * max_aspect)
+        top = (height - new_height) // 2
+        return 0, top, width, top + new_height
+    return None
+
+
+def prepare_file(source: str, output_dir: str, params: dict, previous: dict = None) -> dict:
+    """
+    Проверяет и подготавливает один файл; возвращает запись отчёта
+    status: ok | rejected | error; issues — что было исправлено или почему файл отклонён
+    """
+    from PIL import Image, ImageOps, UnidentifiedImageError
+    from image_hashing import phash, dhash
+
+    stat = os.stat(source)
+    entry = {
+        "name": os.path.basename(source),
+        "mtime_ns": stat.st_mtime_ns,
+        "source_bytes": stat.st_size,
+        "issues": [],
+    }
+    started = time.perf_counter()
+    try:
+        with open(source, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        key = _cache_key(digest, params)
+        output_path = os.path.join(output_dir, f"{key}.jpg")
+        if previous and previous.get("key") == key and (previous["status"] != "ok" or os.path.exists(output_path)):
+            # Содержимое не менялось (например, файл только «тронули») — прошлый результат в силе
+            return dict(previous, mtime_ns=stat.st_mtime_ns, cached=True)
+        entry.update(digest=digest, key=key)
+
+        with Image.open(BytesIO(data)) as img:
+            entry.update(format=img.format, mode=img.mode, width=img.width, height=img.height)
+            if img.width * img.height > params["max_pixels"]:
+                entry["issues"].append(f"too large: {img.width}x{img.height}")
+                entry["status"] = "rejected"
+                return entry
+            # verify() не декодирует пиксели; load() находит обрезанные и битые файлы
+            img.load()
+            img = ImageOps.exif_transpose(img)
+
+            if min(img.size) < params["min_side"]:
+                entry["issues"].append(f"too small: {img.width}x{img.height} < {params['min_side']}px")
+                entry["status"] = "rejected"
+                return entry
+
+            if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+                img = img.convert('RGBA')
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.split()[3])
+                img = background
+                entry["issues"].append("transparency flattened on white")
+            elif img.mode != 'RGB':
+                entry["issues"].append(f"converted from {img.mode}")
+                img = img.convert('RGB')
+
+            box = _center_crop_box(img.width, img.height, params["max_aspect"])
+            if box:
+                img = img.crop(box)
+                entry["issues"].append(f"center-cropped to {img.width}x{img.height}")
+
+            if max(img.size) > params["resolution"]:
+                img.thumbnail((params["resolution"], params["resolution"]), Image.LANCZOS)
+                entry["issues"].append(f"resized to {img.width}x{img.height}")
+            elif max(img.size) < params["resolution"] // 2:
+                entry["issues"].append(f"low resolution {img.width}x{img.height}, trainer will upscale")
+
+            # Хеши для поиска почти-дублей считаются здесь же, пока картинка декодирована
+            entry.update(phash=f"{phash(img):016x}", dhash=f"{dhash(img):016x}")
+
+            temp_path = f"{output_path}.{os.getpid()}.tmp"
+            img.save(temp_path, format='JPEG', quality=params["quality"], optimize=True)
+            os.replace(temp_path, output_path)
+            entry.update(output=os.path.basename(output_path), output_width=img.width,
+                         output_height=img.height, output_bytes=os.path.getsize(output_path))
+        entry["status"] = "ok"
+        return entry
+    except UnidentifiedImageError:
+        entry["issues"].append("not an image or unsupported format")
+        entry["status"] = "error"
+        return entry
+    except Exception as e:
+        entry["issues"].append(f"{type(e).__name__}: {e}")
+        entry["status"] = "error"
+        return entry
+    finally:
+        entry["seconds"] = round(time.perf_counter() - started, 3)
+
+
+# =============================================================================
+# ПАПКА ЦЕЛИКОМ
+# =============================================================================
+
+def list_training_images(images_dir: str) -> list:
+    return sorted(
+        str(path) for path in Path(images_dir).iterdir()
+        if path.is_file() and path.suffix.lower() in SUPPORTED_EXTENSIONS
+    )
+
+
+def _load_manifest(output_dir: str, params: dict) -> dict:
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # При других параметрах обработки прошлые результаты не годятся
+    return manifest.get("files", {}) if manifest.get("params") == params else {}
+
+
+def _write_json(path: str, payload: dict):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, path)
+
+
+def prune_prepared(output_dir: str, keep: set) -> int:
+    """Удаляет подготовленные JPEG, которых нет в текущем отчёте (исходник удалён, изменён или сменились параметры)"""
+    removed = 0
+    for name in os.listdir(output_dir):
+        if PREPARED_NAME_RE.match(name) and name not in keep:
+            try:
+                os.remove(os.path.join(output_dir, name))
+                removed += 1
+            except OSError as e:
+                logger.warning(f"Failed to remove stale prepared file {name}: {e}")
+    return removed
+
+
+def prepare_training_images(images_dir: str, output_dir: str = None, resolution: int = TRAINING_RESOLUTION,
+                            quality: int = TRAINING_JPEG_QUALITY, workers: int = None) -> dict:
+    """
+    Проверяет и подготавливает все изображения папки параллельно
+    Возвращает отчёт: files (запись на файл), prepared (пути готовых JPEG по порядку исходников), summary.
+    """
+    output_dir = output_dir or TRAINING_CACHE_DIR
+    os.makedirs(output_dir, exist_ok=True)
+    params = prepare_params(resolution, quality)
+    previous = _load_manifest(output_dir, params)
+    sources = list_training_images(images_dir)
+
+    started = time.perf_counter()
+    results, pending = {}, []
+    for source in sources:
+        name = os.path.basename(source)
+        entry = previous.get(name)
+        stat = os.stat(source)
+        output = entry and entry.get("output") and os.path.join(output_dir, entry["output"])
+        if (entry and entry.get("mtime_ns") == stat.st_mtime_ns and entry.get("source_bytes") == stat.st_size
+                and (entry["status"] != "ok" or os.path.exists(output))):
+            # Файл не менялся — даже не читаем его
+            results[name] = dict(entry, cached=True)
+        else:
+            pending.append(source)
+
+    if pending:
+        workers = workers or min(len(pending), os.cpu_count() or 1)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(prepare_file, source, output_dir, params, previous.get(os.path.basename(source)))
+                           for source in pending]
+                for future in futures:
+                    entry = future.result()
+                    results[entry["name"]] = entry
+        else:
+            for source in pending:
+                entry = prepare_file(source, output_dir, params, previous.get(os.path.basename(source)))
+                results[entry["name"]] = entry
+
+    files = [results[os.path.basename(source)] for source in sources]
+    _write_json(os.path.join(output_dir, MANIFEST_NAME), {
+        "params": params,
+        "files": {name: {k: v for k, v in entry.items() if k != "cached"} for name, entry in results.items()},
+    })
+
+    ok = [entry for entry in files if entry["status"] == "ok"]
+    pruned = prune_prepared(output_dir, {entry["output"] for entry in ok})
+    summary = {
+        "total": len(files),
+        "ok": len(ok),
+        "rejected": sum(1 for entry in files if entry["status"] == "rejected"),
+        "errors": sum(1 for entry in files if entry["status"] == "error"),
+        "cached": sum(1 for entry in files if entry.get("cached")),
+        "processed": sum(1 for entry in files if not entry.get("cached")),
+        "pruned": pruned,
+        "source_mb": round(sum(entry["source_bytes"] for entry in files) / 1024 / 1024, 2),
+        "prepared_mb": round(sum(entry.get("output_bytes", 0) for entry in ok) / 1024 / 1024, 2),
+        "seconds": round(time.perf_counter() - started, 2),
+    }
+    report = {
+        "images_dir": str(images_dir),
+        "output_dir": output_dir,
+        "params": params,
+        "summary": summary,
+        "files": files,
+        "prepared": [os.path.join(output_dir, entry["output"]) for entry in ok],
+    }
+    _write_json(os.path.join(output_dir, REPORT_NAME), report)
+    return report
+
+
+def prepared_files(report: dict, exclude=()) -> list:
+    """
+    (путь подготовленного JPEG, имя в архиве) для годных файлов, кроме имён из exclude
+    Имя — по исходнику: photo.png -> photo.jpg; при совпадении основ (a.png и a.jpg) — a.png.jpg.
+    """
+    ok = [entry for entry in report["files"] if entry["status"] == "ok" and entry["name"] not in exclude]
+    stems = [Path(entry["name"]).stem for entry in ok]
+    return [
+        (os.path.join(report["output_dir"], entry["output"]),
+         f"{stem}.jpg" if stems.count(stem) == 1 else f"{entry['name']}.jpg")
+        for entry, stem in zip(ok, stems)
+    ]
+
+
+def print_report(report: dict):
+    summary = report["summary"]
+    print(f"🔍 Проверено {summary['total']} файлов за {summary['seconds']} с "
+          f"(обработано {summary['processed']}, из кеша {summary['cached']})")
+    print(f"   ✅ готово: {summary['ok']}, ⛔ отклонено: {summary['rejected']}, ❌ ошибок: {summary['errors']}")
+    print(f"   📦 {summary['source_mb']} MB → {summary['prepared_mb']} MB")
+    if summary.get("pruned"):
+        print(f"   🧹 удалено устаревших копий: {summary['pruned']}")
+    for entry in report["files"]:
+        if entry["status"] != "ok":
+            print(f"   {'⛔' if entry['status'] == 'rejected' else '❌'} {entry['name']}: {'; '.join(entry['issues'])}")
+        elif entry["issues"]:
+            print(f"   ✏️  {entry['name']}: {'; '.join(entry['issues'])}")
+    print(f"📝 Отчёт: {os.path.join(report['output_dir'], REPORT_NAME)}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Проверка и подготовка обучающих изображений")
+    parser.add_argument("images_dir", nargs="?", default="./training_images")
+    parser.add_argument("--output-dir", default=TRAINING_CACHE_DIR, help="Куда класть подготовленные файлы и отчёт")
+    parser.add_argument("--resolution", type=int, default=TRAINING_RESOLUTION)
+    parser.add_argument("--quality", type=int, default=TRAINING_JPEG_QUALITY)
+    parser.add_argument("--workers", type=int, help="Процессов (по умолчанию — по числу ядер)")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.images_dir):
+        print(f"❌ Папка {args.images_dir} не найдена!")
+        return 1
+    report = prepare_training_images(args.images_dir, args.output_dir, args.resolution, args.quality, args.workers)
+    print_report(report)
+    return 0 if report["summary"]["errors"] == 0 and report["summary"]["rejected"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+"""
+Поиск почти-дублей в обучающем наборе по перцептивным хешам
+Хеши (pHash и dHash) считаются при подготовке изображений (training_data.py) и кешируются вместе
+с ней. Соседи ищутся индексом по частям хеша: при пороге t хеш режется на t+1 полос, и у любых двух
+хешей на расстоянии ≤ t хотя бы одна полоса совпадает (принцип Дирихле) — сравниваются только
+хеши из общих корзин, а не все пары. Пары с близкими pHash и dHash объединяются в кластеры;
+в каждом остаётся файл с наибольшим разрешением, остальные можно исключить из архива.
+
+    python training_dedup.py ./training_images --threshold 6
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+
+import numpy as np
+
+from image_hashing import pairwise_hamming
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# КОНФИГУРАЦИЯ
+# =============================================================================
+
+DEDUP_PHASH_THRESHOLD = 6    # Бит из 64: до этого расстояния pHash картинки считаются почти одинаковыми
+DEDUP_DHASH_THRESHOLD = 10   # Подтверждение по dHash отсекает случайные совпадения pHash
+HASH_BITS = 64
+DEDUP_REPORT_NAME = "duplicates.json"
+
+# =============================================================================
+# ИНДЕКС
+# =============================================================================
+
+class HashIndex:
+    """Индекс 64-битных хешей для поиска соседей на расстоянии Хэмминга ≤ max_distance"""
+
+    def __init__(self, hashes, max_distance: int):
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.max_distance = max_distance
+        bands = min(HASH_BITS, max_distance + 1)
+        bounds = np.linspace(0, HASH_BITS, bands + 1).astype(int)
+        self._bands = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            mask = np.uint64((1 << int(end - start)) - 1)
+            keys = (self.hashes >> np.uint64(start)) & mask
+            buckets = {}
+            for index, key in enumerate(keys.tolist()):
+                buckets.setdefault(key, []).append(index)
+            self._bands.append((np.uint64(start), mask, buckets))
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def query(self, value: int) -> tuple:
+        """(индексы, расстояния) хешей не дальше max_distance от value"""
+        value = np.uint64(value)
+        candidates = set()
+        for start, mask, buckets in self._bands:
+            candidates.update(buckets.get(int((value >> start) & mask), ()))
+        if not candidates:
+            return np.array([], dtype=int), np.array([], dtype=int)
+        indices = np.fromiter(sorted(candidates), dtype=int)
+        distances = pairwise_hamming(self.hashes[indices], value)
+        close = distances <= self.max_distance
+        return indices[close], distances[close]
+
+    def pairs(self) -> list:
+        """Все пары (i, j, расстояние), i < j, не дальше max_distance"""
+        candidates = set()
+        for _, _, buckets in self._bands:
+            for members in buckets.values():
+                if len(members) > 1:
+                    candidates.update(
+                        (members[a], members[b]) for a in range(len(members)) for b in range(a + 1, len(members))
+                    )
+        if not candidates:
+            return []
+        left, right = np.array(sorted(candidates), dtype=int).T
+        distances = pairwise_hamming(self.hashes[left], self.hashes[right])
+        close = distances <= self.max_distance
+        return list(zip(left[close].tolist(), right[close].tolist(), distances[close].tolist()))
+
+# =============================================================================
+# КЛАСТЕРЫ
+# =============================================================================
+
+def _find(parents: list, index: int) -> int:
+    while parents[index] != index:
+        parents[index] = parents[parents[index]]
+        index = parents[index]
+    return index
+
+
+def _keep_rank(entry: dict) -> tuple:
+    """Какой файл кластера оставить: больше пикселей, затем больше байт, затем по имени"""
+    return -(entry.get("width", 0) * entry.get("height", 0)), -entry.get("source_bytes", 0), entry["name"]
+
+
+def find_duplicate_clusters(entries: list, phash_threshold: int = DEDUP_PHASH_THRESHOLD,
+                            dhash_threshold: int = DEDUP_DHASH_THRESHOLD) -> list:
+    """
+    Кластеры почти-дублей среди записей отчёта подготовки (нужны поля name, phash, dhash)
+    Кластер: {"keep": имя, "drop": [имена], "max_distance": худшее расстояние pHash в кластере}.
+    """
+    entries = [entry for entry in entries if entry.get("phash") and entry.get("dhash")]
+    if len(entries) < 2:
+        return []
+    phashes = np.array([int(entry["phash"], 16) for entry in entries], dtype=np.uint64)
+    dhashes = np.array([int(entry["dhash"], 16) for entry in entries], dtype=np.uint64)
+
+    pairs = HashIndex(phashes, phash_threshold).pairs()
+    if pairs:
+        left, right, distances = (np.array(column) for column in zip(*pairs))
+        confirmed = pairwise_hamming(dhashes[left], dhashes[right]) <= dhash_threshold
+        pairs = list(zip(left[confirmed].tolist(), right[confirmed].tolist(), distances[confirmed].tolist()))
+
+    parents = list(range(len(entries)))
+    for i, j, _ in pairs:
+        parents[_find(parents, j)] = _find(parents, i)
+    worst = {}
+    for i, _, distance in pairs:
+        root = _find(parents, i)
+        worst[root] = max(worst.get(root, 0), distance)
+
+    groups = {}
+    for index in range(len(entries)):
+        groups.setdefault(_find(parents, index), []).append(entries[index])
+    clusters = []
+    for root, members in groups.items():
+        if len(members) < 2:
+            continue
+        members.sort(key=_keep_rank)
+        clusters.append({
+            "keep": members[0]["name"],
+            "drop": [member["name"] for member in members[1:]],
+            "max_distance": worst.get(root, 0),
+        })
+    return sorted(clusters, key=lambda cluster: cluster["keep"])
+
+
+def find_near_duplicates(report: dict, phash_threshold: int = DEDUP_PHASH_THRESHOLD,
+                         dhash_threshold: int = DEDUP_DHASH_THRESHOLD) -> dict:
+    """Почти-дубли среди годных файлов отчёта подготовки; результат пишется рядом с отчётом"""
+    ok = [entry for entry in report["files"] if entry["status"] == "ok"]
+    clusters = find_duplicate_clusters(ok, phash_threshold, dhash_threshold)
+    drop = sorted(name for cluster in clusters for name in cluster["drop"])
+    drop_bytes = sum(entry.get("output_bytes", 0) for entry in ok if entry["name"] in drop)
+    result = {
+        "phash_threshold": phash_threshold,
+        "dhash_threshold": dhash_threshold,
+        "checked": len(ok),
+        "clusters": clusters,
+        "drop": drop,
+        "drop_mb": round(drop_bytes / 1024 / 1024, 2),
+    }
+    path = os.path.join(report["output_dir"], DEDUP_REPORT_NAME)
+    with open(path, 'w') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    return result
+
+
+def print_duplicates(result: dict):
+    if not result["clusters"]:
+        print(f"🧬 Почти-дублей не найдено ({result['checked']} изображений)")
+        return
+    print(f"🧬 Почти-дубли: {len(result['clusters'])} групп, лишних файлов {len(result['drop'])} "
+          f"(~{result['drop_mb']} MB)")
+    for cluster in result["clusters"][:20]:
+        print(f"   ✅ {cluster['keep']} ≈ {', '.join(cluster['drop'])} (до {cluster['max_distance']} бит)")
+    if len(result["clusters"]) > 20:
+        print(f"   ... и ещё {len(result['clusters']) - 20} групп")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Поиск почти-дублей в обучающем наборе")
+    parser.add_argument("images_dir", nargs="?", default="./training_images")
+    parser.add_argument("--threshold", type=int, default=DEDUP_PHASH_THRESHOLD, help="Порог pHash, бит из 64")
+    parser.add_argument("--dhash-threshold", type=int, default=DEDUP_DHASH_THRESHOLD, help="Порог dHash, бит из 64")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.images_dir):
+        print(f"❌ Папка {args.images_dir} не найдена!")
+        return 1
+    from training_data import prepare_training_images
+    report = prepare_training_images(args.images_dir)
+    result = find_near_duplicates(report, args.threshold, args.dhash_threshold)
+    print_duplicates(result)
+    print(f"📝 Отчёт: {os.path.join(report['output_dir'], DEDUP_REPORT_NAME)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,277 @@
+"""
+Учёт предсказаний: время GPU, очередь, размер выхода и стоимость
+Каждое предсказание пишется в SQLite с метриками, которые вернул провайдер (predict_time,
+created_at/started_at/completed_at), и оценкой стоимости по прайсу модели. Сводка по дням,
+пользователям, моделям и функциям (генерация, удаление фона, прогрев) — для /stats и экспорта.
+
+    python usage_stats.py --days 7                     # сводка в консоль
+    python usage_stats.py --days 30 --csv usage.csv    # сырые записи для таблиц
+    python usage_stats.py --json usage_report.json     # сводка в JSON
+"""
+
+import os
+import re
+import csv
+import math
+import sys
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+USAGE_DB_PATH = os.getenv("USAGE_DB_PATH", "data/usage.sqlite3")
+
+PREDICTION_COST = metrics.counter("prediction_cost_usd_total", "Estimated provider spend by model and feature")
+PREDICTION_GPU_SECONDS = metrics.counter("prediction_gpu_seconds_total", "Provider-reported predict time")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    prediction_id TEXT,
+    created_at    REAL    NOT NULL,
+    day           TEXT    NOT NULL,
+    user_id       INTEGER,
+    model         TEXT    NOT NULL,
+    feature       TEXT    NOT NULL,
+    provider      TEXT,
+    status        TEXT    NOT NULL,
+    predict_time  REAL,
+    queue_time    REAL,
+    total_time    REAL,
+    wall_time     REAL,
+    output_bytes  INTEGER,
+    cost_usd      REAL
+);
+CREATE INDEX IF NOT EXISTS predictions_day ON predictions (day);
+CREATE INDEX IF NOT EXISTS predictions_prediction_id ON predictions (prediction_id);
+"""
+
+CSV_FIELDS = ("prediction_id", "created_at", "day", "user_id", "model", "feature", "provider", "status",
+              "predict_time", "queue_time", "total_time", "wall_time", "output_bytes", "cost_usd")
+
+
+def parse_timestamp(value):
+    """ISO-время Replicate ('2024-01-01T00:00:00.123456789Z') -> datetime или None"""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    # fromisoformat в 3.10 не понимает Z и больше 6 знаков дробной части
+    value = re.sub(r'(\.\d{6})\d+', r'\1', str(value).replace('Z', '+00:00'))
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def _seconds_between(start, end):
+    start, end = parse_timestamp(start), parse_timestamp(end)
+    if start is None or end is None:
+        return None
+    return max(0.0, (end - start).total_seconds())
+
+
+def percentile(values: list, pct: float):
+    """Перцентиль методом ближайшего ранга (None для пустого списка)"""
+    ordered = sorted(v for v in values if v is not None)
+    if not ordered:
+        return None
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def estimate_cost(pricing: dict, model: str, predict_time, succeeded: bool = True) -> float:
+    """
+    Стоимость по прайсу: {"per_prediction": $} и/или {"per_second": $ за секунду GPU}
+    Время GPU оплачивается и у неудачных предсказаний, поштучная цена — только у успешных.
+    """
+    price = pricing.get(model.split(':')[0]) or {}
+    cost = price.get("per_prediction", 0.0) if succeeded else 0.0
+    if predict_time is not None:
+        cost += price.get("per_second", 0.0) * predict_time
+    return round(cost, 6)
+
+
+class UsageStore:
+    """Потокобезопасное хранилище записей о предсказаниях"""
+
+    def __init__(self, path: str = USAGE_DB_PATH, pricing: dict = None):
+        self.path = path
+        self.pricing = pricing or {}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+
+    def record(self, model: str, prediction: dict, feature: str = "other", user_id: int = None,
+               status: str = "succeeded", wall_time: float = None) -> int:
+        """Записывает предсказание; prediction — данные провайдера (id, metrics, created_at...)"""
+        provider_metrics = prediction.get("metrics") or {}
+        predict_time = provider_metrics.get("predict_time")
+        cost = estimate_cost(self.pricing, model, predict_time, succeeded=status == "succeeded")
+        now = time.time()
+        row = {
+            "prediction_id": prediction.get("id"),
+            "created_at": now,
+            "day": datetime.fromtimestamp(now).strftime("%Y-%m-%d"),
+            "user_id": user_id,
+            "model": model.split(':')[0],
+            "feature": feature,
+            "provider": prediction.get("provider"),
+            "status": status,
+            "predict_time": predict_time,
+            "queue_time": _seconds_between(prediction.get("created_at"), prediction.get("started_at")),
+            "total_time": _seconds_between(prediction.get("created_at"), prediction.get("completed_at")),
+            "wall_time": round(wall_time, 3) if wall_time is not None else None,
+            "output_bytes": None,
+            "cost_usd": cost,
+        }
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                f"INSERT INTO predictions ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                list(row.values())
+            )
+        PREDICTION_COST.inc(cost, model=row["model"], feature=feature)
+        if predict_time:
+            PREDICTION_GPU_SECONDS.inc(predict_time, model=row["model"], feature=feature)
+        return cursor.lastrowid
+
+    def set_output_size(self, prediction_id: str, size: int):
+        """Размер выхода известен только после загрузки картинки"""
+        if not prediction_id:
+            return
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE predictions SET output_bytes = ? WHERE prediction_id = ? AND output_bytes IS NULL",
+                (size, prediction_id)
+            )
+
+    def rows(self, days: int = 7) -> list:
+        """Записи за последние days дней (включая сегодня)"""
+        since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM predictions WHERE day >= ? ORDER BY created_at", (since,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def report(self, days: int = 7, top_users: int = 10) -> dict:
+        return build_report(self.rows(days), days, top_users)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _summarize(rows: list) -> dict:
+    succeeded = [row for row in rows if row["status"] == "succeeded"]
+    active_hours = len({int(row["created_at"] // 3600) for row in rows})
+    return {
+        "predictions": len(rows),
+        "failed": len(rows) - len(succeeded),
+        "per_active_hour": round(len(rows) / active_hours, 1) if active_hours else 0.0,
+        "gpu_seconds": round(sum(row["predict_time"] or 0.0 for row in rows), 1),
+        "cost_usd": round(sum(row["cost_usd"] or 0.0 for row in rows), 4),
+        "output_mb": round(sum(row["output_bytes"] or 0 for row in rows) / 1024 / 1024, 2),
+        "wall_p50": percentile([row["wall_time"] for row in succeeded], 50),
+        "wall_p95": percentile([row["wall_time"] for row in succeeded], 95),
+        "predict_p50": percentile([row["predict_time"] for row in succeeded], 50),
+        "queue_p95": percentile([row["queue_time"] for row in succeeded], 95),
+    }
+
+
+def _group(rows: list, field: str) -> dict:
+    groups = {}
+    for row in rows:
+        groups.setdefault(row[field], []).append(row)
+    return {key: _summarize(items) for key, items in groups.items()}
+
+
+def build_report(rows: list, days: int, top_users: int = 10) -> dict:
+    """Сводка: итог, по дням, по моделям, по функциям и самые «дорогие» пользователи"""
+    users = _group([row for row in rows if row["user_id"] is not None], "user_id")
+    top = sorted(users.items(), key=lambda item: item[1]["cost_usd"], reverse=True)[:top_users]
+    return {
+        "days": days,
+        "generated_at": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        "total": _summarize(rows),
+        "by_day": dict(sorted(_group(rows, "day").items())),
+        "by_model": _group(rows, "model"),
+        "by_feature": _group(rows, "feature"),
+        "top_users": {str(user_id): stats for user_id, stats in top},
+    }
+
+
+def write_csv(rows: list, file):
+    writer = csv.DictWriter(file, fieldnames=CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def _fmt_seconds(value) -> str:
+    return f"{value:.1f}s" if value is not None else "—"
+
+
+def format_report(report: dict) -> str:
+    """Короткая текстовая сводка (для /stats и консоли)"""
+    total = report["total"]
+    lines = [
+        f"📊 Предсказания за {report['days']} дн.: {total['predictions']} (ошибок {total['failed']}), "
+        f"~{total['per_active_hour']}/ч",
+        f"💵 ${total['cost_usd']:.2f} · GPU {total['gpu_seconds']:.0f}s · "
+        f"p50/p95 {_fmt_seconds(total['wall_p50'])}/{_fmt_seconds(total['wall_p95'])} · "
+        f"очередь p95 {_fmt_seconds(total['queue_p95'])}",
+    ]
+    sections = [("По дням", report["by_day"]), ("По моделям", report["by_model"]),
+                ("По функциям", report["by_feature"]), ("Пользователи", report["top_users"])]
+    for title, groups in sections:
+        if not groups:
+            continue
+        lines.append(f"\n{title}:")
+        for key, stats in groups.items():
+            lines.append(f"  {key}: {stats['predictions']} шт., ${stats['cost_usd']:.2f}, "
+                         f"GPU {stats['gpu_seconds']:.0f}s, p50 {_fmt_seconds(stats['wall_p50'])}")
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Отчёт по предсказаниям: время GPU, задержки, затраты")
+    parser.add_argument("--db", default=USAGE_DB_PATH, help="База учёта (SQLite)")
+    parser.add_argument("--days", type=int, default=7, help="За сколько последних дней")
+    parser.add_argument("--json", help="Сохранить сводку в JSON")
+    parser.add_argument("--csv", help="Сохранить сырые записи в CSV")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        print(f"⚠️  База {args.db} не найдена")
+        return 1
+
+    store = UsageStore(args.db)
+    rows = store.rows(args.days)
+    report = build_report(rows, args.days)
+    print(format_report(report))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Сводка сохранена: {args.json}")
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            write_csv(rows, f)
+        print(f"💾 Записи сохранены: {args.csv}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())